@@ -0,0 +1,182 @@
+import os
+
+from copier import copy_file, copy_stream, fsync_dir, fsync_path, reflink, temp_path_for
+from delta import content_entry, content_size, open_content, packed_header
+from hashing import CHUNK_SIZE
+from tracing import count, traced
+
+STRATEGIES = (
+    ("reflink", reflink),
+    ("hardlink", os.link),
+)
+
+
+# Puts src at dst using the cheapest mechanism the filesystem allows. The new
+# file is always prepared next to dst and swapped in with os.replace, so an
+# existing dst (which may be a hardlink to a library file) is never written
+# through, only unlinked. durable also flushes the new file and the rename to
+# disk before returning, so a crash can't leave a torn game file behind.
+# link=False never hardlinks, for sources that must not change with dst.
+@traced("activation.place")
+def place(src, dst, progress=None, durable=False, link=True):
+    tmp = temp_path_for(dst)
+    try:
+        if packed_header(src):
+            # stored as a delta or compressed: rebuild it straight into place
+            with open_content(src) as fsrc, open(tmp, "wb") as fdst:
+                copy_stream(fsrc, fdst, progress)
+                if durable:
+                    fdst.flush()
+                    os.fsync(fdst.fileno())
+            strategy = "copy"
+        else:
+            for strategy, clone in STRATEGIES:
+                if strategy == "hardlink" and not link:
+                    continue
+                try:
+                    clone(src, tmp)
+                except OSError:
+                    if os.path.exists(tmp):
+                        os.remove(tmp)
+                    continue
+                if durable:
+                    fsync_path(tmp)
+                if progress:
+                    progress(os.path.getsize(tmp))
+                break
+            else:
+                strategy = "copy"
+                copy_file(src, tmp, progress, durable)
+        os.replace(tmp, dst)
+        if durable:
+            fsync_dir(os.path.dirname(dst))
+        return strategy
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+# -------------------- SWITCH PLANNING --------------------
+# Files at least this big are patched block by block when they are our own
+# copy and can be cloned; smaller ones are simply placed again.
+PATCH_MIN_SIZE = 64 << 20
+
+
+# targets: [(game_file, source or None)]; None means the file must not exist.
+@traced("activation.plan_switch")
+def plan_switch(targets, fingerprints, placements):
+    ops = []
+    for dst, src in targets:
+        if src is None:
+            if os.path.exists(dst):
+                ops.append(("remove", dst, None, None))
+            continue
+        if not os.path.exists(dst):
+            ops.append(("place", dst, src, None))
+            continue
+        if os.path.samefile(src, dst):
+            continue
+        # reflinks and hardlinks are nearly free, comparing contents is not
+        if placements.get(dst) in ("reflink", "hardlink"):
+            ops.append(("place", dst, src, None))
+            continue
+        src_size = content_size(src)
+        dst_st = os.stat(dst)
+        patchable = src_size >= PATCH_MIN_SIZE and dst_st.st_nlink == 1
+        if src_size != dst_st.st_size and not patchable:
+            ops.append(("place", dst, src, None))
+            continue
+        want = content_entry(src, fingerprints)
+        have = fingerprints.lookup(dst)
+        if want["digest"] == have["digest"]:
+            continue
+        if patchable:
+            changed = [
+                i for i, block in enumerate(want["blocks"])
+                if i >= len(have["blocks"]) or have["blocks"][i] != block
+            ]
+            if len(changed) * 2 < len(want["blocks"]):
+                ops.append(("patch", dst, src, changed))
+                continue
+        ops.append(("place", dst, src, None))
+    return ops
+
+
+# Patches a reflink of dst and swaps it in, so like place() it never writes
+# through dst and a crash leaves either the old file or the patched one.
+# Returns the bytes written, or None if dst's filesystem can't clone it; a
+# full copy just to patch it saves nothing, place() the file instead then.
+@traced("activation.patch_blocks")
+def patch_blocks(src, dst, blocks, progress=None, durable=False):
+    tmp = temp_path_for(dst)
+    try:
+        try:
+            reflink(dst, tmp)
+        except OSError:
+            return None
+        written = 0
+        with open_content(src) as fsrc, open(tmp, "r+b") as fdst:
+            for i in blocks:
+                fsrc.seek(i * CHUNK_SIZE)
+                data = fsrc.read(CHUNK_SIZE)
+                fdst.seek(i * CHUNK_SIZE)
+                fdst.write(data)
+                written += len(data)
+                if progress:
+                    progress(len(data))
+            fdst.truncate(content_size(src))
+            if durable:
+                fdst.flush()
+                os.fsync(fdst.fileno())
+        os.replace(tmp, dst)
+        if durable:
+            fsync_dir(os.path.dirname(dst))
+        count(written)
+        return written
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def switch_size(ops):
+    total = 0
+    for kind, dst, src, blocks in ops:
+        if kind == "patch":
+            total += min(len(blocks) * CHUNK_SIZE, content_size(src))
+        elif kind == "place":
+            total += content_size(src)
+    return total
+
+
+# Returns (bytes written, {game_file: strategy}) for the files it touched.
+# on_done(i, strategy) is called once the i-th operation is safely done;
+# every operation can simply be run again if that call never came. Sources
+# in unlinked are never hardlinked into place.
+@traced("activation.apply_switch")
+def apply_switch(ops, fingerprints, progress=None, durable=False, on_done=None, unlinked=()):
+    written = 0
+    strategies = {}
+    for i, (kind, dst, src, blocks) in enumerate(ops):
+        if kind == "remove":
+            if os.path.exists(dst):
+                os.remove(dst)
+            fingerprints.forget(dst)
+            if on_done:
+                on_done(i, "removed")
+            continue
+        patched = patch_blocks(src, dst, blocks, progress, durable) if kind == "patch" else None
+        if patched is not None:
+            written += patched
+            strategies[dst] = "copy"
+        else:
+            strategies[dst] = place(src, dst, progress, durable, src not in unlinked)
+            if strategies[dst] == "copy":
+                written += os.path.getsize(dst)
+        known = content_entry(src, fingerprints, cached_only=True)
+        if known:
+            fingerprints.record(dst, known)
+        else:
+            fingerprints.forget(dst)
+        if on_done:
+            on_done(i, strategies[dst])
+    return written, strategies
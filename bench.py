@@ -0,0 +1,304 @@
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Headless benchmark of the file paths behind the GUI: builds a synthetic game
+# folder and library in a temp folder, drives ModManager on the offscreen Qt
+# platform and writes one JSON record per operation. Runs with the same
+# arguments generate the same files, so results can be compared across
+# commits:
+#
+#   python bench.py --mods 1000 --music-mb 256 --output before.json
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_OUTPUT = os.path.join(REPO_DIR, "bench_output.txt")
+FILLER_SIZE = 4 << 10
+
+
+# -------------------- MEASURING --------------------
+def _proc(name, field):
+    try:
+        with open(f"/proc/self/{name}", "r") as f:
+            for line in f:
+                if line.startswith(field):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+# Linux can reset the peak RSS, which makes it per operation; elsewhere it is
+# the peak of the whole run so far.
+def reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss_mb():
+    hwm = _proc("status", "VmHWM:")
+    if hwm is not None:
+        return hwm / 1024
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / 1024
+
+
+def _round(value):
+    return round(value, 1) if value is not None else None
+
+
+def _commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+class Bench:
+    def __init__(self):
+        self.results = []
+
+    # run() does the operation and returns the bytes it moved
+    def measure(self, op, run, **extra):
+        reset_peak_rss()
+        io_before = _proc("io", "write_bytes:")
+        started = time.perf_counter()
+        nbytes = run()
+        seconds = time.perf_counter() - started
+        io_after = _proc("io", "write_bytes:")
+        result = {
+            "op": op,
+            "seconds": round(seconds, 4),
+            "bytes": nbytes,
+            "mb_per_s": round(nbytes / seconds / 1e6, 1) if nbytes and seconds else None,
+            "disk_write_bytes": io_after - io_before if io_before is not None else None,
+            "peak_rss_mb": _round(peak_rss_mb()),
+            **extra,
+        }
+        self.results.append(result)
+        print(json.dumps(result), file=sys.stderr)
+        return result
+
+
+# -------------------- SYNTHETIC DATA --------------------
+def wad_items(rng, prefix, count, size):
+    per_entry = max(1, size // count)
+    return [(f"{prefix}/{i:05}.{'ogg' if prefix == 'Music' else 'png'}", rng.randbytes(per_entry))
+            for i in range(count)]
+
+
+def write_wad_file(path, items):
+    from wad import write_wad
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        write_wad(f, [(name, memoryview(data)) for name, data in items])
+
+
+# A modded music WAD keeps most of the vanilla tracks, like real ones do.
+def modded_music(rng, vanilla, changed):
+    items = list(vanilla)
+    for i in rng.sample(range(len(items)), max(1, int(len(items) * changed))):
+        items[i] = (items[i][0], rng.randbytes(len(items[i][1])))
+    return items
+
+
+def build_world(args, rng, root):
+    game = os.path.join(root, "game")
+    vanilla = wad_items(rng, "Music", args.tracks, args.music_mb << 20)
+    write_wad_file(os.path.join(game, "hlm2_music_desktop.wad"), vanilla)
+    write_wad_file(os.path.join(game, "hlm2_data_desktop.wad"), wad_items(rng, "Data", 4, 1 << 20))
+    src = os.path.join(root, "src")
+    for name in ("A", "B"):
+        write_wad_file(os.path.join(src, name, f"{name}.patchwad"), wad_items(rng, "Atlases", 64, args.patch_mb << 20))
+        write_wad_file(os.path.join(src, name, "music.wad"), modded_music(rng, vanilla, args.changed))
+    filler = os.path.join(root, "workshop")
+    for i in range(max(0, args.mods - 2)):
+        write_wad_file(os.path.join(filler, f"{i:05}", "level.patchwad"), wad_items(rng, "GL", 2, FILLER_SIZE))
+    return game, src, filler
+
+
+# -------------------- OPERATIONS --------------------
+def tree_size(*paths):
+    return sum(os.path.getsize(os.path.join(d, f)) for p in paths for d, _, fs in os.walk(p) for f in fs)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark HMMM's file operations on synthetic data")
+    parser.add_argument("--mods", type=int, default=100, help="mods in the library (1 to 10000)")
+    parser.add_argument("--patch-mb", type=int, default=16, help="size of each benchmarked patchwad")
+    parser.add_argument("--music-mb", type=int, default=64, help="size of the music WADs")
+    parser.add_argument("--tracks", type=int, default=64, help="tracks per music WAD")
+    parser.add_argument("--changed", type=float, default=0.25, help="share of tracks a mod replaces")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="JSON results file ('-' for stdout)")
+    parser.add_argument("--keep", action="store_true", help="keep the temp folder")
+    args = parser.parse_args(argv)
+    if not 1 <= args.mods <= 10000:
+        parser.error("--mods must be between 1 and 10000")
+    output = args.output if args.output == "-" else os.path.abspath(args.output)
+
+    root = tempfile.mkdtemp(prefix="hmmm-bench-")
+    # the game data folder lives under HOME, set it before core is imported
+    os.environ["HOME"] = root
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    sys.path.insert(0, REPO_DIR)
+    rng = random.Random(args.seed)
+    game, src, filler = build_world(args, rng, root)
+    data_dir = os.path.join(root, "hmmm")
+    os.makedirs(data_dir)
+    os.chdir(data_dir)
+
+    from PySide6.QtWidgets import QApplication
+
+    import modmanager
+    from cold import is_cold
+    from core import ModCore
+
+    app = QApplication([])
+    bench = Bench()
+
+    def settle(window):
+        while window.jobs.jobs:
+            window.jobs.wait()
+            app.processEvents()
+
+    core = ModCore()
+    core.set_game_music_path(os.path.join(game, "hlm2_music_desktop.wad"))
+
+    def ingest():
+        core.ingest_folder(filler)
+        return tree_size(filler)
+
+    if args.mods > 2:
+        bench.measure("ingest", ingest, mods=args.mods - 2)
+    del core
+
+    window = None
+
+    def startup():
+        nonlocal window
+        window = modmanager.ModManager()
+        settle(window)
+        return 0
+
+    bench.measure("startup", startup, mods=args.mods)
+    w = window
+
+    for name in ("A", "B"):
+        files = [os.path.join(src, name, f) for f in sorted(os.listdir(os.path.join(src, name)))]
+
+        def install():
+            w.run_job(f"Installing {name}", lambda job: w.core.install_mod(name, files, False, job),
+                      lambda result: w.add_mod_row(name, *result))
+            settle(w)
+            return tree_size(os.path.join(src, name))
+
+        bench.measure("install", install, mod=name)
+
+    def last_written():
+        return w.core.library.history(1)[0][2]
+
+    def activate():
+        w.activate_mod("A")
+        settle(w)
+        return last_written()
+
+    def switch():
+        w.on_row_activated(w.mod_list.index(w.mod_list.order.index("B"), 0))
+        settle(w)
+        return last_written()
+
+    def restore():
+        w._restore_vanilla_silent()
+        settle(w)
+        return last_written()
+
+    bench.measure("activate", activate, mod="A")
+    bench.measure("switch", switch, mod="B")
+    bench.measure("restore", restore)
+
+    # the dialogs are answered up front
+    package = os.path.join(root, "A.zip")
+    modmanager.QFileDialog.getSaveFileName = staticmethod(lambda *a, **k: (package, "*.zip"))
+    modmanager.QFileDialog.getOpenFileName = staticmethod(lambda *a, **k: (package, "*.zip"))
+    modmanager.QMessageBox.question = staticmethod(lambda *a, **k: modmanager.QMessageBox.Yes)
+    modmanager.QMessageBox.information = staticmethod(lambda *a, **k: None)
+
+    def export():
+        w.on_export_mod_package("A")
+        settle(w)
+        return os.path.getsize(package)
+
+    def import_():
+        w.on_import_mod_package()
+        settle(w)
+        return os.path.getsize(package)
+
+    bench.measure("export", export, mod="A")
+    bench.measure("import", import_, mod="A")
+
+    # with vanilla active every mod gets compressed
+    w._restore_vanilla_silent()
+    settle(w)
+    w.core.set_hot_budget(0)
+
+    # the cold files written; what that saved depends on the data
+    def freeze():
+        frozen = set(w.core.rebalance_tiers()["frozen"])
+        return sum(os.path.getsize(p) for name, patch_wads, music_wad in w.core.mods() if name in frozen
+                   for p in patch_wads + [music_wad] if p and is_cold(p))
+
+    bench.measure("freeze", freeze)
+    bench.measure("activate_cold", activate, mod="A")
+
+    def stage():
+        w._restore_vanilla_silent()
+        settle(w)
+        return w.core.stage_likely()
+
+    bench.measure("stage", stage)
+    bench.measure("activate_staged", activate, mod="A")
+
+    w.close()
+    report = {
+        "commit": _commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": {k: v for k, v in vars(args).items() if k not in ("output", "keep")},
+        "results": bench.results,
+    }
+    if output == "-":
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.keep:
+        print(f"kept {root}", file=sys.stderr)
+    else:
+        shutil.rmtree(root, ignore_errors=True)
+    sys.stdout.flush()
+    # skip Qt's teardown, which has nothing left to do for us
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import hashlib
+import json
+import os
+import threading
+
+from copier import temp_path_for
+
+
+# Files built from other files (merged patchwads, composed music WADs), named
+# by a key over their inputs' content, each with a JSON sidecar describing
+# the build. The sidecar's mtime tracks use: the output may be hardlinked
+# into the game folder, where touching it would look like a change to the
+# game file. Only the most recently used outputs are kept; one still placed
+# in the game folder survives as its hardlink.
+class BuildCache:
+    def __init__(self, cache_dir, suffix, max_entries):
+        self.cache_dir = cache_dir
+        self.suffix = suffix
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(parts):
+        return hashlib.blake2b("\n".join(parts).encode(), digest_size=16).hexdigest()
+
+    # build(path) writes the output to path and returns its sidecar.
+    # Returns (output path, sidecar, reused).
+    def get(self, key, build):
+        out_path = os.path.join(self.cache_dir, key + self.suffix)
+        info_path = os.path.join(self.cache_dir, key + ".json")
+        with self.lock:
+            if os.path.exists(out_path) and os.path.exists(info_path):
+                with open(info_path, "r") as f:
+                    info = json.load(f)
+                os.utime(info_path)
+                return out_path, info, True
+            os.makedirs(self.cache_dir, exist_ok=True)
+            info = _write_atomic(out_path, build)
+
+            def write_info(path):
+                with open(path, "w") as f:
+                    json.dump(info, f, indent=4)
+
+            # written last: an output without its sidecar gets built again
+            _write_atomic(info_path, write_info)
+            self._prune()
+        return out_path, info, False
+
+    def _prune(self):
+        infos = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".json"):
+                path = os.path.join(self.cache_dir, name)
+                infos.append((os.stat(path).st_mtime, path))
+        infos.sort(reverse=True)
+        for _, path in infos[self.max_entries:]:
+            os.remove(path)
+            output = path[:-len(".json")] + self.suffix
+            if os.path.exists(output):
+                os.remove(output)
+
+
+# write(path) fills a temp file next to path, which then replaces path
+def _write_atomic(path, write):
+    tmp = temp_path_for(path)
+    try:
+        result = write(tmp)
+        os.replace(tmp, path)
+        return result
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
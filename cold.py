@@ -0,0 +1,146 @@
+import io
+import json
+import lzma
+import os
+import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from hashing import TreeHasher
+from tracing import count
+
+MAGIC = b"HMMZ\x01\x00"
+COLD_CHUNK = 4 << 20
+COLD_PRESET = 6
+SAMPLE_SIZE = 64 << 10
+STORE_RATIO = 0.9
+COLD_WORKERS = min(4, os.cpu_count() or 1)
+
+
+# -------------------- CREATE --------------------
+# Chunks are compressed on their own so any offset can be read back by
+# decompressing one chunk. A sample of each chunk is tried first: Ogg and PNG
+# payloads barely shrink, those chunks are stored as they are.
+def pack_chunk(data):
+    sample = data[:SAMPLE_SIZE]
+    if len(lzma.compress(sample, preset=0)) > len(sample) * STORE_RATIO:
+        return 0, data
+    packed = lzma.compress(data, preset=COLD_PRESET)
+    if len(packed) > len(data) * STORE_RATIO:
+        return 0, data
+    return 1, packed
+
+
+# Writes src as a cold file: the magic, the chunks, then a JSON footer and
+# its length. The footer carries src's fingerprint, so a cold file never has
+# to be decompressed to be compared. Returns the footer.
+def freeze(src, out_path, progress=None):
+    hasher = TreeHasher()
+    chunks = []
+    with open(src, "rb") as fsrc, open(out_path, "wb") as out, ThreadPoolExecutor(COLD_WORKERS) as pool:
+        out.write(MAGIC)
+        pos = len(MAGIC)
+        in_flight = deque()
+
+        def flush_one():
+            nonlocal pos
+            compressed, data = in_flight.popleft().result()
+            out.write(data)
+            chunks.append((pos, len(data), compressed))
+            pos += len(data)
+            count(len(data))
+
+        while True:
+            data = fsrc.read(COLD_CHUNK)
+            if not data:
+                break
+            hasher.update(data)
+            in_flight.append(pool.submit(pack_chunk, data))
+            if len(in_flight) > COLD_WORKERS * 2:
+                flush_one()
+            if progress:
+                progress(len(data))
+        while in_flight:
+            flush_one()
+        footer = {
+            "size": hasher.size,
+            "digest": hasher.hexdigest(),
+            "blocks": hasher.block_digests(),
+            "chunk_size": COLD_CHUNK,
+            "chunks": chunks,
+        }
+        encoded = json.dumps(footer).encode("utf-8")
+        out.write(encoded + struct.pack("<I", len(encoded)))
+    return footer
+
+
+# -------------------- READ --------------------
+def is_cold(path):
+    try:
+        with open(path, "rb") as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+def read_header(path):
+    with open(path, "rb") as f:
+        f.seek(-4, io.SEEK_END)
+        (length,) = struct.unpack("<I", f.read(4))
+        f.seek(-4 - length, io.SEEK_END)
+        return json.loads(f.read(length))
+
+
+# Seekable view of the original file. One decompressed chunk is kept, so
+# reading straight through decompresses every chunk exactly once.
+class ColdFile(io.RawIOBase):
+    def __init__(self, path):
+        self.header = read_header(path)
+        self.file = open(path, "rb")
+        self.chunk_size = self.header["chunk_size"]
+        self.size = self.header["size"]
+        self.pos = 0
+        self.current = -1
+        self.data = b""
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.pos = max(0, offset)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def _load(self, i):
+        offset, length, compressed = self.header["chunks"][i]
+        self.file.seek(offset)
+        data = self.file.read(length)
+        self.data = lzma.decompress(data) if compressed else data
+        self.current = i
+
+    def readinto(self, buffer):
+        if self.pos >= self.size:
+            return 0
+        i = self.pos // self.chunk_size
+        if i != self.current:
+            self._load(i)
+        skip = self.pos - i * self.chunk_size
+        n = min(len(buffer), len(self.data) - skip)
+        memoryview(buffer)[:n] = memoryview(self.data)[skip:skip + n]
+        self.pos += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.file.close()
+            self.data = b""
+        super().close()
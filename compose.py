@@ -0,0 +1,71 @@
+import os
+from contextlib import ExitStack
+
+from buildcache import BuildCache
+from delta import content_entry
+from tracing import traced
+from wad import WadReader, write_wad
+
+COMPOSE_DIR = os.path.join("cache", "composed")
+# music WADs are big, only the last few mixes are kept
+MAX_COMPOSED = 4
+TRACK_SUFFIXES = (".ogg", ".wav", ".mp3")
+
+
+def is_track(name):
+    return name.lower().endswith(TRACK_SUFFIXES)
+
+
+def list_tracks(path, cache=None):
+    with WadReader(path, cache) as reader:
+        return [entry.name for entry in reader.entries if is_track(entry.name)]
+
+
+# Builds a music WAD from base with some tracks taken from other WADs
+# (choices: {track: source path}). Everything keeps base's order, tracks
+# base doesn't have are appended. Payloads go from the memory-mapped sources
+# straight to the output; only WADs stored as deltas are read a track at a time.
+def compose_music(base, choices, out_path, progress=None, cache=None):
+    with ExitStack() as stack:
+        readers = {}
+
+        def reader(path):
+            if path not in readers:
+                readers[path] = stack.enter_context(WadReader(path, cache))
+            return readers[path]
+
+        base_reader = reader(base)
+        names = [entry.name for entry in base_reader.entries]
+        names += sorted(track for track in choices if track not in base_reader.by_name)
+        items = [(name, reader(choices.get(name, base)).payload(name)) for name in names]
+        try:
+            with open(out_path, "wb") as out:
+                written = write_wad(out, items, base_reader.prefix, progress)
+        finally:
+            for _, payload in items:
+                payload.release()
+    return written
+
+
+# Composed music WADs, keyed by their recipe: the base and every chosen
+# track's source, by content. Reactivating a mix links the file built last
+# time.
+class CompositionCache(BuildCache):
+    def __init__(self, fingerprints, cache_dir=COMPOSE_DIR, wad_index=None):
+        super().__init__(cache_dir, ".wad", MAX_COMPOSED)
+        self.fingerprints = fingerprints
+        self.wad_index = wad_index
+
+    # returns (path, reused)
+    @traced("compose.composed")
+    def composed(self, base, choices, progress=None):
+        recipe = [content_entry(base, self.fingerprints)["digest"]]
+        recipe += [f"{track}={content_entry(path, self.fingerprints)['digest']}"
+                   for track, path in sorted(choices.items())]
+
+        def build(out_path):
+            compose_music(base, choices, out_path, progress, self.wad_index)
+            return {"base": base, "tracks": choices}
+
+        out_path, _, reused = self.get(self.key(recipe), build)
+        return out_path, reused
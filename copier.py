@@ -0,0 +1,165 @@
+import errno
+import os
+import shutil
+import uuid
+
+from tracing import count
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+BUFFER_SIZE = 1 << 20
+# bytes handed to the kernel per call: big enough to run at disk speed, small
+# enough that progress and cancellation stay responsive
+KERNEL_CHUNK = 16 << 20
+
+# the kernel can't copy between these two files this way, try the next way
+UNSUPPORTED = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF}
+
+
+# Raised from progress callbacks to abort a transfer.
+class Cancelled(Exception):
+    pass
+
+
+def temp_path_for(dst):
+    folder, name = os.path.split(dst)
+    return os.path.join(folder, f".{name}.{uuid.uuid4().hex[:8]}.hmmm-tmp")
+
+
+def copy_stream(fsrc, fdst, progress=None):
+    copied = 0
+    while True:
+        data = fsrc.read(BUFFER_SIZE)
+        if not data:
+            count(copied)
+            return copied
+        fdst.write(data)
+        copied += len(data)
+        if progress:
+            progress(len(data))
+
+
+# -------------------- REFLINK --------------------
+FICLONE = 0x40049409  # _IOW(0x94, 9, int), btrfs/XFS/bcachefs
+
+
+def reflink(src, dst):
+    if fcntl is None:
+        raise OSError("reflinks are not supported on this platform")
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    shutil.copystat(src, dst)
+
+
+# -------------------- KERNEL COPY --------------------
+# Each copies fd_in to fd_out from offset up to size, yielding the bytes moved
+# per call; the data never passes through Python. copy_fd counts what was
+# yielded, so a way that fails partway leaves the next one at the right offset
+# without having reported more than was copied.
+def _copy_file_range(fd_in, fd_out, offset, size):
+    while offset < size:
+        n = os.copy_file_range(fd_in, fd_out, min(KERNEL_CHUNK, size - offset), offset, offset)
+        if n == 0:
+            return
+        offset += n
+        yield n
+
+
+def _sendfile(fd_in, fd_out, offset, size):
+    os.lseek(fd_out, offset, os.SEEK_SET)
+    while offset < size:
+        n = os.sendfile(fd_out, fd_in, offset, min(KERNEL_CHUNK, size - offset))
+        if n == 0:
+            return
+        offset += n
+        yield n
+
+
+# copy_file_range shares extents where the filesystem can and stays in the
+# kernel otherwise; across filesystems older kernels refuse it, sendfile
+# still avoids the round trip through user space there
+KERNEL_COPIES = [copy for name, copy in (("copy_file_range", _copy_file_range), ("sendfile", _sendfile))
+                 if hasattr(os, name)]
+
+
+def copy_fd(fsrc, fdst, size, progress=None):
+    copied = 0
+    for copy in KERNEL_COPIES:
+        try:
+            for n in copy(fsrc.fileno(), fdst.fileno(), copied, size):
+                copied += n
+                if progress:
+                    progress(n)
+        except OSError as e:
+            if e.errno not in UNSUPPORTED:
+                raise
+            continue
+        if copied >= size:
+            count(copied)
+            return copied
+    count(copied)
+    fsrc.seek(copied)
+    fdst.seek(copied)
+    return copied + copy_stream(fsrc, fdst, progress)
+
+
+def copy_file(src, dst, progress=None, fsync=False):
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        copy_fd(fsrc, fdst, os.fstat(fsrc.fileno()).st_size, progress)
+        shutil.copystat(src, dst)
+        if fsync:
+            os.fsync(fdst.fileno())
+
+
+# -------------------- DURABILITY --------------------
+def fsync_path(path):
+    with open(path, "rb") as f:
+        os.fsync(f.fileno())
+
+
+# makes a rename in the folder survive a crash; Windows has no such thing
+def fsync_dir(folder):
+    if os.name == "nt":
+        return
+    fd = os.open(folder or ".", os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# Copies into a temp file next to dst and swaps it in with os.replace, so
+# whoever reads dst sees either the old file or the whole new one.
+def atomic_copy(src, dst, progress=None, fsync=False):
+    tmp = temp_path_for(dst)
+    try:
+        copy_file(src, tmp, progress, fsync)
+        os.replace(tmp, dst)
+        if fsync:
+            fsync_dir(os.path.dirname(dst))
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+# Like atomic_copy, but a reflink where the filesystem has them. Either way
+# dst never shares an inode with src, so whatever later rewrites src in
+# place leaves dst alone.
+def atomic_clone(src, dst, fsync=False):
+    tmp = temp_path_for(dst)
+    try:
+        try:
+            reflink(src, tmp)
+            if fsync:
+                fsync_path(tmp)
+        except OSError:
+            copy_file(src, tmp, None, fsync)
+        os.replace(tmp, dst)
+        if fsync:
+            fsync_dir(os.path.dirname(dst))
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
@@ -0,0 +1,864 @@
+import os
+import shutil
+from contextlib import contextmanager
+from functools import wraps
+
+from activation import apply_switch, plan_switch, switch_size
+from cold import freeze
+from compose import CompositionCache, list_tracks
+from copier import atomic_clone, temp_path_for
+from delta import (
+    DELTA_SUFFIX, content_entry, content_size, is_delta, make_delta, open_content, packed_header, read_header
+)
+from library import LIBRARY_FILE, Library, LibraryFingerprints
+from locking import ProcessLock
+from merge import MergeCache
+from staging import STAGING_BUDGET, StagingCache, staging_size
+from store import BlobStore, pin_path
+from tracing import traced
+from wad import IndexCache, WadError
+
+MODS_DIR = "mods"
+BACKUP_DIR = "backup"
+# superseded by the library database, only read once to migrate
+CONFIG_FILE = "mods.json"
+STATE_FILE = "state.json"
+FINGERPRINT_FILE = "fingerprints.json"
+# held while game files, backups or staged copies change, see ModCore.game_files_locked()
+LOCK_FILE = "hmmm.lock"
+# settings that say what is in the game folder, see save_state()
+SWITCH_STATE = ("active_mod", "placements", "expected")
+# seconds to wait for another process holding the lock, e.g. one staging a file
+LOCK_WAIT = 30
+# how many recently used mods stage_likely() keeps ready besides the pinned ones
+STAGE_RECENT = 3
+STAGE_HISTORY = 50
+
+
+def get_game_data_dir():
+    if os.name == "nt":
+        return os.path.join(os.environ["LOCALAPPDATA"], "HotlineMiami2")
+    return os.path.expanduser("~/.local/share/HotlineMiami2")
+
+
+GAME_DATA_DIR = get_game_data_dir()
+PATCHWAD_PATH = os.path.join(GAME_DATA_DIR, "patchwad.wad")
+PATCHWAD_MODS_DIR = os.path.join(GAME_DATA_DIR, "mods")
+
+
+# what check_game_files() makes of the game folder
+GAME_OK = "ok"
+GAME_MODIFIED = "modified"
+GAME_UNKNOWN = "unknown"
+
+
+class ModError(ValueError):
+    pass
+
+
+# Another HMMM (the GUI, or the CLI in a script) is changing the game files.
+class GameFilesBusy(ModError):
+    pass
+
+
+# Runs the method holding the game files lock.
+def locked(method):
+    @wraps(method)
+    def call(self, *args, **kwargs):
+        with self.game_files_locked():
+            return method(self, *args, **kwargs)
+    return call
+
+
+# Stand-in for a Job when nobody watches the progress.
+class Progress:
+    def set_total(self, total):
+        pass
+
+    def report(self, nbytes):
+        pass
+
+
+# Everything HMMM does to files, without any Qt. The GUI and the CLI both
+# drive this; methods taking a job report progress through job.set_total()
+# and job.report() and block until done.
+class ModCore:
+    def __init__(self):
+        os.makedirs(MODS_DIR, exist_ok=True)
+        os.makedirs(PATCHWAD_MODS_DIR, exist_ok=True)
+        self.store = BlobStore()
+        self.library = Library(LIBRARY_FILE, (CONFIG_FILE, STATE_FILE, FINGERPRINT_FILE))
+        self.fingerprints = LibraryFingerprints(self.library)
+        self.wad_index = IndexCache(fingerprints=self.fingerprints)
+        self.merges = MergeCache(self.fingerprints, wad_index=self.wad_index)
+        self.compositions = CompositionCache(self.fingerprints, wad_index=self.wad_index)
+
+        self.active_mod = None
+        self.game_music_path = None
+        self.last_folder = os.getcwd()
+        self.placements = {}
+        # game file -> digest it should have after the last switch (None: absent)
+        self.expected = {}
+        self.delta_music = False
+        # fsync game files and backups before reporting a switch as done
+        self.durable_writes = True
+        # bytes of mod files kept uncompressed (None: no limit), see rebalance_tiers()
+        self.hot_budget = None
+        # mods whose game files are kept staged no matter how long ago they ran
+        self.staged_pins = []
+        self.staging = StagingCache(self.fingerprints)
+        self.game_lock = ProcessLock(LOCK_FILE)
+        self.load_state()
+
+    # -------------------- STATE --------------------
+    # Saves only the given settings: another process may have changed the
+    # rest since they were loaded. The switch state (SWITCH_STATE) is only
+    # ever saved under game_files_locked().
+    @traced("core.save_state", "db")
+    def save_state(self, *keys):
+        state = {
+            "active_mod": self.active_mod,
+            "game_music_path": self.game_music_path,
+            "last_folder": self.last_folder,
+            "placements": self.placements,
+            "expected": self.expected,
+            "delta_music": self.delta_music,
+            "durable_writes": self.durable_writes,
+            "hot_budget": self.hot_budget,
+            "staging_budget": self.staging.budget,
+            "staged_pins": self.staged_pins
+        }
+        self.library.save_settings({key: state[key] for key in keys})
+
+    def load_state(self):
+        state = self.library.settings()
+        self.active_mod = state.get("active_mod")
+        self.game_music_path = state.get("game_music_path")
+        self.last_folder = state.get("last_folder", os.getcwd())
+        self.placements = state.get("placements", {})
+        self.expected = state.get("expected", {})
+        self.delta_music = state.get("delta_music", False)
+        self.durable_writes = state.get("durable_writes", True)
+        self.hot_budget = state.get("hot_budget")
+        self.staging.budget = state.get("staging_budget", STAGING_BUDGET)
+        self.staged_pins = state.get("staged_pins", [])
+
+    # The GUI and the CLI share the data folder. Whoever changes the game
+    # files holds this lock, and starts from the switch state on disk, which
+    # the other process may have moved on since this one last loaded it.
+    @contextmanager
+    def game_files_locked(self, wait=LOCK_WAIT):
+        if not self.game_lock.acquire(wait):
+            raise GameFilesBusy(
+                "Another HMMM is changing the game files right now.\n"
+                "Try again once it is done."
+            )
+        try:
+            if self.game_lock.depth == 1:
+                state = self.library.settings()
+                self.active_mod = state.get("active_mod")
+                self.placements = state.get("placements", {})
+                self.expected = state.get("expected", {})
+            yield
+        finally:
+            self.game_lock.release()
+
+    def set_last_folder(self, folder):
+        self.last_folder = folder
+        self.save_state("last_folder")
+
+    def set_game_music_path(self, file_path):
+        data_wad = os.path.join(os.path.dirname(file_path), "hlm2_data_desktop.wad")
+        if not os.path.exists(data_wad):
+            raise ModError(
+                "This doesn't seem like the correct game folder.\n"
+                "Make sure you aren't just selecting a modded music WAD."
+            )
+        self.game_music_path = file_path
+        self.save_state("game_music_path")
+
+    # -------------------- MODS --------------------
+    def mods(self):
+        return self.library.mods()
+
+    def mod(self, mod_name):
+        mod = self.library.mod(mod_name)
+        if mod is None:
+            raise ModError(f"No mod named '{mod_name}'.")
+        return mod
+
+    def mod_folder(self, mod_name):
+        return os.path.join(MODS_DIR, mod_name)
+
+    @staticmethod
+    def split_files(files):
+        patch_wads = [f for f in files if f.lower().endswith(".patchwad")]
+        music_wads = [f for f in files if f.lower().endswith(".wad")]
+        if len(music_wads) > 1:
+            raise ModError("Only one music .wad allowed.")
+        return patch_wads, music_wads[0] if music_wads else ""
+
+    # returns (patch_wads, music_wad) as stored in the mod folder
+    # a folder without a library entry is still taken: installing into it
+    # would mix in whatever files it has left
+    def check_new_name(self, mod_name):
+        if not mod_name:
+            raise ModError("Mod name cannot be empty.")
+        if self.library.mod(mod_name) is not None or os.path.exists(self.mod_folder(mod_name)):
+            raise ModError("A mod with that name already exists.")
+
+    @traced("core.install_mod")
+    def install_mod(self, mod_name, files, as_delta=None, job=None):
+        job = job or Progress()
+        self.check_new_name(mod_name)
+        patch_wads, music_wad = self.split_files(files)
+        if as_delta is None:
+            as_delta = self.delta_music
+        elif as_delta != self.delta_music:
+            self.delta_music = as_delta
+            self.save_state("delta_music")
+
+        mod_folder = self.mod_folder(mod_name)
+        os.makedirs(mod_folder)
+        try:
+            job.set_total(2 * sum(os.path.getsize(f) for f in patch_wads + [music_wad] if f))
+            copied_patch_files = [self.copy_wad(p, mod_folder, job.report) for p in patch_wads]
+            copied_music_file = ""
+            if music_wad and as_delta:
+                copied_music_file = self.store_music_delta(music_wad, mod_folder, job.report)
+            if music_wad and not copied_music_file:
+                copied_music_file = self.copy_wad(music_wad, mod_folder, job.report)
+        except BaseException:
+            shutil.rmtree(mod_folder, ignore_errors=True)
+            self.store.gc()
+            raise
+        self.library.save_mod(mod_name, copied_patch_files, copied_music_file)
+        return copied_patch_files, copied_music_file
+
+    # files are the mod's current files, in override order
+    @locked
+    def update_mod(self, mod_name, new_name, files):
+        if not new_name:
+            raise ModError("Mod name cannot be empty.")
+        current_folder = self.mod_folder(mod_name)
+        new_folder = self.mod_folder(new_name)
+        if new_name != mod_name:
+            if os.path.exists(new_folder):
+                raise ModError("A mod with that name already exists.")
+            os.rename(current_folder, new_folder)
+            files = [f.replace(current_folder, new_folder, 1) for f in files]
+        patch_wads, music_wad = self.split_files(files)
+        self.library.save_mod(new_name, patch_wads, music_wad, mod_name)
+        if self.active_mod == mod_name or mod_name in self.staged_pins:
+            if self.active_mod == mod_name:
+                self.active_mod = new_name
+            self.staged_pins = [new_name if p == mod_name else p for p in self.staged_pins]
+            self.save_state("active_mod", "staged_pins")
+        return patch_wads, music_wad
+
+    def remove_files(self, files):
+        for f in files:
+            os.remove(f)
+        self.unpin_unused()
+        self.store.gc()
+
+    # restores vanilla first when the mod is active
+    @locked
+    def delete_mod(self, mod_name, job=None):
+        if mod_name == self.active_mod:
+            self.restore(job)
+        shutil.rmtree(self.mod_folder(mod_name), ignore_errors=True)
+        self.library.delete_mod(mod_name)
+        self.unpin_unused()
+        self.store.gc()
+        if mod_name in self.staged_pins:
+            self.staged_pins.remove(mod_name)
+            self.save_state("staged_pins")
+
+    # -------------------- PACKAGES --------------------
+    # package.py pulls in zipfile and the thread pool, which a plain
+    # activation never needs, so it is only imported here
+    def import_conflicts(self, zip_path):
+        from package import PackageError, package_format, package_mods
+
+        existing = [name for name in package_mods(zip_path) if os.path.exists(self.mod_folder(name))]
+        if existing and package_format(zip_path) < 2:
+            raise PackageError("Mod already exists.")
+        return existing
+
+    # returns [(name, patch_wads, music_wad)]
+    @traced("core.import_package")
+    def import_package(self, zip_path, job=None):
+        from package import import_package, import_size
+
+        job = job or Progress()
+        try:
+            job.set_total(import_size(zip_path))
+            mods = import_package(zip_path, MODS_DIR, self.store, job.report)
+        except BaseException:
+            self.store.gc()
+            raise
+        self.library.save_mods(mods)
+        return mods
+
+    # Turns every folder under root that holds WADs into a mod, e.g. a Steam
+    # Workshop download folder. Running it again only touches folders whose
+    # files changed. Returns {"mods": [(name, patch_wads, music_wad)] added or
+    # updated, "unchanged": [names], "skipped": {folder: reason}}.
+    @traced("core.ingest_folder")
+    def ingest_folder(self, root, job=None):
+        from ingest import ingest_mods, ingest_size, plan_ingest, scan_folder
+
+        job = job or Progress()
+        if not os.path.isdir(root):
+            raise ModError(f"No such folder: {root}")
+        known = self.library.ingested()
+        plan, skipped = plan_ingest(scan_folder(os.path.abspath(root)), known,
+                                    {name for name, _, _ in self.mods()})
+        todo = [p for p in plan if p[3] != "unchanged"]
+        try:
+            job.set_total(ingest_size(todo, known, self.store))
+            mods, sources = ingest_mods(todo, MODS_DIR, self.store, known, job.report)
+        except BaseException:
+            self.store.gc()
+            raise
+        self.library.save_ingest(mods, sources)
+        if any(p[3] == "changed" for p in todo):
+            # blobs only the replaced files still used
+            self.store.gc()
+        return {
+            "mods": mods,
+            "unchanged": [name for _, name, _, status in plan if status == "unchanged"],
+            "skipped": skipped,
+        }
+
+    @traced("core.export_mod")
+    def export_mod(self, mod_name, save_path, base_path=None, job=None):
+        from package import build_manifest, export_package, package_digests
+
+        job = job or Progress()
+        try:
+            exclude = package_digests(base_path) if base_path else ()
+            manifest, members = build_manifest(
+                [(mod_name, self.mod_folder(mod_name))],
+                lambda p: content_entry(p, self.fingerprints)["digest"], exclude
+            )
+            self.fingerprints.save()
+            job.set_total(sum(content_size(fp) for fp, _ in members))
+            return export_package(members, save_path, job.report, manifest)
+        except BaseException:
+            if os.path.exists(save_path):
+                os.remove(save_path)
+            raise
+
+    # -------------------- ACTIVATE --------------------
+    # returns (bytes written, note on how the files were combined)
+    @traced("core.activate")
+    @locked
+    def activate(self, mod_name, job=None):
+        job = job or Progress()
+        mod_files, note = self.mod_files(mod_name, job)
+        written = self.switch_game_files(mod_files, job, mod_name)
+        return written, note
+
+    # {game file: what the mod puts there}, merging and composing as needed;
+    # returns (mod_files, note)
+    def mod_files(self, mod_name, job):
+        _, patch_wads, music_wad = self.mod(mod_name)
+        patches = [p for p in patch_wads if p and os.path.exists(p)]
+        mod_files = {PATCHWAD_PATH: patches[-1] if patches else None}
+        if music_wad and os.path.exists(music_wad):
+            mod_files[self.game_music_path] = music_wad
+
+        note = ""
+        self.backup_vanilla()
+        choices = self.library.tracks(mod_name)
+        if choices and self.game_music_path:
+            try:
+                music, missing = self.compose_music(music_wad, choices, job)
+                if music:
+                    mod_files[self.game_music_path] = music
+                if missing:
+                    note += f", {len(missing)} chosen tracks unavailable"
+            except WadError:
+                note += ", music tracks could not be composed"
+        if len(patches) > 1:
+            # the game loads a single patchwad: merge them, later files winning
+            try:
+                mod_files[PATCHWAD_PATH], conflicts, _ = self.merges.merged(patches, job.report)
+                if conflicts:
+                    note += f", {len(conflicts)} patchwad entries overridden"
+            except WadError:
+                note += ", patchwads could not be merged so only the last one is used"
+        return mod_files, note
+
+    # -------------------- MUSIC TRACKS --------------------
+    # music WAD a track choice refers to: "" is vanilla, anything else a mod
+    def music_source(self, source):
+        if not source:
+            return os.path.join(BACKUP_DIR, "hlm2_music_desktop.wad")
+        return self.mod(source)[2]
+
+    # returns (tracks of the mod's own music, {track: [sources that have it]})
+    @traced("core.track_options")
+    def track_options(self, mod_name):
+        self.backup_vanilla()
+        sources = [""] + [name for name, _, music_wad in self.mods() if name != mod_name and music_wad]
+        base, options = [], {}
+        own = self.mod(mod_name)[2] or self.music_source("")
+        for source in [None] + sources:
+            path = own if source is None else self.music_source(source)
+            if not path or not os.path.exists(path):
+                continue
+            try:
+                tracks = list_tracks(path, self.wad_index)
+            except WadError:
+                continue
+            if source is None:
+                base = tracks
+            else:
+                for track in tracks:
+                    options.setdefault(track, []).append(source)
+        return base, options
+
+    def music_tracks(self, mod_name):
+        return self.library.tracks(mod_name)
+
+    def set_music_tracks(self, mod_name, choices):
+        self.mod(mod_name)
+        for source in set(choices.values()):
+            if source == mod_name:
+                raise ModError("A mod can't take tracks from itself.")
+            if source:
+                self.mod(source)
+        self.library.save_tracks(mod_name, choices)
+
+    # Builds the music WAD for a mod with track choices: its own music (or
+    # vanilla's) with the chosen tracks swapped in. Returns (path, [tracks
+    # whose source is gone]); path is None when there is nothing to build on.
+    def compose_music(self, music_wad, choices, job):
+        base = music_wad if music_wad and os.path.exists(music_wad) else self.music_source("")
+        if not os.path.exists(base):
+            return None, list(choices)
+        resolved, missing, listed = {}, [], {}
+        for track, source in sorted(choices.items()):
+            try:
+                path = self.music_source(source)
+                if path not in listed:
+                    listed[path] = set(list_tracks(path, self.wad_index)) if os.path.exists(path) else set()
+            except (ModError, WadError):
+                path = None
+            # the source may be gone or no longer have the track
+            if path and track in listed[path]:
+                resolved[track] = path
+            else:
+                missing.append(track)
+        return self.compositions.composed(base, resolved, job.report)[0], missing
+
+    @traced("core.restore")
+    @locked
+    def restore(self, job=None):
+        return self.switch_game_files({}, job or Progress(), None)
+
+    # Switches the game files to mod_files and makes mod_name (None: vanilla)
+    # the active mod. The plan is journaled before anything is touched, see
+    # resume_switch() for finishing one that was interrupted.
+    @traced("core.switch_game_files")
+    @locked
+    def switch_game_files(self, mod_files, job, mod_name):
+        # a staged copy is linked into place instead of copying the source
+        targets = [(game_file, self.staging.lookup(game_file, src) or src, modded)
+                   for game_file, src, modded in self.switch_targets(mod_files)]
+        ops = plan_switch([(game_file, src) for game_file, src, _ in targets], self.fingerprints, self.placements)
+        job.set_total(switch_size(ops))
+        self.library.begin_switch({"mod": mod_name, "targets": targets}, ops)
+        written, strategies = apply_switch(ops, self.fingerprints, job.report, self.durable_writes,
+                                           self.library.mark_done, self.backups())
+        self._finish_switch(mod_name, targets, strategies, written)
+        return written
+
+    # every game file ends up either as the mod's file or as its vanilla backup
+    def switch_targets(self, mod_files):
+        targets = []
+        for game_file, backup in self.vanilla_files():
+            if mod_files.get(game_file):
+                targets.append((game_file, mod_files[game_file], True))
+            elif os.path.exists(backup):
+                targets.append((game_file, backup, False))
+            elif game_file == PATCHWAD_PATH and game_file in self.placements:
+                # vanilla had no patchwad, so undo the placement by removing it
+                targets.append((game_file, None, False))
+        return targets
+
+    def pending_switch(self):
+        return self.library.pending_switch()
+
+    # Finishes a switch that HMMM was killed in the middle of. Operations the
+    # journal has as done are kept and only the rest are run again, so at
+    # most one file is copied twice. When a source has disappeared since
+    # (a deleted mod, a pruned merge), the switch can't be completed and the
+    # game is rolled back to vanilla instead. Returns (mod, bytes written)
+    # where mod is whatever ended up active.
+    @traced("core.resume_switch")
+    @locked
+    def resume_switch(self, job=None):
+        job = job or Progress()
+        pending = self.library.pending_switch()
+        if pending is None:
+            return self.active_mod, 0
+        switch, journal = pending
+        mod_name, targets = switch["mod"], [tuple(t) for t in switch["targets"]]
+        # half-written temp files of the interrupted copy
+        for folder in {os.path.dirname(dst) or "." for _, dst, _, _, _ in journal}:
+            if os.path.isdir(folder):
+                for entry in os.scandir(folder):
+                    if entry.name.startswith(".") and entry.name.endswith(".hmmm-tmp"):
+                        os.remove(entry.path)
+        remaining = [(i, op[:4]) for i, op in enumerate(journal) if op[4] is None]
+        strategies = {dst: done for kind, dst, _, _, done in journal if done and kind != "remove"}
+        if any(src and not os.path.exists(src) for _, (_, _, src, _) in remaining):
+            # what did get placed must not be mistaken for vanilla
+            self.placements.update(strategies)
+            self.library.end_switch()
+            return None, self.restore(job)
+        job.set_total(switch_size([op for _, op in remaining]))
+        written, redone = apply_switch(
+            [op for _, op in remaining], self.fingerprints, job.report, self.durable_writes,
+            lambda i, done: self.library.mark_done(remaining[i][0], done), self.backups()
+        )
+        strategies.update(redone)
+        self._finish_switch(mod_name, targets, strategies, written)
+        return mod_name, written
+
+    def _finish_switch(self, mod_name, targets, strategies, written):
+        for game_file, src, modded in targets:
+            if not modded:
+                self.placements.pop(game_file, None)
+            elif game_file in strategies:
+                self.placements[game_file] = strategies[game_file]
+            self.expected[game_file] = self._expect(game_file, src)
+        targeted = {game_file for game_file, _, _ in targets}
+        for game_file, _ in self.vanilla_files():
+            if game_file not in targeted:
+                # untouched, so whatever is there now is what belongs there
+                self.expected[game_file] = self._expect(game_file, game_file if os.path.exists(game_file) else None)
+        self.fingerprints.save()
+        self.active_mod = mod_name
+        self.save_state(*SWITCH_STATE)
+        self.library.record_activation(mod_name, written)
+        # everything above is safe to redo, so the journal goes last
+        self.library.end_switch()
+
+    # Digest the game file has right after a switch. It is recorded as the
+    # game file's fingerprint too, so later checks only need a stat.
+    def _expect(self, game_file, src):
+        if src is None:
+            return None
+        entry = self.fingerprints.cached(game_file)
+        if not entry:
+            entry = self.fingerprints.record(game_file, content_entry(src, self.fingerprints))
+        return entry["digest"]
+
+    # -------------------- DRIFT CHECK --------------------
+    # Compares the game files with what the last switch left there. Steam
+    # verifying or updating the game replaces them behind our back: with a
+    # mod active that is reported as modified, in vanilla it means the backup
+    # is outdated and gets refreshed. cached_only never reads file contents,
+    # files whose fingerprint is stale then count as unknown.
+    @traced("core.check_game_files")
+    def check_game_files(self, job=None, cached_only=False):
+        if cached_only:
+            return self._check_game_files(job, True)
+        with self.game_files_locked():
+            return self._check_game_files(job, False)
+
+    def _check_game_files(self, job, cached_only):
+        job = job or Progress()
+        if not cached_only:
+            job.set_total(sum(os.path.getsize(f) for f, _ in self.vanilla_files()
+                              if os.path.exists(f) and not self.fingerprints.cached(f)))
+        state, changed = GAME_OK, False
+        for game_file, backup in self.vanilla_files():
+            have = None
+            if os.path.exists(game_file):
+                if cached_only:
+                    have = self.fingerprints.cached(game_file)
+                    if not have:
+                        state = GAME_UNKNOWN
+                        continue
+                else:
+                    have = self.fingerprints.lookup(game_file, job.report)
+            have = have and have["digest"]
+            if self.active_mod is None:
+                if not cached_only and have and game_file not in self.placements:
+                    changed |= self._refresh_backup(game_file, backup, have)
+                continue
+            if game_file not in self.expected:
+                # activated by an older version, nothing to compare with
+                if state == GAME_OK:
+                    state = GAME_UNKNOWN
+            elif have != self.expected[game_file]:
+                state = GAME_MODIFIED
+                if not cached_only and have:
+                    # whatever replaced our file is the game's new vanilla
+                    self.placements.pop(game_file, None)
+                    changed |= self._refresh_backup(game_file, backup, have)
+        if changed:
+            self.save_state(*SWITCH_STATE)
+        self.fingerprints.save()
+        return state
+
+    def _refresh_backup(self, game_file, backup, digest):
+        if os.path.exists(backup) and self.fingerprints.lookup(backup)["digest"] == digest:
+            return False
+        os.makedirs(BACKUP_DIR, exist_ok=True)
+        atomic_clone(game_file, backup, self.durable_writes)
+        entry = self.fingerprints.cached(game_file)
+        if entry:
+            self.fingerprints.record(backup, entry)
+        else:
+            # the game file changed since it was hashed (Steam updating it?),
+            # so the copy has to be hashed itself
+            entry = self.fingerprints.lookup(backup)
+        if self.active_mod is None:
+            self.expected[game_file] = entry["digest"]
+        return True
+
+    # -------------------- BACKUP --------------------
+    # The backups are never hardlinked into the game folder either: Steam
+    # may rewrite a game file in place, which must not reach the backup.
+    def backups(self):
+        return {backup for _, backup in self.vanilla_files()}
+
+    def vanilla_files(self):
+        files = [(PATCHWAD_PATH, os.path.join(BACKUP_DIR, "patchwad.wad"))]
+        if self.game_music_path:
+            files.insert(0, (self.game_music_path, os.path.join(BACKUP_DIR, "hlm2_music_desktop.wad")))
+        return files
+
+    @traced("core.backup_vanilla")
+    # backups are copies (or reflinks) of the game files, see backups()
+    def backup_vanilla(self):
+        os.makedirs(BACKUP_DIR, exist_ok=True)
+        for game_file, backup in self.vanilla_files():
+            if os.path.exists(backup) and os.path.exists(game_file) and os.path.samefile(backup, game_file):
+                # linked by an older version
+                atomic_clone(game_file, backup, self.durable_writes)
+            # files we placed ourselves are mod files, never back them up
+            if game_file in self.placements:
+                continue
+            if os.path.exists(game_file) and not os.path.exists(backup):
+                atomic_clone(game_file, backup, self.durable_writes)
+
+    # -------------------- TIERS --------------------
+    # Mod files are hot (plain files, linked into place on activation) or
+    # cold (chunked lzma, streamed into place). Deltas are small already and
+    # stay as they are.
+    def mod_tiers(self):
+        tiers = {}
+        for name, patch_wads, music_wad in self.mods():
+            hot = cold = 0
+            for path in patch_wads + [music_wad]:
+                if not path or not os.path.exists(path) or is_delta(path):
+                    continue
+                if packed_header(path):
+                    cold += os.path.getsize(path)
+                else:
+                    hot += os.path.getsize(path)
+            tiers[name] = (hot, cold)
+        return tiers
+
+    def set_hot_budget(self, nbytes):
+        if nbytes is not None and nbytes < 0:
+            raise ModError("The budget can't be negative.")
+        self.hot_budget = nbytes
+        self.save_state("hot_budget")
+
+    # Keeps the most recently activated mods hot, as many as fit in
+    # hot_budget, and compresses the rest. The active mod always stays hot.
+    # Returns {"frozen": [names], "thawed": [names], "freed": bytes}.
+    @traced("core.rebalance_tiers")
+    @locked
+    def rebalance_tiers(self, job=None):
+        job = job or Progress()
+        budget = float("inf") if self.hot_budget is None else self.hot_budget
+        last_used = self.library.last_used()
+        mods = sorted(self.mods(), key=lambda mod: (mod[0] == self.active_mod, last_used.get(mod[0], 0)),
+                      reverse=True)
+        plan, hot = [], 0
+        for name, patch_wads, music_wad in mods:
+            files = [p for p in patch_wads + [music_wad] if p and os.path.exists(p) and not is_delta(p)]
+            hot += sum(content_size(p) for p in files)
+            keep = name == self.active_mod or hot <= budget
+            todo = [p for p in files if bool(packed_header(p)) == keep]
+            if todo:
+                plan.append((name, keep, todo))
+
+        job.set_total(sum(content_size(p) for _, _, todo in plan for p in todo))
+        result = {"frozen": [], "thawed": [], "freed": 0}
+        for name, keep, todo in plan:
+            if keep:
+                for path in todo:
+                    self._thaw(path, job.report)
+                result["thawed"].append(name)
+                continue
+            freed = [self._freeze(path, job.report) for path in todo]
+            if any(f is not None for f in freed):
+                result["frozen"].append(name)
+                result["freed"] += sum(f for f in freed if f)
+        if plan:
+            self.store.gc()
+        return result
+
+    # Returns the bytes saved, or None when the file is shared with other mods
+    # or the game folder: compressing one link of it would only add a copy.
+    def _freeze(self, path, progress):
+        st = os.stat(path)
+        if st.st_nlink > 2:
+            return None
+        tmp = temp_path_for(path)
+        try:
+            freeze(path, tmp, progress)
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        return st.st_size - os.path.getsize(path)
+
+    # back into the blob store, so identical files share it again
+    def _thaw(self, path, progress):
+        tmp = temp_path_for(path)
+        try:
+            with open_content(path) as f:
+                self.store.install_stream(f, tmp, progress)
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    # -------------------- STAGING --------------------
+    def set_staging_budget(self, nbytes):
+        if nbytes < 0:
+            raise ModError("The budget can't be negative.")
+        self.staging.budget = nbytes
+        self.save_state("staging_budget")
+        if not nbytes:
+            self.staging.clear([game_file for game_file, _ in self.vanilla_files()])
+            self.fingerprints.save()
+
+    def set_staged_pin(self, mod_name, pinned):
+        self.mod(mod_name)
+        if pinned and mod_name not in self.staged_pins:
+            self.staged_pins.append(mod_name)
+        elif not pinned and mod_name in self.staged_pins:
+            self.staged_pins.remove(mod_name)
+        self.save_state("staged_pins")
+
+    # pinned mods, then the last few mods (None: vanilla) switched to
+    def likely_next(self):
+        names = {name for name, _, _ in self.mods()}
+        likely = [name for name in self.staged_pins if name in names]
+        recent = 0
+        for mod_name, _, _ in self.library.history(STAGE_HISTORY):
+            if recent == STAGE_RECENT:
+                break
+            if mod_name not in likely and (mod_name is None or mod_name in names):
+                likely.append(mod_name)
+                recent += 1
+        return likely
+
+    # Copies the game files of the likely next switches next to the game
+    # files, as far as the budget goes, and drops the copies least recently
+    # used beyond it. Returns the bytes written. It runs while idle, so it
+    # takes the lock per mod and per file and never waits for it: a switch
+    # in another process only waits for the file being staged, and staging
+    # stops for this pass when another process holds the lock.
+    @traced("core.stage_likely")
+    def stage_likely(self, job=None):
+        job = job or Progress()
+        if not self.staging.budget or not self.game_music_path:
+            return 0
+        written, keep = 0, set()
+        try:
+            work = self._staging_work()
+            job.set_total(staging_size(work))
+            for game_file, src in work:
+                with self.game_files_locked(wait=0):
+                    # the other process may have deleted the mod since
+                    if os.path.exists(src):
+                        written += self.staging.stage(game_file, src, job.report)
+                        keep.add(self.staging.lookup(game_file, src))
+            with self.game_files_locked(wait=0):
+                self.staging.prune([game_file for game_file, _ in self.vanilla_files()], keep)
+        except GameFilesBusy:
+            pass
+        finally:
+            self.fingerprints.save()
+        return written
+
+    # [(game file, source)] to stage, as far as the budget goes
+    def _staging_work(self):
+        work, planned = [], 0
+        for mod_name in self.likely_next():
+            with self.game_files_locked(wait=0):
+                mod_files = self.mod_files(mod_name, Progress())[0] if mod_name else {}
+                targets = self.switch_targets(mod_files)
+            for game_file, src, _ in targets:
+                if (game_file, src) in work or not self.staging.wanted(game_file, src):
+                    continue
+                planned += content_size(src)
+                if planned > self.staging.budget:
+                    break
+                work.append((game_file, src))
+            if planned > self.staging.budget:
+                break
+        return work
+
+    # -------------------- FILES --------------------
+    def unique_path(self, dest_dir, file_name):
+        base, ext = os.path.splitext(file_name)
+        dest_path = os.path.join(dest_dir, file_name)
+        counter = 1
+        while os.path.exists(dest_path):
+            dest_path = os.path.join(dest_dir, f"{base}_{counter}{ext}")
+            counter += 1
+        return dest_path
+
+    @traced("core.copy_wad")
+    def copy_wad(self, src_path, dest_dir, progress=None):
+        if not src_path:
+            return ""
+        dest_path = self.unique_path(dest_dir, os.path.basename(src_path))
+        self.store.install(src_path, dest_path, progress)
+        return dest_path
+
+    # Returns "" when there is no vanilla backup to diff against or the WAD
+    # shares too little with it; the caller then stores it in full.
+    @traced("core.store_music_delta")
+    def store_music_delta(self, src_path, dest_dir, progress=None):
+        self.backup_vanilla()
+        base = os.path.join(BACKUP_DIR, "hlm2_music_desktop.wad")
+        if not os.path.exists(base):
+            return ""
+        base_digest = self.store.pin(base)
+        name = os.path.splitext(os.path.basename(src_path))[0] + DELTA_SUFFIX
+        dest_path = self.unique_path(dest_dir, name)
+        if make_delta(src_path, pin_path(base_digest), base_digest, dest_path, progress):
+            return dest_path
+        if os.path.exists(dest_path):
+            os.remove(dest_path)
+        return ""
+
+    # Vanilla bases stay pinned only while a music delta is built against
+    # them; every game update would otherwise leave one behind for good. The
+    # current backup's pin stays too, new deltas (maybe one being installed
+    # right now) are built against it.
+    def unpin_unused(self):
+        bases = set()
+        backup = os.path.join(BACKUP_DIR, "hlm2_music_desktop.wad")
+        if os.path.exists(backup):
+            bases.add(self.fingerprints.lookup(backup)["digest"])
+        for _, _, music_wad in self.mods():
+            if music_wad and os.path.exists(music_wad) and is_delta(music_wad):
+                bases.add(read_header(music_wad)[0]["base"])
+        self.store.unpin_unused(bases)
@@ -0,0 +1,234 @@
+import bisect
+import hashlib
+import io
+import json
+import os
+import struct
+
+import cold
+import wad
+from hashing import TreeHasher, hash_file
+from store import pin_path
+
+MAGIC = b"HMMD\x01\x00"
+FIXED_SPAN = 1 << 20
+MAX_LITERAL_RATIO = 0.5
+DELTA_SUFFIX = ".delta.wad"
+
+
+# -------------------- WAD SPANS --------------------
+# Payload spans of an HM2 WAD, used as content-defined chunks: a swapped track
+# shifts every later offset but leaves the other payloads byte-identical.
+def wad_spans(f, size):
+    return sorted((entry.offset, entry.size) for entry in wad.parse_index(f, size) if entry.size)
+
+
+# Splits [0, size) into chunks: WAD payloads plus the gaps between them, or
+# fixed-size chunks for anything that does not parse as a WAD.
+def chunk_file(f, size):
+    try:
+        spans = wad_spans(f, size)
+    except (ValueError, struct.error):
+        spans = []
+    chunks, pos = [], 0
+    for offset, length in spans:
+        if offset < pos:
+            continue
+        if offset > pos:
+            chunks.append((pos, offset - pos))
+        chunks.append((offset, length))
+        pos = offset + length
+    if pos < size:
+        chunks.extend((p, min(FIXED_SPAN, size - p)) for p in range(pos, size, FIXED_SPAN))
+    return chunks
+
+
+def chunk_key(data):
+    return len(data), hashlib.blake2b(data, digest_size=16).digest()
+
+
+# -------------------- CREATE --------------------
+# Writes `target` as a list of copy-from-base and literal ops. Returns the
+# header, or None when too little of the file matches the base to be worth it.
+def make_delta(target, base, base_digest, out_path, progress=None):
+    index = {}
+    with open(base, "rb") as f:
+        for offset, length in chunk_file(f, os.fstat(f.fileno()).st_size):
+            f.seek(offset)
+            index.setdefault(chunk_key(f.read(length)), offset)
+            if progress:
+                progress(length)
+
+    ops, hasher = [], TreeHasher()
+    literal_bytes = 0
+    with open(target, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        for offset, length in chunk_file(f, size):
+            f.seek(offset)
+            data = f.read(length)
+            hasher.update(data)
+            base_offset = index.get(chunk_key(data))
+            if base_offset is None:
+                literal_bytes += length
+                if ops and ops[-1][0] == 1 and ops[-1][1] + ops[-1][2] == offset:
+                    ops[-1][2] += length
+                else:
+                    ops.append([1, offset, length])
+            elif ops and ops[-1][0] == 0 and ops[-1][1] + ops[-1][2] == base_offset:
+                ops[-1][2] += length
+            else:
+                ops.append([0, base_offset, length])
+            if progress:
+                progress(length)
+        if literal_bytes > size * MAX_LITERAL_RATIO:
+            return None
+
+        # literal ops point into the target for now; rebase them onto the
+        # literal data that follows the header
+        literals, data_pos = [], 0
+        for op in ops:
+            if op[0] == 1:
+                literals.append((op[1], op[2]))
+                op[1] = data_pos
+                data_pos += op[2]
+        header = {
+            "base": base_digest,
+            "size": size,
+            "digest": hasher.hexdigest(),
+            "blocks": hasher.block_digests(),
+            "ops": ops,
+        }
+        encoded = json.dumps(header).encode("utf-8")
+        with open(out_path, "wb") as out:
+            out.write(MAGIC + struct.pack("<I", len(encoded)) + encoded)
+            for offset, length in literals:
+                f.seek(offset)
+                out.write(f.read(length))
+    return header
+
+
+# -------------------- READ --------------------
+def is_delta(path):
+    try:
+        with open(path, "rb") as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+def read_header(path):
+    with open(path, "rb") as f:
+        f.seek(len(MAGIC))
+        (length,) = struct.unpack("<I", f.read(4))
+        return json.loads(f.read(length)), len(MAGIC) + 4 + length
+
+
+# (path, inode, size, mtime) of pins already hashed -> their digest. A pin
+# is never written once made, so it is only hashed again if its stat changes.
+_verified_bases = {}
+
+
+# A base that changed would rebuild corrupt music without any error.
+def check_base(base, digest):
+    st = os.stat(base)
+    key = (base, st.st_ino, st.st_size, st.st_mtime_ns)
+    if _verified_bases.get(key) == digest:
+        return
+    if hash_file(base).hexdigest() != digest:
+        raise ValueError(f"Vanilla base {digest[:12]} no longer matches its digest")
+    _verified_bases[key] = digest
+
+
+# Seekable view of the reconstructed file, streamed from the base and the
+# delta's literal data.
+class DeltaFile(io.RawIOBase):
+    def __init__(self, path):
+        self.header, self.data_start = read_header(path)
+        base = pin_path(self.header["base"])
+        if not os.path.exists(base):
+            raise FileNotFoundError(f"Vanilla base {self.header['base'][:12]} for {path} is missing")
+        check_base(base, self.header["base"])
+        self.delta = open(path, "rb")
+        self.base = open(base, "rb")
+        self.starts, pos = [], 0
+        for _, _, length in self.header["ops"]:
+            self.starts.append(pos)
+            pos += length
+        self.size = self.header["size"]
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.pos = max(0, offset)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def readinto(self, buffer):
+        if self.pos >= self.size:
+            return 0
+        i = bisect.bisect_right(self.starts, self.pos) - 1
+        kind, src_offset, length = self.header["ops"][i]
+        skip = self.pos - self.starts[i]
+        want = min(len(buffer), length - skip)
+        if kind == 0:
+            src, where = self.base, src_offset + skip
+        else:
+            src, where = self.delta, self.data_start + src_offset + skip
+        src.seek(where)
+        n = src.readinto(memoryview(buffer)[:want])
+        self.pos += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.delta.close()
+            self.base.close()
+        super().close()
+
+
+# Files that stand for other content: deltas and cold (compressed) files.
+# Returns the header that describes the content (size, digest, blocks), or
+# None for a plain file.
+def packed_header(path):
+    try:
+        with open(path, "rb") as f:
+            magic = f.read(len(MAGIC))
+    except OSError:
+        return None
+    if magic == MAGIC:
+        return read_header(path)[0]
+    if magic == cold.MAGIC:
+        return cold.read_header(path)
+    return None
+
+
+def open_content(path):
+    if is_delta(path):
+        return io.BufferedReader(DeltaFile(path), 1 << 20)
+    if cold.is_cold(path):
+        return io.BufferedReader(cold.ColdFile(path), 1 << 20)
+    return open(path, "rb")
+
+
+def content_size(path):
+    header = packed_header(path)
+    return header["size"] if header else os.path.getsize(path)
+
+
+# Fingerprint of what the file stands for: deltas and cold files carry their own.
+def content_entry(path, fingerprints, cached_only=False):
+    header = packed_header(path)
+    if header:
+        return {"size": header["size"], "digest": header["digest"], "blocks": header["blocks"]}
+    return fingerprints.cached(path) if cached_only else fingerprints.lookup(path)
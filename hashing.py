@@ -0,0 +1,180 @@
+import hashlib
+import json
+import mmap
+import os
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from tracing import traced
+
+CHUNK_SIZE = 8 << 20
+DIGEST_SIZE = 32
+PARALLEL_MIN_SIZE = 4 * CHUNK_SIZE
+HASH_WORKERS = min(8, os.cpu_count() or 1)
+
+
+# Files are hashed as a two-level tree: every CHUNK_SIZE slice gets its own
+# blake2b digest and the root digest is taken over those, so chunks can be
+# hashed independently.
+class TreeHasher:
+    def __init__(self):
+        self.root = hashlib.blake2b(digest_size=DIGEST_SIZE)
+        self.leaf = hashlib.blake2b(digest_size=DIGEST_SIZE)
+        self.leaf_len = 0
+        self.size = 0
+        self.leaves = []
+        self.crc = 0
+
+    def update(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        view = memoryview(data)
+        while view:
+            take = min(len(view), CHUNK_SIZE - self.leaf_len)
+            self.leaf.update(view[:take])
+            self.leaf_len += take
+            self.size += take
+            view = view[take:]
+            if self.leaf_len == CHUNK_SIZE:
+                self.leaves.append(self.leaf.hexdigest())
+                self.root.update(self.leaf.digest())
+                self.leaf = hashlib.blake2b(digest_size=DIGEST_SIZE)
+                self.leaf_len = 0
+
+    def hexdigest(self):
+        root = self.root.copy()
+        if self.leaf_len or not self.size:
+            root.update(self.leaf.digest())
+        return root.hexdigest()
+
+    def block_digests(self):
+        if self.leaf_len:
+            return self.leaves + [self.leaf.hexdigest()]
+        return list(self.leaves)
+
+
+def hash_file(path, progress=None):
+    hasher = TreeHasher()
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(1 << 20)
+            if not data:
+                break
+            hasher.update(data)
+            if progress:
+                progress(len(data))
+    return hasher
+
+
+def file_digest(path, progress=None):
+    return hash_file(path, progress).hexdigest()
+
+
+# -------------------- PARALLEL HASHING --------------------
+# Same tree hash as TreeHasher, but the leaves of a big file are hashed from
+# an mmap on several threads at once. blake2b drops the GIL while it works,
+# so threads scale across cores without pickling data to other processes.
+_hash_pool = None
+_hash_pool_lock = threading.Lock()
+
+
+def _pool():
+    global _hash_pool
+    with _hash_pool_lock:
+        if _hash_pool is None:
+            _hash_pool = ThreadPoolExecutor(HASH_WORKERS, thread_name_prefix="hash")
+        return _hash_pool
+
+
+def _hash_leaf(mm, index):
+    view = memoryview(mm)[index * CHUNK_SIZE:(index + 1) * CHUNK_SIZE]
+    try:
+        return index, hashlib.blake2b(view, digest_size=DIGEST_SIZE).digest(), len(view)
+    finally:
+        view.release()
+
+
+# returns (hex digest, block digests); the crc TreeHasher also keeps is skipped
+@traced("hashing.tree_hash")
+def tree_hash(path, progress=None):
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < PARALLEL_MIN_SIZE:
+            hasher = hash_file(path, progress)
+            return hasher.hexdigest(), hasher.block_digests()
+        leaves = [None] * ((size + CHUNK_SIZE - 1) // CHUNK_SIZE)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            futures = [_pool().submit(_hash_leaf, mm, i) for i in range(len(leaves))]
+            try:
+                for future in as_completed(futures):
+                    index, digest, length = future.result()
+                    leaves[index] = digest
+                    if progress:
+                        progress(length)
+            finally:
+                for future in futures:
+                    future.cancel()
+                # a running leaf still holds a view on the map
+                for future in futures:
+                    if not future.cancelled():
+                        future.exception()
+    root = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    for digest in leaves:
+        root.update(digest)
+    return root.hexdigest(), [digest.hex() for digest in leaves]
+
+
+# -------------------- FINGERPRINT CACHE --------------------
+# Remembers (size, mtime, inode) -> digest and per-block digests so unchanged
+# files never have to be read again: checking one costs a single stat.
+class FingerprintCache:
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.entries = {}
+        # paths changed or forgotten since the last save
+        self.dirty = set()
+        self.lock = threading.Lock()
+        if os.path.exists(cache_file):
+            with open(cache_file, "r") as f:
+                self.entries = json.load(f)
+
+    def cached(self, path):
+        entry = self.entries.get(path)
+        if not entry:
+            return None
+        st = os.stat(path)
+        # a file swapped for another one (e.g. by a game update) gets a new inode
+        if (entry["size"], entry["mtime_ns"], entry.get("ino") or st.st_ino) == (st.st_size, st.st_mtime_ns, st.st_ino):
+            return entry
+        return None
+
+    def lookup(self, path, progress=None):
+        entry = self.cached(path)
+        if entry:
+            return entry
+        st = os.stat(path)
+        digest, blocks = tree_hash(path, progress)
+        return self._store(path, st, digest, blocks)
+
+    def record(self, path, entry):
+        return self._store(path, os.stat(path), entry["digest"], entry["blocks"])
+
+    def forget(self, path):
+        with self.lock:
+            if self.entries.pop(path, None):
+                self.dirty.add(path)
+
+    def _store(self, path, st, digest, blocks):
+        entry = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "ino": st.st_ino, "digest": digest, "blocks": blocks}
+        with self.lock:
+            self.entries[path] = entry
+            self.dirty.add(path)
+        return entry
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            with open(self.cache_file, "w") as f:
+                json.dump(self.entries, f)
+            self.dirty = set()
@@ -0,0 +1,199 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+import tracing
+from core import GameFilesBusy, ModCore
+
+
+# Command line front end over ModCore. It never imports Qt, so scripted use
+# (e.g. switching mods from a Steam launch option) skips the GUI start-up
+# entirely. Every command prints one JSON object; failures exit with 1.
+def mod_json(core, name, patch_wads, music_wad):
+    return {"name": name, "patch_wads": patch_wads, "music_wad": music_wad, "active": name == core.active_mod}
+
+
+def cmd_list(core, args):
+    return {
+        "active": core.active_mod,
+        "game_files": core.check_game_files(cached_only=True),
+        "mods": [mod_json(core, *mod) for mod in core.mods()],
+    }
+
+
+def cmd_install(core, args):
+    patch_wads, music_wad = core.install_mod(args.name, args.files, args.delta)
+    return {"mod": mod_json(core, args.name, patch_wads, music_wad)}
+
+
+def cmd_activate(core, args):
+    written, note = core.activate(args.name)
+    return {"active": args.name, "bytes_written": written, "note": note.lstrip(", ")}
+
+
+def cmd_restore(core, args):
+    return {"active": None, "bytes_written": core.restore()}
+
+
+def cmd_import(core, args):
+    existing = core.import_conflicts(args.package)
+    if existing and not args.replace:
+        raise ValueError(f"Mod(s) already installed, pass --replace to update: {', '.join(existing)}")
+    mods = core.import_package(args.package)
+    return {"mods": [mod_json(core, *mod) for mod in mods]}
+
+
+def cmd_ingest(core, args):
+    result = core.ingest_folder(args.folder)
+    return {**result, "mods": [mod_json(core, *mod) for mod in result["mods"]]}
+
+
+def cmd_export(core, args):
+    core.mod(args.name)
+    return {"stats": core.export_mod(args.name, args.output, args.base)}
+
+
+def cmd_compose(core, args):
+    choices = {} if args.clear else core.music_tracks(args.name)
+    for pick in args.track:
+        track, sep, source = pick.partition("=")
+        if not sep:
+            raise ValueError(f"Expected TRACK=MOD, got '{pick}'")
+        if source.lower() == "vanilla":
+            source = ""
+        if source == "-":
+            choices.pop(track, None)
+        else:
+            choices[track] = source
+    core.set_music_tracks(args.name, choices)
+    return {"name": args.name, "tracks": {track: source or "vanilla" for track, source in choices.items()}}
+
+
+def cmd_tier(core, args):
+    if args.no_limit:
+        core.set_hot_budget(None)
+    elif args.budget is not None:
+        core.set_hot_budget(args.budget * 1000000)
+    result = core.rebalance_tiers()
+    tiers = core.mod_tiers()
+    return {
+        **result,
+        "hot_budget": core.hot_budget,
+        "hot_bytes": sum(hot for hot, _ in tiers.values()),
+        "cold_bytes": sum(cold for _, cold in tiers.values()),
+    }
+
+
+def cmd_stage(core, args):
+    if args.budget is not None:
+        core.set_staging_budget(args.budget * 1000000)
+    for name in args.pin:
+        core.set_staged_pin(name, True)
+    for name in args.unpin:
+        core.set_staged_pin(name, False)
+    written = core.stage_likely()
+    return {
+        "bytes_written": written,
+        "staging_budget": core.staging.budget,
+        "pinned": core.staged_pins,
+        "likely": core.likely_next(),
+    }
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="hmmm", description="Hotline Miami Mod Manager")
+    parser.add_argument("--data-dir", help="folder holding the HMMM library (default: current folder)")
+    parser.add_argument("--trace", help="write a Chrome trace of the command to this file")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser("list", help="list installed mods").set_defaults(run=cmd_list)
+
+    install = commands.add_parser("install", help="install .patchwad/.wad files as a mod")
+    install.add_argument("name")
+    install.add_argument("files", nargs="+")
+    install.add_argument("--delta", action=argparse.BooleanOptionalAction, default=None,
+                         help="store the music WAD as a delta against vanilla")
+    install.set_defaults(run=cmd_install)
+
+    activate = commands.add_parser("activate", help="switch the game to a mod")
+    activate.add_argument("name")
+    activate.set_defaults(run=cmd_activate)
+
+    commands.add_parser("restore", help="restore the vanilla game files").set_defaults(run=cmd_restore)
+
+    import_ = commands.add_parser("import", help="import a mod package")
+    import_.add_argument("package")
+    import_.add_argument("--replace", action="store_true", help="update mods that are already installed")
+    import_.set_defaults(run=cmd_import)
+
+    ingest = commands.add_parser("ingest", help="install every mod found in a folder tree (e.g. Workshop downloads)")
+    ingest.add_argument("folder")
+    ingest.set_defaults(run=cmd_ingest)
+
+    export = commands.add_parser("export", help="export a mod package")
+    export.add_argument("name")
+    export.add_argument("output")
+    export.add_argument("--base", help="build a delta package against this earlier package")
+    export.set_defaults(run=cmd_export)
+
+    compose = commands.add_parser("compose", help="take single music tracks from other mods or vanilla")
+    compose.add_argument("name")
+    compose.add_argument("--track", action="append", default=[], metavar="TRACK=MOD",
+                         help="take TRACK from MOD ('vanilla' for the game's own, '-' to drop the choice)")
+    compose.add_argument("--clear", action="store_true", help="drop all earlier choices first")
+    compose.set_defaults(run=cmd_compose)
+
+    tier = commands.add_parser("tier", help="compress the least recently used mods beyond a size budget")
+    budget = tier.add_mutually_exclusive_group()
+    budget.add_argument("--budget", type=int, metavar="MB", help="keep at most this much of the mods uncompressed")
+    budget.add_argument("--no-limit", action="store_true", help="decompress every mod again")
+    tier.set_defaults(run=cmd_tier)
+
+    stage = commands.add_parser("stage", help="copy the likely next mods next to the game files for instant switching")
+    stage.add_argument("--budget", type=int, metavar="MB", help="space the staged copies may take (0 turns it off)")
+    stage.add_argument("--pin", action="append", default=[], metavar="NAME", help="always keep this mod staged")
+    stage.add_argument("--unpin", action="append", default=[], metavar="NAME")
+    stage.set_defaults(run=cmd_stage)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    started = time.perf_counter()
+    try:
+        # paths given on the command line are relative to where we were started
+        for attr in ("package", "output", "base", "folder", "trace"):
+            if getattr(args, attr, None):
+                setattr(args, attr, os.path.abspath(getattr(args, attr)))
+        if getattr(args, "files", None):
+            args.files = [os.path.abspath(f) for f in args.files]
+        if args.data_dir:
+            os.chdir(args.data_dir)
+        if args.trace:
+            tracing.set_enabled(True)
+        core = ModCore()
+        result = {"ok": True}
+        if core.pending_switch():
+            # the last switch was interrupted, finish it before anything else
+            try:
+                mod_name, written = core.resume_switch()
+                result["resumed"] = {"active": mod_name, "bytes_written": written}
+            except GameFilesBusy:
+                # not interrupted: the GUI is in the middle of it. Commands
+                # that touch the game files fail on the lock themselves.
+                pass
+        result.update(args.run(core, args))
+    except (OSError, ValueError) as e:
+        result = {"ok": False, "error": str(e)}
+    result["seconds"] = round(time.perf_counter() - started, 4)
+    if args.trace:
+        tracing.export_chrome_trace(args.trace)
+    json.dump(result, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+    return 0 if result["ok"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
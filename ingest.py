@@ -0,0 +1,152 @@
+import os
+import shutil
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from package import run_parallel
+
+WAD_SUFFIXES = (".patchwad", ".wad")
+# directory reads mostly wait on the disk (or the network share), so many
+# more of them can be in flight than there are cores
+SCAN_WORKERS = 16
+
+
+# -------------------- SCAN --------------------
+# returns (folder, [(path, size, mtime_ns)], [subfolders])
+def _scan_dir(folder):
+    files, subdirs = [], []
+    try:
+        entries = list(os.scandir(folder))
+    except OSError:
+        # unreadable folders are skipped, not fatal
+        return folder, files, subdirs
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            subdirs.append(entry.path)
+        elif entry.name.lower().endswith(WAD_SUFFIXES) and entry.is_file():
+            st = entry.stat()
+            files.append((entry.path, st.st_size, st.st_mtime_ns))
+    return folder, sorted(files), subdirs
+
+
+# Walks the tree with every folder listed on the pool as soon as its parent
+# was read. Returns {folder: files} for the folders that hold WADs; each of
+# them becomes one mod.
+def scan_folder(root):
+    groups = {}
+    with ThreadPoolExecutor(SCAN_WORKERS) as pool:
+        pending = {pool.submit(_scan_dir, root)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                folder, files, subdirs = future.result()
+                if files:
+                    groups[folder] = files
+                pending |= {pool.submit(_scan_dir, d) for d in subdirs}
+    return groups
+
+
+# -------------------- PLAN --------------------
+def _unique_name(name, taken):
+    candidate, counter = name, 2
+    while candidate in taken:
+        candidate = f"{name} ({counter})"
+        counter += 1
+    return candidate
+
+
+# known: {source path: (size, mtime_ns, digest, mod)} from earlier runs.
+# mods: names of the installed mods. A folder keeps the mod it was ingested
+# as before; new folders are named after themselves. Returns
+# ([(folder, mod_name, files, status)], {folder: reason skipped}) where status
+# is "new", "changed" or "unchanged".
+def plan_ingest(groups, known, mods):
+    owned = {}
+    for path, (_, _, _, mod) in known.items():
+        owned.setdefault(mod, set()).add(path)
+    plan, skipped, assigned = [], {}, set()
+    for folder in sorted(groups):
+        files = groups[folder]
+        if sum(path.lower().endswith(".wad") for path, _, _ in files) > 1:
+            skipped[folder] = "more than one music .wad"
+            continue
+        name = next((known[path][3] for path, _, _ in files if path in known), None)
+        if name is None or name in assigned:
+            name = _unique_name(os.path.basename(os.path.normpath(folder)), set(mods) | assigned)
+        assigned.add(name)
+        unchanged = (
+            name in mods
+            and owned.get(name) == {path for path, _, _ in files}
+            and all(known[path][:2] == (size, mtime_ns) for path, size, mtime_ns in files)
+        )
+        status = "unchanged" if unchanged else "changed" if name in mods else "new"
+        plan.append((folder, name, files, status))
+    return plan, skipped
+
+
+# bytes reported for a file: twice when it has to be hashed and copied
+def ingest_size(plan, known, store):
+    total = 0
+    for _, _, files, _ in plan:
+        for path, size, mtime_ns in files:
+            total += size if _known_digest(path, size, mtime_ns, known, store) else 2 * size
+    return total
+
+
+def _known_digest(path, size, mtime_ns, known, store):
+    entry = known.get(path)
+    if entry and entry[:2] == (size, mtime_ns) and store.has(entry[2]):
+        return entry[2]
+    return None
+
+
+# -------------------- INGEST --------------------
+# Hashes and dedupes every file of the planned mods in parallel. Files whose
+# size and mtime match an earlier run are linked straight from the store
+# without being read. Mods are assembled in a ".<name>.partial" folder and
+# swapped in at the end, so an interrupted run leaves every mod as it was.
+# Returns ([(mod_name, patch_wads, music_wad)], [(source, size, mtime_ns,
+# digest, mod_name)]).
+def ingest_mods(plan, mods_dir, store, known, progress=None):
+    tasks = []
+    for _, name, files, _ in plan:
+        partial = os.path.join(mods_dir, f".{name}.partial")
+        shutil.rmtree(partial, ignore_errors=True)
+        os.makedirs(partial)
+        tasks += [(name, partial, f) for f in files]
+
+    def ingest(task):
+        name, partial, (path, size, mtime_ns) = task
+        target = os.path.join(partial, os.path.basename(path))
+        digest = _known_digest(path, size, mtime_ns, known, store)
+        if digest:
+            store.link(digest, target)
+            if progress:
+                progress(size)
+        else:
+            digest = store.install(path, target, progress)
+        return path, size, mtime_ns, digest, name
+
+    try:
+        sources = run_parallel(ingest, tasks)
+    except BaseException:
+        for _, name, _, _ in plan:
+            shutil.rmtree(os.path.join(mods_dir, f".{name}.partial"), ignore_errors=True)
+        raise
+
+    result = {}
+    for name, _, (path, _, _) in tasks:
+        result.setdefault(name, []).append(os.path.join(mods_dir, name, os.path.basename(path)))
+    mods = []
+    for name, paths in result.items():
+        partial = os.path.join(mods_dir, f".{name}.partial")
+        dest = os.path.join(mods_dir, name)
+        if os.path.exists(dest):
+            old = os.path.join(mods_dir, f".{name}.old")
+            os.rename(dest, old)
+            os.rename(partial, dest)
+            shutil.rmtree(old, ignore_errors=True)
+        else:
+            os.rename(partial, dest)
+        music_wads = [p for p in paths if p.lower().endswith(".wad")]
+        mods.append((name, [p for p in paths if p.lower().endswith(".patchwad")], music_wads[0] if music_wads else ""))
+    return mods, sources
@@ -0,0 +1,202 @@
+import threading
+import time
+import traceback
+from collections import deque
+
+from PySide6.QtCore import QObject, QRunnable, QThreadPool, Signal
+from PySide6.QtWidgets import QHBoxLayout, QLabel, QProgressBar, QPushButton, QVBoxLayout, QWidget
+
+from copier import Cancelled
+
+PROGRESS_INTERVAL = 0.1
+
+
+class JobSignals(QObject):
+    started = Signal(object)
+    progress = Signal(object)
+    finished = Signal(object, object)
+    failed = Signal(object, str)
+    cancelled = Signal(object)
+
+
+# A unit of background work. The work function receives the job itself and
+# uses set_total()/report() as its byte-level progress callback; report()
+# raises Cancelled once cancel() has been called.
+class Job(QRunnable):
+    def __init__(self, title, work, signals, cancellable=True):
+        super().__init__()
+        self.setAutoDelete(False)
+        self.title = title
+        self.work = work
+        self.signals = signals
+        self.cancellable = cancellable
+        self.cancel_event = threading.Event()
+        self.total = 0
+        self.done = 0
+        self.started_at = None
+        self.last_emit = 0.0
+        self.lock = threading.Lock()
+
+    def cancel(self):
+        if self.cancellable:
+            self.cancel_event.set()
+
+    def check(self):
+        if self.cancel_event.is_set():
+            raise Cancelled()
+
+    def set_total(self, total):
+        self.total = total
+        self.signals.progress.emit(self)
+
+    # may be called from several threads of the same job
+    def report(self, nbytes):
+        self.check()
+        with self.lock:
+            self.done += nbytes
+            now = time.monotonic()
+            if now - self.last_emit < PROGRESS_INTERVAL:
+                return
+            self.last_emit = now
+        self.signals.progress.emit(self)
+
+    def run(self):
+        self.started_at = time.monotonic()
+        self.signals.started.emit(self)
+        try:
+            result = self.work(self)
+        except Cancelled:
+            self.signals.cancelled.emit(self)
+        except Exception as e:
+            traceback.print_exc()
+            self.signals.failed.emit(self, str(e))
+        else:
+            self.signals.finished.emit(self, result)
+
+
+# Runs jobs on a thread pool. Jobs sharing a lane (e.g. everything touching
+# the game files) run one after another, everything else runs concurrently.
+class JobManager(QObject):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.pool = QThreadPool(self)
+        self.signals = JobSignals(self)
+        self.signals.finished.connect(self._on_finished)
+        self.signals.failed.connect(self._on_failed)
+        self.signals.cancelled.connect(self._on_cancelled)
+        self.callbacks = {}
+        self.lanes = {}
+        self.jobs = []
+        # a worker may still be unwinding run() when its signal arrives
+        self.recent = deque(maxlen=32)
+
+    def submit(self, title, work, on_done=None, on_error=None, on_cancel=None, lane=None, cancellable=True):
+        job = Job(title, work, self.signals, cancellable)
+        job.lane = lane
+        self.callbacks[job] = (on_done, on_error, on_cancel)
+        self.jobs.append(job)
+        if lane is None:
+            self.pool.start(job)
+        else:
+            queue = self.lanes.setdefault(lane, deque())
+            queue.append(job)
+            if len(queue) == 1:
+                self.pool.start(job)
+        return job
+
+    def cancel_all(self):
+        for job in self.jobs:
+            job.cancel()
+
+    def wait(self):
+        self.pool.waitForDone()
+
+    def _release(self, job):
+        self.jobs.remove(job)
+        self.recent.append(job)
+        callbacks = self.callbacks.pop(job)
+        if job.lane is not None:
+            queue = self.lanes[job.lane]
+            queue.popleft()
+            if queue:
+                self.pool.start(queue[0])
+        return callbacks
+
+    def _on_finished(self, job, result):
+        on_done, _, _ = self._release(job)
+        if on_done:
+            on_done(result)
+
+    def _on_failed(self, job, message):
+        _, on_error, _ = self._release(job)
+        if on_error:
+            on_error(message)
+
+    def _on_cancelled(self, job):
+        _, _, on_cancel = self._release(job)
+        if on_cancel:
+            on_cancel()
+
+
+# -------------------- PROGRESS PANEL --------------------
+class JobRow(QWidget):
+    def __init__(self, job):
+        super().__init__()
+        self.job = job
+        layout = QHBoxLayout(self)
+        layout.setContentsMargins(0, 0, 0, 0)
+        self.label = QLabel(job.title)
+        self.bar = QProgressBar()
+        self.bar.setRange(0, 0)
+        cancel_btn = QPushButton("Cancel")
+        cancel_btn.setEnabled(job.cancellable)
+        cancel_btn.clicked.connect(job.cancel)
+        layout.addWidget(self.label, 2)
+        layout.addWidget(self.bar, 3)
+        layout.addWidget(cancel_btn)
+
+    def refresh(self):
+        job = self.job
+        if job.total:
+            self.bar.setRange(0, 1000)
+            self.bar.setValue(min(1000, job.done * 1000 // job.total))
+        if job.started_at and job.done:
+            elapsed = max(time.monotonic() - job.started_at, 1e-6)
+            self.label.setText(f"{job.title} ({job.done / elapsed / 1e6:.1f} MB/s)")
+
+
+class JobPanel(QWidget):
+    def __init__(self, manager, status_bar=None):
+        super().__init__()
+        self.status_bar = status_bar
+        self.rows = {}
+        self.rows_layout = QVBoxLayout(self)
+        self.rows_layout.setContentsMargins(0, 0, 0, 0)
+        manager.signals.started.connect(self.add_job)
+        manager.signals.progress.connect(self.update_job)
+        for signal in (manager.signals.finished, manager.signals.failed, manager.signals.cancelled):
+            signal.connect(self.remove_job)
+        self.hide()
+
+    def add_job(self, job):
+        row = JobRow(job)
+        self.rows[job] = row
+        self.rows_layout.addWidget(row)
+        self.show()
+        self.refresh_status()
+
+    def update_job(self, job):
+        if job in self.rows:
+            self.rows[job].refresh()
+
+    def remove_job(self, job, *_):
+        row = self.rows.pop(job, None)
+        if row:
+            row.deleteLater()
+        if not self.rows:
+            self.hide()
+        self.refresh_status()
+
+    def refresh_status(self):
+        if self.status_bar is not None and self.rows:
+            self.status_bar.showMessage(f"{len(self.rows)} job(s) running")
@@ -0,0 +1,376 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from hashing import FingerprintCache
+from tracing import traced
+
+LIBRARY_FILE = "library.db"
+SCHEMA_VERSION = 5
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS mods (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    added_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    mod_id INTEGER NOT NULL REFERENCES mods(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    path TEXT NOT NULL,
+    PRIMARY KEY (mod_id, position)
+);
+CREATE INDEX IF NOT EXISTS files_path ON files(path);
+CREATE TABLE IF NOT EXISTS hashes (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    ino INTEGER,
+    digest TEXT NOT NULL,
+    blocks TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS hashes_digest ON hashes(digest);
+CREATE TABLE IF NOT EXISTS activations (
+    id INTEGER PRIMARY KEY,
+    mod TEXT,
+    at REAL NOT NULL,
+    bytes_written INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS journal (
+    position INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    dst TEXT NOT NULL,
+    src TEXT,
+    blocks TEXT,
+    done TEXT
+);
+CREATE TABLE IF NOT EXISTS ingested (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    digest TEXT NOT NULL,
+    mod TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS mod_tracks (
+    mod_id INTEGER NOT NULL REFERENCES mods(id) ON DELETE CASCADE,
+    track TEXT NOT NULL,
+    source TEXT NOT NULL,
+    PRIMARY KEY (mod_id, track)
+);
+"""
+
+# applied in order to bring an older database up to SCHEMA_VERSION
+MIGRATIONS = {
+    2: "ALTER TABLE hashes ADD COLUMN ino INTEGER;",
+    3: """
+CREATE TABLE IF NOT EXISTS journal (
+    position INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    dst TEXT NOT NULL,
+    src TEXT,
+    blocks TEXT,
+    done TEXT
+);
+""",
+    4: """
+CREATE TABLE IF NOT EXISTS ingested (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    digest TEXT NOT NULL,
+    mod TEXT NOT NULL
+);
+""",
+    5: """
+CREATE TABLE IF NOT EXISTS mod_tracks (
+    mod_id INTEGER NOT NULL REFERENCES mods(id) ON DELETE CASCADE,
+    track TEXT NOT NULL,
+    source TEXT NOT NULL,
+    PRIMARY KEY (mod_id, track)
+);
+""",
+}
+
+
+# Mods, their files, file fingerprints, activation history and settings in
+# one SQLite database. Every change is its own small transaction, so writes
+# cost what they touch and a crash leaves the previous state intact. Each
+# thread gets its own connection; WAL lets readers run alongside a writer.
+class Library:
+    # legacy: (mods file, state file, fingerprint file) of the JSON era,
+    # imported when the database is new
+    def __init__(self, path=LIBRARY_FILE, legacy=None):
+        self.path = path
+        self.local = threading.local()
+        conn = self.conn
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        self.created = version == 0
+        if version < SCHEMA_VERSION:
+            # the scripts only create what is missing, so rerunning them
+            # after a crash is harmless
+            if self.created:
+                conn.executescript(SCHEMA)
+            else:
+                for step in range(version + 1, SCHEMA_VERSION + 1):
+                    conn.executescript(MIGRATIONS[step])
+            # The version goes in with the imported JSON files: if the import
+            # fails, the next start still sees a new database and tries again.
+            with conn:
+                if self.created and legacy:
+                    self._import_json(conn, *legacy)
+                conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    @property
+    def conn(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            conn.execute("PRAGMA foreign_keys = ON")
+            self.local.conn = conn
+        return conn
+
+    # -------------------- MODS --------------------
+    # returns [(name, patch_wads, music_wad)] in install order
+    def mods(self):
+        rows = self.conn.execute(
+            "SELECT m.id, m.name, f.kind, f.path FROM mods m "
+            "LEFT JOIN files f ON f.mod_id = m.id ORDER BY m.id, f.position"
+        )
+        mods = {}
+        for mod_id, name, kind, path in rows:
+            mod = mods.setdefault(mod_id, (name, [], []))
+            if kind:
+                mod[1 if kind == "patch" else 2].append(path)
+        return [(name, patches, music[0] if music else "") for name, patches, music in mods.values()]
+
+    # returns (name, patch_wads, music_wad), or None when there is no such mod
+    def mod(self, name):
+        rows = self.conn.execute(
+            "SELECT f.kind, f.path FROM mods m LEFT JOIN files f ON f.mod_id = m.id "
+            "WHERE m.name = ? ORDER BY f.position", (name,)
+        ).fetchall()
+        if not rows:
+            return None
+        patches = [path for kind, path in rows if kind == "patch"]
+        music = [path for kind, path in rows if kind == "music"]
+        return name, patches, music[0] if music else ""
+
+    @traced("library.save_mods", "db")
+    def save_mods(self, mods):
+        with self.conn as conn:
+            for name, patch_wads, music_wad in mods:
+                self._save_mod(conn, name, patch_wads, music_wad)
+
+    # old_name renames the mod in the same transaction
+    @traced("library.save_mod", "db")
+    def save_mod(self, name, patch_wads, music_wad, old_name=None):
+        with self.conn as conn:
+            if old_name and old_name != name:
+                conn.execute("UPDATE mods SET name = ? WHERE name = ?", (name, old_name))
+                conn.execute("UPDATE ingested SET mod = ? WHERE mod = ?", (name, old_name))
+                conn.execute("UPDATE mod_tracks SET source = ? WHERE source = ?", (name, old_name))
+                conn.execute("UPDATE activations SET mod = ? WHERE mod = ?", (name, old_name))
+            self._save_mod(conn, name, patch_wads, music_wad)
+
+    def _save_mod(self, conn, name, patch_wads, music_wad):
+        conn.execute("INSERT OR IGNORE INTO mods (name, added_at) VALUES (?, ?)", (name, time.time()))
+        (mod_id,) = conn.execute("SELECT id FROM mods WHERE name = ?", (name,)).fetchone()
+        conn.execute("DELETE FROM files WHERE mod_id = ?", (mod_id,))
+        files = [("patch", p) for p in patch_wads if p]
+        if music_wad:
+            files.append(("music", music_wad))
+        conn.executemany(
+            "INSERT INTO files (mod_id, position, kind, path) VALUES (?, ?, ?, ?)",
+            [(mod_id, i, kind, path) for i, (kind, path) in enumerate(files)]
+        )
+
+    @traced("library.delete_mod", "db")
+    def delete_mod(self, name):
+        with self.conn as conn:
+            conn.execute("DELETE FROM mods WHERE name = ?", (name,))
+            conn.execute("DELETE FROM ingested WHERE mod = ?", (name,))
+            # other mods' tracks from it fall back to their own
+            conn.execute("DELETE FROM mod_tracks WHERE source = ?", (name,))
+
+    # -------------------- MUSIC TRACKS --------------------
+    # tracks a mod takes from other music WADs: {track: source}, where source
+    # is a mod name or "" for vanilla
+    def tracks(self, name):
+        return dict(self.conn.execute(
+            "SELECT t.track, t.source FROM mod_tracks t JOIN mods m ON m.id = t.mod_id WHERE m.name = ?", (name,)
+        ))
+
+    def save_tracks(self, name, choices):
+        with self.conn as conn:
+            (mod_id,) = conn.execute("SELECT id FROM mods WHERE name = ?", (name,)).fetchone()
+            conn.execute("DELETE FROM mod_tracks WHERE mod_id = ?", (mod_id,))
+            conn.executemany(
+                "INSERT INTO mod_tracks (mod_id, track, source) VALUES (?, ?, ?)",
+                [(mod_id, track, source) for track, source in choices.items()]
+            )
+
+    # -------------------- INGEST --------------------
+    # source files of ingested mods: {path: (size, mtime_ns, digest, mod)}
+    def ingested(self):
+        return {
+            path: (size, mtime_ns, digest, mod)
+            for path, size, mtime_ns, digest, mod in self.conn.execute(
+                "SELECT path, size, mtime_ns, digest, mod FROM ingested")
+        }
+
+    # mods and the sources they came from, all in one transaction
+    @traced("library.save_ingest", "db")
+    def save_ingest(self, mods, sources):
+        with self.conn as conn:
+            for name, patch_wads, music_wad in mods:
+                conn.execute("DELETE FROM ingested WHERE mod = ?", (name,))
+                self._save_mod(conn, name, patch_wads, music_wad)
+            conn.executemany(
+                "INSERT OR REPLACE INTO ingested (path, size, mtime_ns, digest, mod) VALUES (?, ?, ?, ?, ?)",
+                sources
+            )
+
+    # -------------------- SETTINGS --------------------
+    def settings(self):
+        return {key: json.loads(value) for key, value in self.conn.execute("SELECT key, value FROM settings")}
+
+    @traced("library.save_settings", "db")
+    def save_settings(self, values):
+        with self.conn as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+                [(key, json.dumps(value)) for key, value in values.items()]
+            )
+
+    # -------------------- HISTORY --------------------
+    @traced("library.record_activation", "db")
+    def record_activation(self, mod_name, bytes_written):
+        with self.conn as conn:
+            conn.execute(
+                "INSERT INTO activations (mod, at, bytes_written) VALUES (?, ?, ?)",
+                (mod_name, time.time(), bytes_written)
+            )
+
+    # {mod: last activation, or when it was added if never activated}
+    def last_used(self):
+        used = dict(self.conn.execute("SELECT name, added_at FROM mods"))
+        for mod, at in self.conn.execute("SELECT mod, MAX(at) FROM activations GROUP BY mod"):
+            if mod in used:
+                used[mod] = at
+        return used
+
+    def history(self, limit=50):
+        return self.conn.execute(
+            "SELECT mod, at, bytes_written FROM activations ORDER BY id DESC LIMIT ?", (limit,)
+        ).fetchall()
+
+    # -------------------- SWITCH JOURNAL --------------------
+    # Write-ahead log of a game file switch: the planned operations go in
+    # before the first file is touched and each is marked as it completes,
+    # so a switch that was killed halfway can be finished on the next start.
+    # switch describes the switch itself (the mod and its targets).
+    def begin_switch(self, switch, ops):
+        conn = self.conn
+        # this one must survive a power cut, not just a crash
+        conn.execute("PRAGMA synchronous = FULL")
+        try:
+            with conn:
+                conn.execute("DELETE FROM journal")
+                conn.executemany(
+                    "INSERT INTO journal (position, kind, dst, src, blocks) VALUES (?, ?, ?, ?, ?)",
+                    [(i, kind, dst, src, json.dumps(blocks) if blocks is not None else None)
+                     for i, (kind, dst, src, blocks) in enumerate(ops)]
+                )
+                conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('switch', ?)", (json.dumps(switch),))
+        finally:
+            conn.execute("PRAGMA synchronous = NORMAL")
+
+    # done is what the operation did, e.g. the placement strategy
+    def mark_done(self, position, done):
+        with self.conn as conn:
+            conn.execute("UPDATE journal SET done = ? WHERE position = ?", (done, position))
+
+    # returns (switch, [(kind, dst, src, blocks, done)]), or None when the
+    # last switch completed
+    def pending_switch(self):
+        row = self.conn.execute("SELECT value FROM settings WHERE key = 'switch'").fetchone()
+        if row is None:
+            return None
+        ops = [
+            (kind, dst, src, json.loads(blocks) if blocks is not None else None, done)
+            for kind, dst, src, blocks, done in self.conn.execute(
+                "SELECT kind, dst, src, blocks, done FROM journal ORDER BY position")
+        ]
+        return json.loads(row[0]), ops
+
+    def end_switch(self):
+        with self.conn as conn:
+            conn.execute("DELETE FROM journal")
+            conn.execute("DELETE FROM settings WHERE key = 'switch'")
+
+    # -------------------- MIGRATION --------------------
+    # One-time import of the JSON files older versions kept. They are left in
+    # place, untouched, in case an older version is started again.
+    def _import_json(self, conn, mods_file, state_file, fingerprint_file):
+        mods, settings, hashes = [], {}, {}
+        if os.path.exists(mods_file):
+            with open(mods_file, "r") as f:
+                for mod in json.load(f):
+                    patches = mod.get("patch_wads", "").split("; ") if mod.get("patch_wads") else []
+                    mods.append((mod.get("mod_name", ""), patches, mod.get("music_wad", "")))
+        if os.path.exists(state_file):
+            with open(state_file, "r") as f:
+                settings = json.load(f)
+        if os.path.exists(fingerprint_file):
+            with open(fingerprint_file, "r") as f:
+                hashes = json.load(f)
+        for name, patch_wads, music_wad in mods:
+            self._save_mod(conn, name, patch_wads, music_wad)
+        conn.executemany(
+            "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+            [(key, json.dumps(value)) for key, value in settings.items()]
+        )
+        self._save_hashes(conn, hashes)
+
+    def _save_hashes(self, conn, entries):
+        conn.executemany(
+            "INSERT OR REPLACE INTO hashes (path, size, mtime_ns, ino, digest, blocks) VALUES (?, ?, ?, ?, ?, ?)",
+            [(path, e["size"], e["mtime_ns"], e.get("ino"), e["digest"], json.dumps(e["blocks"]))
+             for path, e in entries.items()]
+        )
+
+
+# FingerprintCache kept in the hashes table; save() writes only the paths
+# that changed since the last save.
+class LibraryFingerprints(FingerprintCache):
+    def __init__(self, library):
+        self.library = library
+        self.cache_file = library.path
+        self.dirty = set()
+        self.lock = threading.Lock()
+        self.entries = {
+            path: {"size": size, "mtime_ns": mtime_ns, "ino": ino, "digest": digest, "blocks": json.loads(blocks)}
+            for path, size, mtime_ns, ino, digest, blocks in library.conn.execute(
+                "SELECT path, size, mtime_ns, ino, digest, blocks FROM hashes")
+        }
+
+    @traced("fingerprints.save", "db")
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            changed = {path: self.entries[path] for path in self.dirty if path in self.entries}
+            removed = [(path,) for path in self.dirty if path not in self.entries]
+            with self.library.conn as conn:
+                self.library._save_hashes(conn, changed)
+                conn.executemany("DELETE FROM hashes WHERE path = ?", removed)
+            self.dirty = set()
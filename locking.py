@@ -0,0 +1,71 @@
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+# neither lock can be waited on with a timeout, so it is polled
+POLL_INTERVAL = 0.1
+
+
+def _try_lock(fd):
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            os.lseek(fd, 0, os.SEEK_SET)
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+    except OSError:
+        return False
+    return True
+
+
+def _unlock(fd):
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    else:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+
+# An exclusive lock on a file, held by one process at a time. The OS drops it
+# when the process dies, so a crash never leaves it stuck. Within the process
+# it is re-entrant and threads simply take turns; another process is waited
+# for up to timeout seconds, then acquire() returns False.
+class ProcessLock:
+    def __init__(self, path):
+        self.path = path
+        self.thread_lock = threading.RLock()
+        self.depth = 0
+        self.fd = None
+
+    def acquire(self, timeout=0):
+        self.thread_lock.acquire()
+        if self.depth == 0:
+            try:
+                fd = os.open(self.path, os.O_RDWR | os.O_CREAT)
+            except OSError:
+                self.thread_lock.release()
+                raise
+            deadline = time.monotonic() + timeout
+            while not _try_lock(fd):
+                if time.monotonic() >= deadline:
+                    os.close(fd)
+                    self.thread_lock.release()
+                    return False
+                time.sleep(POLL_INTERVAL)
+            self.fd = fd
+        self.depth += 1
+        return True
+
+    def release(self):
+        self.depth -= 1
+        if self.depth == 0:
+            _unlock(self.fd)
+            os.close(self.fd)
+            self.fd = None
+        self.thread_lock.release()
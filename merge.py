@@ -0,0 +1,49 @@
+import os
+from contextlib import ExitStack
+
+from buildcache import BuildCache
+from delta import content_entry
+from tracing import traced
+from wad import WadReader, write_wad
+
+MERGE_DIR = os.path.join("cache", "merged")
+MAX_MERGED = 16
+
+
+# Folds several patchwads into one. Later inputs override earlier ones entry
+# by entry; every entry that more than one input provides is reported as a
+# conflict along with the inputs that had it, in override order.
+def merge_patchwads(paths, out_path, progress=None, cache=None):
+    with ExitStack() as stack:
+        readers = [stack.enter_context(WadReader(path, cache)) for path in paths]
+        winners, conflicts = {}, {}
+        for reader in readers:
+            for entry in reader.entries:
+                if entry.name in winners:
+                    conflicts.setdefault(entry.name, [os.path.basename(winners[entry.name].path)])
+                    conflicts[entry.name].append(os.path.basename(reader.path))
+                winners[entry.name] = reader
+        # first appearance fixes an entry's position, the last provider its data
+        items = [(name, reader.payload(name)) for name, reader in winners.items()]
+        try:
+            with open(out_path, "wb") as out:
+                written = write_wad(out, items, readers[0].prefix, progress)
+        finally:
+            for _, payload in items:
+                payload.release()
+    return written, conflicts
+
+
+# Merged outputs, keyed by the digests of their inputs in override order.
+# Reactivating a mod links the prebuilt file instead of merging again.
+class MergeCache(BuildCache):
+    def __init__(self, fingerprints, cache_dir=MERGE_DIR, wad_index=None):
+        super().__init__(cache_dir, ".patchwad", MAX_MERGED)
+        self.fingerprints = fingerprints
+        self.wad_index = wad_index
+
+    # returns (path, conflicts, reused)
+    @traced("merge.merged")
+    def merged(self, paths, progress=None):
+        key = self.key([content_entry(path, self.fingerprints)["digest"] for path in paths])
+        return self.get(key, lambda out_path: merge_patchwads(paths, out_path, progress, self.wad_index)[1])
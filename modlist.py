@@ -0,0 +1,145 @@
+import os
+from collections import namedtuple
+
+from PySide6.QtCore import QAbstractTableModel, QModelIndex, Qt
+from PySide6.QtGui import QFont
+
+HEADERS = ["Active", "Mod Name", "Patch WAD(s)", "Music WAD"]
+# by the state of the game files, see core.check_game_files()
+ACTIVE_MARKS = {"ok": "✅", "modified": "⚠️", "unknown": "❔"}
+ACTIVE_TIPS = {
+    "ok": "Active",
+    "modified": "Active, but the game files were changed outside HMMM (game update or file verification?). "
+                "Double click to activate it again.",
+    "unknown": "Active, the game files have not been checked yet",
+}
+
+ModRow = namedtuple("ModRow", "name patch_wads music_wad")
+
+
+# Table model over the installed mods. Rows are only materialized when the
+# view asks for them, so only the visible rows ever cost anything; sorting and
+# filtering just reorder the list of visible names.
+class ModListModel(QAbstractTableModel):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.mods = {}
+        self.order = []
+        self.active = None
+        self.active_state = "ok"
+        self.filter_text = ""
+        self.sort_column = 1
+        self.sort_order = Qt.AscendingOrder
+        self.name_font = QFont()
+        self.name_font.setPointSize(11)
+        self.name_font.setBold(True)
+        self.active_font = QFont()
+        self.active_font.setPointSize(16)
+
+    # -------------------- QT MODEL --------------------
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.order)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(HEADERS)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return HEADERS[section]
+        return None
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        mod = self.mods[self.order[index.row()]]
+        column = index.column()
+        if role == Qt.DisplayRole:
+            return self._text(mod, column)
+        if role == Qt.ToolTipRole and column == 0 and mod.name == self.active:
+            return ACTIVE_TIPS[self.active_state]
+        if role == Qt.FontRole:
+            if column == 0:
+                return self.active_font
+            if column == 1:
+                return self.name_font
+        if role == Qt.UserRole:
+            return mod
+        return None
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        self.sort_column, self.sort_order = column, order
+        self.beginResetModel()
+        self._rebuild(self.mods)
+        self.endResetModel()
+
+    # -------------------- ROWS --------------------
+    def _text(self, mod, column):
+        if column == 0:
+            return ACTIVE_MARKS[self.active_state] if mod.name == self.active else ""
+        if column == 1:
+            return mod.name
+        if column == 2:
+            return "\n".join(os.path.basename(p) for p in mod.patch_wads)
+        return os.path.basename(mod.music_wad) if mod.music_wad else ""
+
+    def _key(self, name):
+        return self._text(self.mods[name], self.sort_column).lower()
+
+    def _matches(self, name):
+        return self.filter_text in name.lower()
+
+    def _rebuild(self, names):
+        reverse = self.sort_order == Qt.DescendingOrder
+        self.order = sorted((n for n in names if self._matches(n)), key=self._key, reverse=reverse)
+
+    def set_mods(self, rows):
+        self.beginResetModel()
+        self.mods = {row.name: row for row in rows}
+        self._rebuild(self.mods)
+        self.endResetModel()
+
+    def add(self, row):
+        if row.name in self.mods:
+            self.mods[row.name] = row
+            if row.name in self.order:
+                i = self.order.index(row.name)
+                self.dataChanged.emit(self.index(i, 0), self.index(i, len(HEADERS) - 1))
+            return
+        self.mods[row.name] = row
+        if not self._matches(row.name):
+            return
+        key, reverse = self._key(row.name), self.sort_order == Qt.DescendingOrder
+        i = next((i for i, n in enumerate(self.order) if (self._key(n) > key) != reverse), len(self.order))
+        self.beginInsertRows(QModelIndex(), i, i)
+        self.order.insert(i, row.name)
+        self.endInsertRows()
+
+    def remove(self, name):
+        self.mods.pop(name, None)
+        if name in self.order:
+            i = self.order.index(name)
+            self.beginRemoveRows(QModelIndex(), i, i)
+            del self.order[i]
+            self.endRemoveRows()
+
+    def get(self, name):
+        return self.mods.get(name)
+
+    def mod_at(self, index):
+        return self.mods[self.order[index.row()]] if index.isValid() else None
+
+    # only the active column changes; the view re-reads just what it shows
+    def set_active(self, name, state="ok"):
+        self.active = name
+        self.active_state = state
+        if self.order:
+            self.dataChanged.emit(self.index(0, 0), self.index(len(self.order) - 1, 0))
+
+    # a longer filter can only narrow the current rows down further
+    def set_filter(self, text):
+        text = text.strip().lower()
+        narrowing = self.filter_text in text
+        self.filter_text = text
+        self.beginResetModel()
+        self._rebuild(self.order if narrowing else self.mods)
+        self.endResetModel()
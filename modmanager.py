@@ -1,66 +1,57 @@
 import sys
 import os
-import json
-import shutil
-import zipfile
 from PySide6.QtWidgets import (
     QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
-    QPushButton, QTreeWidget, QTreeWidgetItem, QMessageBox,
-    QDialog, QLabel, QLineEdit, QFileDialog, QMenu
+    QPushButton, QTreeWidget, QTreeWidgetItem, QTreeView, QMessageBox,
+    QDialog, QLabel, QLineEdit, QFileDialog, QMenu, QCheckBox, QSplitter, QComboBox, QSpinBox
 )
-from PySide6.QtCore import Qt
+from PySide6.QtCore import Qt, QTimer
 from PySide6.QtGui import QAction, QFont, QIcon, QPixmap
 
-MODS_DIR = "mods"
-CONFIG_FILE = "mods.json"
-STATE_FILE = "state.json"
-BACKUP_DIR = "backup"
+from core import GAME_MODIFIED, GAME_OK, GAME_UNKNOWN, ModCore, ModError
+from delta import content_size
+from jobs import JobManager, JobPanel
+from modlist import ModListModel, ModRow
+from package import PackageError
+from performance import PerformanceDialog
+from preview import PreviewCache, PreviewLoader, PreviewPane
+from tracing import traced
+from wad import WadError, WadReader
+
 ASSETS_DIR = "assets"
+# quiet time before the likely next mods are staged in the background
+STAGING_IDLE_MS = 3000
 icon_png = os.path.join(os.path.dirname(os.path.abspath(__file__)), ASSETS_DIR, "icon.png")
 icon_ico = os.path.join(os.path.dirname(os.path.abspath(__file__)), ASSETS_DIR, "icon.ico")
 
-def get_game_data_dir():
-    if os.name == "nt":
-        return os.path.join(os.environ["LOCALAPPDATA"], "HotlineMiami2")
-    return os.path.expanduser("~/.local/share/HotlineMiami2")
-
-GAME_DATA_DIR = get_game_data_dir()
-PATCHWAD_PATH = os.path.join(GAME_DATA_DIR, "patchwad.wad")
-PATCHWAD_MODS_DIR = os.path.join(GAME_DATA_DIR, "mods")
-
 
 class ModManager(QMainWindow):
     def __init__(self):
         super().__init__()
         self.setWindowTitle("HMMM - Vanilla")
-        self.resize(900, 500)
+        self.resize(1100, 500)
         self.setWindowIcon(QIcon(icon_png))
 
-        os.makedirs(MODS_DIR, exist_ok=True)
-        os.makedirs(PATCHWAD_MODS_DIR, exist_ok=True)
-
-        self.active_mod = None
-        self.game_music_path = None
-        self.last_folder = os.getcwd()
+        self.core = ModCore()
+        self.jobs = JobManager(self)
+        self.game_state = GAME_OK
 
-        self.load_state()
-
-        if not self.game_music_path:
+        if not self.core.game_music_path:
             self.show_welcome()
         else:
             self.init_main_ui()
 
     # -------------------- FILE PICKER --------------------
     def qt_open_file(self, title, filter_str):
-        file_path, _ = QFileDialog.getOpenFileName(self, title, self.last_folder, filter_str)
+        file_path, _ = QFileDialog.getOpenFileName(self, title, self.core.last_folder, filter_str)
         if file_path:
-            self.last_folder = os.path.dirname(file_path)
+            self.core.set_last_folder(os.path.dirname(file_path))
         return file_path or None
 
     def qt_open_files(self, title, filter_str):
-        files, _ = QFileDialog.getOpenFileNames(self, title, self.last_folder, filter_str)
+        files, _ = QFileDialog.getOpenFileNames(self, title, self.core.last_folder, filter_str)
         if files:
-            self.last_folder = os.path.dirname(files[0])
+            self.core.set_last_folder(os.path.dirname(files[0]))
         return files or []
 
     # -------------------- WELCOME --------------------
@@ -120,20 +111,11 @@ class ModManager(QMainWindow):
         file_path = self.qt_open_file("Select hlm2_music_desktop.wad", "hlm2_music_desktop.wad")
         if not file_path:
             return False
-
-        folder = os.path.dirname(file_path)
-        data_wad = os.path.join(folder, "hlm2_data_desktop.wad")
-        if not os.path.exists(data_wad):
-            QMessageBox.critical(
-                self,
-                "Error",
-                "This doesn't seem like the correct game folder.\n"
-                "Make sure you aren't just selecting a modded music WAD."
-            )
+        try:
+            self.core.set_game_music_path(file_path)
+        except ModError as e:
+            QMessageBox.critical(self, "Error", str(e))
             return False
-
-        self.game_music_path = file_path
-        self.save_state()
         return True
 
     # -------------------- MAIN UI --------------------
@@ -143,25 +125,49 @@ class ModManager(QMainWindow):
 
         layout = QVBoxLayout(central)
 
-        self.tree = QTreeWidget()
-        self.tree.setColumnCount(4)
-        self.tree.setHeaderLabels(["Active", "Mod Name", "Patch WAD(s)", "Music WAD"])
+        self.filter_input = QLineEdit()
+        self.filter_input.setPlaceholderText("Search mods...")
+        self.filter_input.setClearButtonEnabled(True)
+        layout.addWidget(self.filter_input)
+
+        self.mod_list = ModListModel(self)
+        self.filter_input.textChanged.connect(self.mod_list.set_filter)
+        self.tree = QTreeView()
+        self.tree.setModel(self.mod_list)
+        self.tree.setUniformRowHeights(True)  # lets the view skip measuring every row
         self.tree.setSortingEnabled(True)
-        self.tree.sortItems(1, Qt.AscendingOrder)
+        self.tree.sortByColumn(1, Qt.AscendingOrder)
 
         self.tree.setStyleSheet("""
-            QTreeWidget::item { height: 50px; }
-            QTreeWidget::item:selected { background-color: #444444; color: #ffffff; }
-            QTreeWidget { gridline-color: #999999; font-size: 10pt; }
+            QTreeView::item { height: 50px; }
+            QTreeView::item:selected { background-color: #444444; color: #ffffff; }
+            QTreeView { gridline-color: #999999; font-size: 10pt; }
         """)
         self.tree.setAlternatingRowColors(True)
         self.tree.setRootIsDecorated(False)  # remove expand/collapse icons
 
-        self.tree.itemDoubleClicked.connect(self.on_row_activated)
+        self.tree.doubleClicked.connect(self.on_row_activated)
         self.tree.setContextMenuPolicy(Qt.CustomContextMenu)
         self.tree.customContextMenuRequested.connect(self.show_context_menu)
 
-        layout.addWidget(self.tree)
+        # previews are built in the background for the selected and the visible rows
+        self.previews = PreviewLoader(PreviewCache(self.core.fingerprints, self.core.wad_index), self)
+        self.preview_pane = PreviewPane(self.previews)
+        self.tree.selectionModel().currentChanged.connect(
+            lambda index: self.preview_pane.show_mod(self.mod_list.mod_at(index)))
+        self.prefetch_timer = QTimer(self)
+        self.prefetch_timer.setSingleShot(True)
+        self.prefetch_timer.setInterval(150)
+        self.prefetch_timer.timeout.connect(self.prefetch_previews)
+        self.tree.verticalScrollBar().valueChanged.connect(self.prefetch_timer.start)
+        self.mod_list.modelReset.connect(self.prefetch_timer.start)
+
+        splitter = QSplitter()
+        splitter.addWidget(self.tree)
+        splitter.addWidget(self.preview_pane)
+        splitter.setStretchFactor(0, 3)
+        splitter.setStretchFactor(1, 1)
+        layout.addWidget(splitter)
 
         btn_layout = QHBoxLayout()
         install_btn = QPushButton("Install Mod")
@@ -170,41 +176,47 @@ class ModManager(QMainWindow):
         restore_btn.clicked.connect(self.on_restore_vanilla)
         import_btn = QPushButton("Import Mod Package")
         import_btn.clicked.connect(self.on_import_mod_package)
+        ingest_btn = QPushButton("Ingest Folder")
+        ingest_btn.clicked.connect(self.on_ingest_folder)
+        storage_btn = QPushButton("Storage")
+        storage_btn.clicked.connect(self.on_storage)
+        perf_btn = QPushButton("Performance")
+        perf_btn.clicked.connect(lambda: PerformanceDialog(self).exec())
         btn_layout.addWidget(install_btn)
         btn_layout.addWidget(restore_btn)
         btn_layout.addWidget(import_btn)
+        btn_layout.addWidget(ingest_btn)
+        btn_layout.addWidget(storage_btn)
+        btn_layout.addWidget(perf_btn)
         layout.addLayout(btn_layout)
 
+        self.job_panel = JobPanel(self.jobs, self.statusBar())
+        layout.addWidget(self.job_panel)
+        self.staging_job = None
+        self.staging_timer = QTimer(self)
+        self.staging_timer.setSingleShot(True)
+        self.staging_timer.setInterval(STAGING_IDLE_MS)
+        self.staging_timer.timeout.connect(self.stage_likely)
+
         self.load_mods()
+        interrupted = self.core.pending_switch() is not None
+        if interrupted:
+            self.game_state = GAME_UNKNOWN
+        else:
+            self.game_state = self.core.check_game_files(cached_only=True)
         self.update_active_column()
         self.refresh_title()
         self.show()
+        if interrupted:
+            self.resume_switch()
+        elif self.game_state == GAME_UNKNOWN:
+            self.verify_game_files()
+        self.staging_timer.start()
 
     # -------------------- ADD ROW --------------------
+    # adds the mod, or replaces the row of a mod with the same name
     def add_mod_row(self, mod_name, patch_files, music_file):
-        patch_text = "\n".join(os.path.basename(p) for p in patch_files)
-        music_text = os.path.basename(music_file) if music_file else ""
-
-        item = QTreeWidgetItem(["", mod_name, patch_text, music_text])
-        item.setFlags(Qt.ItemIsEnabled | Qt.ItemIsSelectable)
-
-        # store full paths for internal use
-        item.setData(2, Qt.UserRole, ";".join(patch_files))
-        item.setData(3, Qt.UserRole, music_file)
-
-        # fonts
-        font_name = item.font(1)
-        font_name.setPointSize(11)
-        font_name.setBold(True)
-        item.setFont(1, font_name)
-        font_active = item.font(0)
-        font_active.setPointSize(16)
-        item.setFont(0, font_active)
-
-        # add to tree
-        self.tree.addTopLevelItem(item)
-        self.update_active_column()
-
+        self.mod_list.add(ModRow(mod_name, list(patch_files), music_file or ""))
 
     # -------------------- INSTALL MOD --------------------
     def on_install_mod(self):
@@ -242,6 +254,8 @@ class ModManager(QMainWindow):
 
         def remove_selected():
             for item_sel in file_list.selectedItems():
+                if item_sel.parent() is not None:
+                    continue
                 name = item_sel.text(0)
                 for f in selected_files[:]:
                     if os.path.basename(f) == name:
@@ -255,6 +269,10 @@ class ModManager(QMainWindow):
         add_btn.clicked.connect(add_files)
         remove_btn.clicked.connect(remove_selected)
 
+        delta_check = QCheckBox("Store music WAD as a delta against vanilla (saves space)")
+        delta_check.setChecked(self.core.delta_music)
+        layout.addWidget(delta_check)
+
         btn_row = QHBoxLayout()
         ok_btn = QPushButton("OK")
         cancel_btn = QPushButton("Cancel")
@@ -265,33 +283,28 @@ class ModManager(QMainWindow):
 
         def on_ok():
             mod_name = mod_name_input.text().strip()
-            if not mod_name:
-                QMessageBox.warning(self, "Error", "Mod name cannot be empty.")
+            try:
+                self.core.check_new_name(mod_name)
+                self.core.split_files(selected_files)
+            except ModError as e:
+                QMessageBox.warning(self, "Error", str(e))
                 return
 
-            music_wads = [f for f in selected_files if f.lower().endswith(".wad")]
-            if len(music_wads) > 1:
-                QMessageBox.warning(self, "Error", "Only one music .wad allowed.")
-                return
+            files, as_delta = list(selected_files), delta_check.isChecked()
 
-            mod_folder = os.path.join(MODS_DIR, mod_name)
-            os.makedirs(mod_folder, exist_ok=True)
+            def done(result):
+                self.add_mod_row(mod_name, *result)
 
-            patch_wads = [f for f in selected_files if f.lower().endswith(".patchwad")]
-            copied_patch_files = [self._copy_wad(p, mod_folder) for p in patch_wads]
-            copied_music_file = self._copy_wad(music_wads[0], mod_folder) if music_wads else ""
-
-            self.add_mod_row(mod_name, copied_patch_files, copied_music_file)
-            self.save_mods()
+            self.run_job(f"Installing {mod_name}",
+                         lambda job: self.core.install_mod(mod_name, files, as_delta, job), done)
             dialog.accept()
 
         ok_btn.clicked.connect(on_ok)
         dialog.exec()
 
     # -------------------- EDIT MOD --------------------
-    def on_edit_mod(self, item):
-        mod_name = item.text(1)
-        mod_folder = os.path.join(MODS_DIR, mod_name)
+    def on_edit_mod(self, mod_name):
+        mod_folder = self.core.mod_folder(mod_name)
 
         dialog = QDialog(self)
         dialog.setWindowTitle(f"Edit Mod - {mod_name}")
@@ -304,8 +317,9 @@ class ModManager(QMainWindow):
 
         layout.addWidget(QLabel("Files in Mod:"))
         file_list = QTreeWidget()
-        file_list.setColumnCount(1)
-        file_list.setHeaderLabels(["File"])
+        file_list.setColumnCount(2)
+        file_list.setHeaderLabels(["File", "Size"])
+        file_list.setColumnWidth(0, 340)
         layout.addWidget(file_list)
 
         selected_files = [os.path.join(mod_folder, f) for f in os.listdir(mod_folder)]
@@ -313,29 +327,62 @@ class ModManager(QMainWindow):
         def refresh_list():
             file_list.clear()
             for f in selected_files:
-                file_list.addTopLevelItem(QTreeWidgetItem([os.path.basename(f)]))
+                file_item = QTreeWidgetItem([os.path.basename(f), f"{content_size(f) / 1e6:.1f} MB"])
+                file_list.addTopLevelItem(file_item)
+                # only the WAD's table is read; payloads stay on disk
+                try:
+                    with WadReader(f, self.core.wad_index) as reader:
+                        for entry in reader.entries:
+                            file_item.addChild(QTreeWidgetItem([entry.name, f"{entry.size / 1e3:.1f} KB"]))
+                except (OSError, WadError):
+                    pass
 
         refresh_list()
 
+        # the dialog waits for its changes to the mod folder, see run_mod_job()
+        def run_edit(title, work, on_done):
+            def done(result):
+                dialog.setEnabled(True)
+                on_done(result)
+
+            dialog.setEnabled(False)
+            self.run_mod_job(title, work, done, lambda: dialog.setEnabled(True))
+
         def add_files():
-            nonlocal selected_files
-            files = self.qt_open_files("Add WAD Files", "WAD Files (*.wad *.patchwad)")
-            for f in files:
-                if f.lower().endswith(".wad") and any(x.lower().endswith(".wad") for x in selected_files):
+            files = []
+            has_music = any(x.lower().endswith(".wad") for x in selected_files)
+            for f in self.qt_open_files("Add WAD Files", "WAD Files (*.wad *.patchwad)"):
+                if f.lower().endswith(".wad") and has_music:
                     QMessageBox.warning(self, "Error", "Only one music .wad allowed.")
                     continue
-                copied = self._copy_wad(f, mod_folder)
-                selected_files.append(copied)
-            refresh_list()
+                has_music |= f.lower().endswith(".wad")
+                files.append(f)
+            if not files:
+                return
+
+            def work(job):
+                # progress sees each file twice, see BlobStore.install()
+                job.set_total(2 * sum(os.path.getsize(f) for f in files))
+                return [self.core.copy_wad(f, mod_folder, job.report) for f in files]
+
+            def done(copied):
+                selected_files.extend(copied)
+                refresh_list()
+
+            run_edit(f"Adding files to {mod_name}", work, done)
 
         def remove_selected():
-            for item_sel in file_list.selectedItems():
-                name = item_sel.text(0)
-                for f in selected_files[:]:
-                    if os.path.basename(f) == name:
-                        os.remove(f)
-                        selected_files.remove(f)
-            refresh_list()
+            names = {item_sel.text(0) for item_sel in file_list.selectedItems() if item_sel.parent() is None}
+            removed = [f for f in selected_files if os.path.basename(f) in names]
+            if not removed:
+                return
+
+            def done(_):
+                for f in removed:
+                    selected_files.remove(f)
+                refresh_list()
+
+            run_edit(f"Removing files from {mod_name}", lambda job: self.core.remove_files(removed), done)
 
         add_btn = QPushButton("Add Files")
         remove_btn = QPushButton("Remove Selected")
@@ -358,60 +405,112 @@ class ModManager(QMainWindow):
                 QMessageBox.warning(self, "Error", "Mod name cannot be empty.")
                 return
 
-            current_folder = os.path.join(MODS_DIR, mod_name)
-            new_folder = os.path.join(MODS_DIR, new_name)
-            if new_name != mod_name:
-                if os.path.exists(new_folder):
-                    QMessageBox.warning(self, "Error", "A mod with that name already exists.")
-                    return
-                os.rename(current_folder, new_folder)
-                mod_name_local = new_name
-            else:
-                mod_name_local = mod_name
+            def done(result):
+                if new_name != mod_name:
+                    self.mod_list.remove(mod_name)
+                self.add_mod_row(new_name, *result)
+                self.update_active_column()
+                self.refresh_title()
+                dialog.accept()
 
-            patch_files = [f for f in selected_files if f.lower().endswith(".patchwad")]
-            music_files = [f for f in selected_files if f.lower().endswith(".wad")]
+            files = list(selected_files)
+            run_edit(f"Saving {mod_name}", lambda job: self.core.update_mod(mod_name, new_name, files), done)
 
-            item.setData(2, Qt.UserRole, "; ".join(patch_files))
-            item.setData(3, Qt.UserRole, music_files[0] if music_files else "")
+        ok_btn.clicked.connect(save_changes)
+        dialog.exec()
 
-            item.setText(1, new_name)
-            self.tree.takeTopLevelItem(self.tree.indexOfTopLevelItem(item))
-            self.add_mod_row(new_name, patch_files, music_files[0] if music_files else "")
+    # -------------------- COMPOSE MUSIC --------------------
+    def on_compose_music(self, mod_name):
+        try:
+            base, options = self.core.track_options(mod_name)
+        except (OSError, WadError) as e:
+            QMessageBox.critical(self, "Error", f"Failed to read the music WADs:\n{e}")
+            return
+        if not options:
+            QMessageBox.information(self, "Compose Music", "No other music WADs to take tracks from.")
+            return
+        choices = self.core.music_tracks(mod_name)
 
-            if self.active_mod == mod_name:
-                self.active_mod = new_name
-                self.refresh_title()
+        dialog = QDialog(self)
+        dialog.setWindowTitle(f"Compose Music - {mod_name}")
+        dialog.resize(600, 500)
+        layout = QVBoxLayout(dialog)
+        layout.addWidget(QLabel("Pick where each track comes from:"))
+        track_list = QTreeWidget()
+        track_list.setColumnCount(2)
+        track_list.setHeaderLabels(["Track", "Source"])
+        track_list.setColumnWidth(0, 300)
+        layout.addWidget(track_list)
+
+        combos = {}
+        for track in base + sorted(t for t in options if t not in base):
+            item = QTreeWidgetItem([track])
+            track_list.addTopLevelItem(item)
+            combo = QComboBox()
+            # None keeps the track as the mod has it (or leaves it out)
+            combo.addItem("Mod's own" if track in base else "Not included", None)
+            for source in options.get(track, []):
+                combo.addItem(source or "Vanilla", source)
+            index = combo.findData(choices[track]) if track in choices else 0
+            combo.setCurrentIndex(max(index, 0))
+            track_list.setItemWidget(item, 1, combo)
+            combos[track] = combo
+
+        btn_row = QHBoxLayout()
+        ok_btn = QPushButton("OK")
+        cancel_btn = QPushButton("Cancel")
+        btn_row.addWidget(ok_btn)
+        btn_row.addWidget(cancel_btn)
+        layout.addLayout(btn_row)
+        cancel_btn.clicked.connect(dialog.reject)
 
-            self.save_mods()
+        def save_choices():
+            picked = {track: combo.currentData() for track, combo in combos.items()
+                      if combo.currentData() is not None}
+            try:
+                self.core.set_music_tracks(mod_name, picked)
+            except ModError as e:
+                QMessageBox.warning(self, "Error", str(e))
+                return
             dialog.accept()
+            if mod_name == self.core.active_mod:
+                self.activate_mod(mod_name)
 
-        ok_btn.clicked.connect(save_changes)
+        ok_btn.clicked.connect(save_choices)
         dialog.exec()
 
     # -------------------- DELETE / EXPORT --------------------
-    def on_delete_mod(self, item):
-        mod_name = item.text(1)
+    def on_delete_mod(self, mod_name):
         confirm = QMessageBox.question(self, "Confirm", f"Delete mod '{mod_name}'?")
         if confirm == QMessageBox.Yes:
-            if mod_name == self.active_mod:
-                self._restore_vanilla_silent()
-            shutil.rmtree(os.path.join(MODS_DIR, mod_name), ignore_errors=True)
-            self.tree.takeTopLevelItem(self.tree.indexOfTopLevelItem(item))
-            self.save_mods()
-
-    def on_export_mod_package(self, item):
-        mod_name = item.text(1)
-        mod_folder = os.path.join(MODS_DIR, mod_name)
-        save_path = QFileDialog.getSaveFileName(self, "Export Mod Package", f"{mod_name}.zip", "*.zip")[0]
+            # whether it is active is only known once the switches before it are done
+            def done(_):
+                self.mod_list.remove(mod_name)
+                self.update_active_column()
+                self.refresh_title()
+
+            self.run_mod_job(f"Deleting {mod_name}", lambda job: self.core.delete_mod(mod_name, job), done,
+                             cancellable=False)
+
+    def on_export_mod_package(self, mod_name, delta=False):
+        base_path = None
+        if delta:
+            base_path = self.qt_open_file("Select the package to build the delta against", "*.zip")
+            if not base_path:
+                return
+        default_name = f"{mod_name}-delta.zip" if delta else f"{mod_name}.zip"
+        save_path = QFileDialog.getSaveFileName(self, "Export Mod Package", default_name, "*.zip")[0]
         if not save_path:
             return
-        with zipfile.ZipFile(save_path, "w") as zipf:
-            for root, _, files in os.walk(mod_folder):
-                for f in files:
-                    fp = os.path.join(root, f)
-                    arcname = os.path.relpath(fp, MODS_DIR)
-                    zipf.write(fp, arcname)
+
+        def done(stats):
+            self.statusBar().showMessage(
+                f"Exported '{mod_name}': {stats['bytes_out'] / 1e6:.1f} MB "
+                f"({stats['ratio']:.0%} of original) at {stats['mb_per_s']:.0f} MB/s"
+            )
+
+        self.run_job(f"Exporting {mod_name}",
+                     lambda job: self.core.export_mod(mod_name, save_path, base_path, job), done)
 
     # -------------------- IMPORT MOD PACKAGE --------------------
     def on_import_mod_package(self):
@@ -419,164 +518,301 @@ class ModManager(QMainWindow):
         if not zip_path:
             return
         try:
-            with zipfile.ZipFile(zip_path, "r") as zipf:
-                root_folders = {name.split("/")[0] for name in zipf.namelist() if "/" in name}
-                if not root_folders:
-                    QMessageBox.warning(self, "Error", "Invalid mod package structure.")
+            existing = self.core.import_conflicts(zip_path)
+            if existing:
+                confirm = QMessageBox.question(self, "Confirm", f"Update existing mod(s): {', '.join(existing)}?")
+                if confirm != QMessageBox.Yes:
                     return
-                mod_name = list(root_folders)[0]
-                dest = os.path.join(MODS_DIR, mod_name)
-                if os.path.exists(dest):
-                    QMessageBox.warning(self, "Error", "Mod already exists.")
-                    return
-                zipf.extractall(MODS_DIR)
+        except PackageError as e:
+            QMessageBox.warning(self, "Error", str(e))
+            return
+        except Exception as e:
+            QMessageBox.critical(self, "Error", f"Failed to install mod package:\n{str(e)}")
+            return
 
-            patch_wads, music_wad = [], ""
-            for root, _, files in os.walk(dest):
-                for f in files:
-                    fp = os.path.join(root, f)
-                    if f.endswith(".patchwad"):
-                        patch_wads.append(fp)
-                    elif f.endswith(".wad"):
-                        music_wad = fp
+        def done(mods):
+            for mod_name, patch_wads, music_wad in mods:
+                self.add_mod_row(mod_name, patch_wads, music_wad)
+            names = ", ".join(f"'{name}'" for name, _, _ in mods)
+            QMessageBox.information(self, "Success", f"Mod {names} installed successfully.")
 
-            self.add_mod_row(mod_name, patch_wads, music_wad)
-            self.save_mods()
-            QMessageBox.information(self, "Success", f"Mod '{mod_name}' installed successfully.")
+        self.run_mod_job(f"Importing {os.path.basename(zip_path)}",
+                         lambda job: self.core.import_package(zip_path, job), done)
 
-        except Exception as e:
-            QMessageBox.critical(self, "Error", f"Failed to install mod package:\n{str(e)}")
+    # -------------------- INGEST FOLDER --------------------
+    def on_ingest_folder(self):
+        folder = QFileDialog.getExistingDirectory(self, "Select Folder With Mods", self.core.last_folder)
+        if not folder:
+            return
+        self.core.set_last_folder(folder)
+
+        def done(result):
+            self.load_mods()
+            lines = [f"{len(result['mods'])} mod(s) installed or updated, {len(result['unchanged'])} unchanged."]
+            lines += [f"Skipped {folder}: {reason}" for folder, reason in result["skipped"].items()]
+            QMessageBox.information(self, "Success", "\n".join(lines))
+
+        self.run_mod_job(f"Ingesting {os.path.basename(folder)}", lambda job: self.core.ingest_folder(folder, job),
+                         done)
 
     # -------------------- CONTEXT MENU --------------------
     def show_context_menu(self, pos):
-        item = self.tree.itemAt(pos)
-        if not item:
+        mod = self.mod_list.mod_at(self.tree.indexAt(pos))
+        if not mod:
             return
         menu = QMenu(self)
         edit_action = QAction("Edit", self)
         delete_action = QAction("Delete", self)
         export_action = QAction("Export Mod Package", self)
-        edit_action.triggered.connect(lambda: self.on_edit_mod(item))
-        delete_action.triggered.connect(lambda: self.on_delete_mod(item))
-        export_action.triggered.connect(lambda: self.on_export_mod_package(item))
+        edit_action.triggered.connect(lambda: self.on_edit_mod(mod.name))
+        delete_action.triggered.connect(lambda: self.on_delete_mod(mod.name))
+        export_action.triggered.connect(lambda: self.on_export_mod_package(mod.name))
         menu.addAction(edit_action)
         menu.addAction(delete_action)
         menu.addAction(export_action)
+        delta_action = QAction("Export Delta Package", self)
+        delta_action.triggered.connect(lambda: self.on_export_mod_package(mod.name, delta=True))
+        menu.addAction(delta_action)
+        compose_action = QAction("Compose Music...", self)
+        compose_action.triggered.connect(lambda: self.on_compose_music(mod.name))
+        menu.addAction(compose_action)
+        pin_action = QAction("Keep Staged for Instant Switching", self)
+        pin_action.setCheckable(True)
+        pin_action.setChecked(mod.name in self.core.staged_pins)
+        pin_action.toggled.connect(lambda pinned: self.on_toggle_staged_pin(mod.name, pinned))
+        menu.addAction(pin_action)
         menu.exec(self.tree.viewport().mapToGlobal(pos))
 
     # -------------------- ACTIVATE --------------------
-    def on_row_activated(self, item):
-        mod_name = item.text(1)
-        patch_wads = item.data(2, Qt.UserRole)
-        music_wad = item.data(3, Qt.UserRole)
-        patch_list = patch_wads.split("; ") if patch_wads else []
-        if self.active_mod == mod_name:
+    def on_row_activated(self, index):
+        mod = self.mod_list.mod_at(index)
+        if not mod or (self.core.active_mod == mod.name and self.game_state == GAME_OK):
             return
-        self._restore_vanilla_silent()
-        self.activate_mod(mod_name, patch_list, music_wad)
-
-    def activate_mod(self, mod_name, patch_wads, music_wad):
-        self.backup_vanilla()
-        for patch in patch_wads:
-            if patch and os.path.exists(patch):
-                shutil.copy2(patch, PATCHWAD_PATH)
-        if music_wad and os.path.exists(music_wad):
-            shutil.copy2(music_wad, self.game_music_path)
-        self.active_mod = mod_name
-        self.update_active_column()
-        self.save_state()
-        self.refresh_title()
+        # goes straight from the current mod to the new one, no vanilla round-trip
+        self.activate_mod(mod.name)
+
+    def activate_mod(self, mod_name):
+        def done(result):
+            written, note = result
+            self.game_state = GAME_OK
+            self.update_active_column()
+            self.refresh_title()
+            self.statusBar().showMessage(f"Activated '{mod_name}' ({written / 1e6:.1f} MB written{note})")
+            if self.core.hot_budget is not None:
+                self.rebalance_tiers()
+            self.staging_timer.start()
+
+        self.cancel_staging()
+        # switches must not interleave, and stopping one halfway helps nobody
+        self.run_job(f"Activating {mod_name}", lambda job: self.core.activate(mod_name, job), done,
+                     lane="game", cancellable=False)
+
+    # -------------------- STORAGE --------------------
+    # compresses the mods that fell out of the hot budget; runs in the game
+    # lane so no switch reads a mod file while it is being swapped
+    def rebalance_tiers(self):
+        def done(result):
+            parts = []
+            if result["frozen"]:
+                parts.append(f"compressed {len(result['frozen'])} mods, {result['freed'] / 1e6:.1f} MB freed")
+            if result["thawed"]:
+                parts.append(f"decompressed {len(result['thawed'])} mods")
+            if parts:
+                self.statusBar().showMessage("Storage: " + ", ".join(parts))
+
+        self.run_job("Compressing unused mods", self.core.rebalance_tiers, done, lane="game")
+
+    def on_storage(self):
+        tiers = self.core.mod_tiers()
+        hot = sum(h for h, _ in tiers.values())
+        cold = sum(c for _, c in tiers.values())
+        cold_mods = sum(1 for _, c in tiers.values() if c)
+
+        dialog = QDialog(self)
+        dialog.setWindowTitle("Storage")
+        layout = QVBoxLayout(dialog)
+        layout.addWidget(QLabel(
+            f"Uncompressed mod files: {hot / 1e9:.2f} GB\n"
+            f"Compressed mod files: {cold / 1e9:.2f} GB in {cold_mods} mods"))
+        limit_check = QCheckBox("Compress the least recently used mods beyond")
+        layout.addWidget(limit_check)
+        budget_input = QSpinBox()
+        budget_input.setRange(0, 1 << 20)
+        budget_input.setSuffix(" MB")
+        budget_input.setValue((self.core.hot_budget or hot) // 1000000)
+        layout.addWidget(budget_input)
+        limit_check.toggled.connect(budget_input.setEnabled)
+        limit_check.setChecked(self.core.hot_budget is not None)
+        budget_input.setEnabled(limit_check.isChecked())
+        layout.addWidget(QLabel("Compressed mods take a little longer to activate."))
+
+        staged = sum(size for _, _, size in self.core.staging.entries(
+            [game_file for game_file, _ in self.core.vanilla_files()]))
+        layout.addWidget(QLabel(
+            f"Copies kept next to the game files for instant switching: {staged / 1e9:.2f} GB, at most"))
+        staging_input = QSpinBox()
+        staging_input.setRange(0, 1 << 20)
+        staging_input.setSuffix(" MB")
+        staging_input.setSpecialValueText("Off")
+        staging_input.setValue(self.core.staging.budget // 1000000)
+        layout.addWidget(staging_input)
+
+        btn_row = QHBoxLayout()
+        ok_btn = QPushButton("OK")
+        cancel_btn = QPushButton("Cancel")
+        btn_row.addWidget(ok_btn)
+        btn_row.addWidget(cancel_btn)
+        layout.addLayout(btn_row)
+        ok_btn.clicked.connect(dialog.accept)
+        cancel_btn.clicked.connect(dialog.reject)
+        if not dialog.exec():
+            return
+        staging_budget = staging_input.value() * 1000000
+        if staging_budget != self.core.staging.budget:
+            self.core.set_staging_budget(staging_budget)
+            self.staging_timer.start()
+        budget = budget_input.value() * 1000000 if limit_check.isChecked() else None
+        if budget == self.core.hot_budget:
+            return
+        self.core.set_hot_budget(budget)
+        # lifting the limit decompresses everything again
+        if budget is not None or cold:
+            self.rebalance_tiers()
+
+    # Copies the game files of the pinned and recent mods next to the game
+    # files once nothing else is going on. It waits its turn in the game lane
+    # and gives way to any switch the user starts.
+    def stage_likely(self):
+        if self.staging_job or self.jobs.jobs:
+            self.staging_timer.start()
+            return
+
+        def done(written):
+            self.staging_job = None
+            if written:
+                self.statusBar().showMessage(f"Staged the likely next mods ({written / 1e6:.1f} MB)")
+
+        def failed(message):
+            self.staging_job = None
+            self.statusBar().showMessage(f"Staging failed: {message}")
+
+        def cancelled():
+            self.staging_job = None
+
+        self.staging_job = self.jobs.submit("Staging likely mods", self.core.stage_likely, done, failed, cancelled,
+                                            lane="game")
+
+    def cancel_staging(self):
+        self.staging_timer.stop()
+        if self.staging_job:
+            self.staging_job.cancel()
 
-    # -------------------- BACKUP / RESTORE --------------------
-    def backup_vanilla(self):
-        os.makedirs(BACKUP_DIR, exist_ok=True)
-        music_backup = os.path.join(BACKUP_DIR, "hlm2_music_desktop.wad")
-        patch_backup = os.path.join(BACKUP_DIR, "patchwad.wad")
-        if self.game_music_path and not os.path.exists(music_backup):
-            shutil.copy2(self.game_music_path, music_backup)
-        if os.path.exists(PATCHWAD_PATH) and not os.path.exists(patch_backup):
-            shutil.copy2(PATCHWAD_PATH, patch_backup)
+    def on_toggle_staged_pin(self, mod_name, pinned):
+        self.core.set_staged_pin(mod_name, pinned)
+        if pinned:
+            self.staging_timer.start()
 
+    # -------------------- RESTORE --------------------
     def _restore_vanilla_silent(self):
-        music_backup = os.path.join(BACKUP_DIR, "hlm2_music_desktop.wad")
-        patch_backup = os.path.join(BACKUP_DIR, "patchwad.wad")
-        if self.game_music_path and os.path.exists(music_backup):
-            shutil.copy2(music_backup, self.game_music_path)
-        if os.path.exists(patch_backup):
-            shutil.copy2(patch_backup, PATCHWAD_PATH)
-        self.active_mod = None
-        self.update_active_column()
-        self.save_state()
-        self.refresh_title()
+        def done(written):
+            self.game_state = GAME_OK
+            self.update_active_column()
+            self.refresh_title()
+            self.statusBar().showMessage(f"Restored vanilla ({written / 1e6:.1f} MB written)")
+            self.staging_timer.start()
+
+        self.cancel_staging()
+        self.run_job("Restoring vanilla", self.core.restore, done, lane="game", cancellable=False)
 
     def on_restore_vanilla(self):
         confirm = QMessageBox.question(self, "Confirm", "Restore vanilla game files?")
         if confirm == QMessageBox.Yes:
             self._restore_vanilla_silent()
 
-    # -------------------- SAVE / LOAD --------------------
-    def save_mods(self):
-        data = []
-        for i in range(self.tree.topLevelItemCount()):
-            item = self.tree.topLevelItem(i)
-            data.append({
-                "mod_name": item.text(1),
-                "patch_wads": item.data(2, Qt.UserRole),
-                "music_wad": item.data(3, Qt.UserRole)
-            })
-        with open(CONFIG_FILE, "w") as f:
-            json.dump(data, f)
+    # the last run was killed in the middle of switching the game files
+    def resume_switch(self):
+        def done(result):
+            mod_name, written = result
+            self.game_state = GAME_OK
+            self.update_active_column()
+            self.refresh_title()
+            target = f"'{mod_name}'" if mod_name else "vanilla"
+            self.statusBar().showMessage(
+                f"Finished the interrupted switch to {target} ({written / 1e6:.1f} MB written)")
+
+        self.run_job("Finishing interrupted switch", self.core.resume_switch, done, lane="game", cancellable=False)
+
+    # hashes the game files whose fingerprints went stale since the last run
+    def verify_game_files(self):
+        def done(state):
+            self.game_state = state
+            self.update_active_column()
+            if state == GAME_MODIFIED:
+                self.statusBar().showMessage(
+                    f"The game files no longer match '{self.core.active_mod}'. Double click it to activate it again.")
+
+        self.run_job("Verifying game files", self.core.check_game_files, done, lane="game")
+
+    # -------------------- PREVIEW --------------------
+    @traced("ui.prefetch_previews", "ui")
+    def prefetch_previews(self):
+        viewport = self.tree.viewport()
+        first = self.tree.indexAt(viewport.rect().topLeft())
+        if not first.isValid():
+            return
+        last = self.tree.indexAt(viewport.rect().bottomLeft())
+        end = last.row() if last.isValid() else self.mod_list.rowCount() - 1
+        self.previews.prefetch([self.mod_list.mod_at(self.mod_list.index(row, 0))
+                                for row in range(first.row(), end + 1)])
 
+    # -------------------- LOAD --------------------
+    @traced("ui.load_mods", "ui")
     def load_mods(self):
-        if not os.path.exists(CONFIG_FILE):
-            return
-        with open(CONFIG_FILE, "r") as f:
-            data = json.load(f)
-        for mod in data:
-            patch_files = mod.get("patch_wads", "").split("; ") if mod.get("patch_wads") else []
-            music_file = mod.get("music_wad", "")
-            self.add_mod_row(mod.get("mod_name", ""), patch_files, music_file)
-
-    def save_state(self):
-        with open(STATE_FILE, "w") as f:
-            json.dump({
-                "active_mod": self.active_mod,
-                "game_music_path": self.game_music_path,
-                "last_folder": self.last_folder
-            }, f)
-
-    def load_state(self):
-        if not os.path.exists(STATE_FILE):
-            return
-        with open(STATE_FILE, "r") as f:
-            state = json.load(f)
-        self.active_mod = state.get("active_mod")
-        self.game_music_path = state.get("game_music_path")
-        self.last_folder = state.get("last_folder", os.getcwd())
+        self.mod_list.set_mods([ModRow(*mod) for mod in self.core.mods()])
 
+    @traced("ui.refresh_title", "ui")
     def refresh_title(self):
-        if self.active_mod:
-            self.setWindowTitle(f"HMMM - Active: {self.active_mod}")
+        if self.core.active_mod:
+            self.setWindowTitle(f"HMMM - Active: {self.core.active_mod}")
         else:
             self.setWindowTitle("HMMM - Vanilla")
 
+    @traced("ui.update_active_column", "ui")
     def update_active_column(self):
-        for i in range(self.tree.topLevelItemCount()):
-            item = self.tree.topLevelItem(i)
-            item.setText(0, "✅" if item.text(1) == self.active_mod else "")
-
-    def _copy_wad(self, src_path, dest_dir):
-        if not src_path:
-            return ""
-        file_name = os.path.basename(src_path)
-        base, ext = os.path.splitext(file_name)
-        dest_path = os.path.join(dest_dir, file_name)
-        counter = 1
-        while os.path.exists(dest_path):
-            dest_path = os.path.join(dest_dir, f"{base}_{counter}{ext}")
-            counter += 1
-        shutil.copy2(src_path, dest_path)
-        return dest_path
+        self.mod_list.set_active(self.core.active_mod, self.game_state)
+
+    # -------------------- JOBS --------------------
+    def run_job(self, title, work, on_done=None, on_cleanup=None, lane=None, cancellable=True):
+        def on_error(message):
+            if on_cleanup:
+                on_cleanup()
+            QMessageBox.critical(self, "Error", f"{title} failed:\n{message}")
+
+        return self.jobs.submit(title, work, on_done, on_error, on_cleanup, lane, cancellable)
+
+    # Jobs that change mod folders wait in the game lane, behind any switch
+    # still reading the mod's files. Idle staging gives way to them and
+    # starts over once they are done.
+    def run_mod_job(self, title, work, on_done=None, on_cleanup=None, cancellable=True):
+        def done(result):
+            self.staging_timer.start()
+            if on_done:
+                on_done(result)
+
+        def cleanup():
+            self.staging_timer.start()
+            if on_cleanup:
+                on_cleanup()
+
+        self.cancel_staging()
+        return self.run_job(title, work, done, cleanup, "game", cancellable)
+
+    def closeEvent(self, event):
+        self.jobs.cancel_all()
+        self.jobs.wait()
+        if hasattr(self, "previews"):
+            self.previews.wait()
+        super().closeEvent(event)
 
 
 if __name__ == "__main__":
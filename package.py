@@ -0,0 +1,474 @@
+import json
+import os
+import re
+import shutil
+import struct
+import threading
+import time
+import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+
+from delta import DELTA_SUFFIX, content_size, open_content
+from hashing import TreeHasher
+
+MAX_PACKAGE_SIZE = 32 << 30
+MAX_RATIO = 100
+BOMB_MIN_SIZE = 64 << 20
+IMPORT_WORKERS = min(8, os.cpu_count() or 1)
+PACKAGE_FORMAT = 2
+MANIFEST_NAME = "hmmm-package.json"
+HEX_DIGEST = re.compile(r"[0-9a-f]{64}")
+
+
+class PackageError(ValueError):
+    pass
+
+
+# -------------------- VALIDATION --------------------
+def safe_parts(name):
+    parts = name.split("/")
+    if name.startswith("/") or "\\" in name or ":" in parts[0] or any(p in ("", ".", "..") for p in parts):
+        raise PackageError(f"Unsafe path in package: {name}")
+    return parts
+
+
+# Everything is checked against the central directory before a single byte is
+# written. Member streams are capped at their declared size, so bounding the
+# declared sizes bounds what can end up on disk.
+def check_members(zipf):
+    members = [m for m in zipf.infolist() if not m.is_dir()]
+    total = 0
+    for m in members:
+        safe_parts(m.filename)
+        if len(m.filename.split("/")) < 2 and m.filename != MANIFEST_NAME:
+            raise PackageError("Invalid mod package structure.")
+        if m.flag_bits & 0x1:
+            raise PackageError(f"Encrypted member: {m.filename}")
+        if m.file_size > BOMB_MIN_SIZE and m.file_size > m.compress_size * MAX_RATIO:
+            raise PackageError(f"Suspicious compression ratio: {m.filename}")
+        total += m.file_size
+    if total > MAX_PACKAGE_SIZE:
+        raise PackageError("Package is too large.")
+    if not members:
+        raise PackageError("Invalid mod package structure.")
+    return members
+
+
+def read_manifest(zipf):
+    if MANIFEST_NAME not in zipf.NameToInfo:
+        return None
+    manifest = json.loads(zipf.read(MANIFEST_NAME))
+    if manifest.get("format", 0) > PACKAGE_FORMAT:
+        raise PackageError("This package needs a newer version of HMMM.")
+    members = manifest.setdefault("members", {})
+    for mod in manifest["mods"]:
+        safe_parts(mod["name"])
+        for entry in mod["files"]:
+            safe_parts(entry["name"])
+            if not HEX_DIGEST.fullmatch(entry["digest"]):
+                raise PackageError(f"Bad digest for {entry['name']}")
+    for digest, member in members.items():
+        if member not in zipf.NameToInfo:
+            raise PackageError(f"Missing member: {member}")
+    return manifest
+
+
+def package_mods(zip_path):
+    with zipfile.ZipFile(zip_path, "r") as zipf:
+        members = check_members(zipf)
+        manifest = read_manifest(zipf)
+    if manifest:
+        return sorted(mod["name"] for mod in manifest["mods"])
+    return sorted({m.filename.split("/")[0] for m in members})
+
+
+def package_format(zip_path):
+    with zipfile.ZipFile(zip_path, "r") as zipf:
+        manifest = read_manifest(zipf)
+    return manifest["format"] if manifest else 1
+
+
+# Total of what import_package() will report through its progress callback.
+def import_size(zip_path):
+    with zipfile.ZipFile(zip_path, "r") as zipf:
+        manifest = read_manifest(zipf)
+        if manifest:
+            return sum(entry["size"] for mod in manifest["mods"] for entry in mod["files"])
+        return sum(m.file_size for m in zipf.infolist() if not m.is_dir())
+
+
+# -------------------- IMPORT --------------------
+class ZipReaders:
+    # ZipFile handles are not safe to share, so every worker opens its own
+    def __init__(self, zip_path):
+        self.zip_path = zip_path
+        self.local = threading.local()
+        self.handles = []
+
+    def get(self):
+        if not hasattr(self.local, "zipf"):
+            self.local.zipf = zipfile.ZipFile(self.zip_path, "r")
+            self.handles.append(self.local.zipf)
+        return self.local.zipf
+
+    def close(self):
+        for zipf in self.handles:
+            zipf.close()
+
+
+# Members are streamed into the blob store by a thread pool (zlib, blake2b and
+# file I/O all release the GIL).
+def run_parallel(fn, items):
+    with ThreadPoolExecutor(IMPORT_WORKERS) as pool:
+        futures = [pool.submit(fn, item) for item in items]
+        done, pending = wait(futures, return_when=FIRST_EXCEPTION)
+        for future in pending:
+            future.cancel()
+        for future in done:
+            if future.exception():
+                raise future.exception()
+        return [f.result() for f in futures]
+
+
+def group_files(mods):
+    result = []
+    for name, paths in sorted(mods.items()):
+        patch_wads = [p for p in paths if p.endswith(".patchwad")]
+        music_wads = [p for p in paths if p.endswith(".wad")]
+        result.append((name, patch_wads, music_wads[-1] if music_wads else ""))
+    return result
+
+
+def member_digest(zipf, member):
+    hasher = TreeHasher()
+    with zipf.open(member) as f:
+        while True:
+            data = f.read(1 << 20)
+            if not data:
+                break
+            hasher.update(data)
+    return hasher.hexdigest()
+
+
+# Returns [(mod_name, patch_wads, music_wad)].
+def import_package(zip_path, mods_dir, store, progress=None):
+    with zipfile.ZipFile(zip_path, "r") as zipf:
+        members = check_members(zipf)
+        manifest = read_manifest(zipf)
+    if manifest:
+        return import_v2(zip_path, manifest, mods_dir, store, progress)
+    for mod_name in {m.filename.split("/")[0] for m in members}:
+        if os.path.exists(os.path.join(mods_dir, mod_name)):
+            raise PackageError(f"Mod '{mod_name}' already exists.")
+    if sum(m.file_size for m in members) > shutil.disk_usage(mods_dir).free:
+        raise PackageError("Not enough free disk space for this package.")
+
+    readers = ZipReaders(zip_path)
+
+    def extract(member):
+        target = os.path.join(mods_dir, *safe_parts(member.filename))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # A blob with the same size and CRC-32 is only a candidate: CRC-32 is
+        # easy to collide, so the member is hashed before it is linked. That
+        # still saves writing it. ZipExtFile verifies the CRC-32 once the
+        # member is fully read.
+        known = store.find_crc(member.file_size, member.CRC)
+        if known and member_digest(readers.get(), member) == known:
+            store.link(known, target)
+            if progress:
+                progress(member.file_size)
+            return target
+        with readers.get().open(member) as fsrc:
+            store.install_stream(fsrc, target, progress)
+        return target
+
+    created = [os.path.join(mods_dir, name) for name in {m.filename.split("/")[0] for m in members}]
+    try:
+        paths = run_parallel(extract, members)
+    except BaseException:
+        # also catches Cancelled: leave no half-imported mod behind
+        for folder in created:
+            shutil.rmtree(folder, ignore_errors=True)
+        raise
+    finally:
+        readers.close()
+
+    mods = {}
+    for member, path in zip(members, paths):
+        mods.setdefault(member.filename.split("/")[0], []).append(path)
+    return group_files(mods)
+
+
+# Format 2 packages list every file with its digest. Blobs the store already
+# has are linked instead of extracted, and delta packs leave them out of the
+# zip entirely. Mods are assembled in a ".<name>.partial" folder that is kept
+# if the import is interrupted; its links keep the extracted blobs alive, so
+# running the import again only extracts what is still missing. Existing mods
+# are replaced by the new file set.
+def import_v2(zip_path, manifest, mods_dir, store, progress=None):
+    members = manifest["members"]
+    missing = {
+        entry["digest"] for mod in manifest["mods"] for entry in mod["files"]
+        if not store.has(entry["digest"]) and entry["digest"] not in members
+    }
+    if missing:
+        raise PackageError(
+            f"This delta package needs {len(missing)} file(s) that are not in your library. "
+            "Import the full package first."
+        )
+    sizes = {entry["digest"]: entry["size"] for mod in manifest["mods"] for entry in mod["files"]}
+    needed = {d for d in sizes if not store.has(d)}
+    if sum(sizes[d] for d in needed) > shutil.disk_usage(mods_dir).free:
+        raise PackageError("Not enough free disk space for this package.")
+
+    # each missing blob is extracted straight into the first file that uses it
+    plan, first = [], {}
+    for mod in manifest["mods"]:
+        partial = os.path.join(mods_dir, f".{mod['name']}.partial")
+        for entry in mod["files"]:
+            target = os.path.join(partial, *safe_parts(entry["name"]))
+            plan.append((mod["name"], entry, target))
+            first.setdefault(entry["digest"], target)
+
+    readers = ZipReaders(zip_path)
+
+    def extract(digest):
+        target = first[digest]
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if os.path.exists(target):
+            os.remove(target)
+        with readers.get().open(members[digest]) as fsrc:
+            got = store.install_stream(fsrc, target, progress)
+        if got != digest:
+            os.remove(target)
+            raise PackageError(f"Checksum mismatch for {members[digest]}")
+
+    try:
+        run_parallel(extract, sorted(needed))
+    finally:
+        readers.close()
+
+    result = {}
+    for name, entry, target in plan:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        blob = store.blob_path(entry["digest"])
+        if not (os.path.exists(target) and os.path.exists(blob) and os.path.samefile(target, blob)):
+            if os.path.exists(target):
+                os.remove(target)
+            store.link(entry["digest"], target)
+        if progress and not (entry["digest"] in needed and first[entry["digest"]] == target):
+            progress(entry["size"])
+        result.setdefault(name, []).append(os.path.join(mods_dir, name, *safe_parts(entry["name"])))
+    planned = {target for _, _, target in plan}
+    for name in result:
+        partial = os.path.join(mods_dir, f".{name}.partial")
+        # drop leftovers of an earlier, different import of the same mod
+        for root, _, files in os.walk(partial):
+            for f in files:
+                if os.path.join(root, f) not in planned:
+                    os.remove(os.path.join(root, f))
+        dest = os.path.join(mods_dir, name)
+        if os.path.exists(dest):
+            old = os.path.join(mods_dir, f".{name}.old")
+            os.rename(dest, old)
+            os.rename(partial, dest)
+            shutil.rmtree(old, ignore_errors=True)
+        else:
+            os.rename(partial, dest)
+    return group_files(result)
+
+
+# -------------------- EXPORT --------------------
+ZIP64_LIMIT = (1 << 31) - 1
+BLOCK_SIZE = 1 << 20
+WINDOW_SIZE = 32 << 10
+SAMPLE_SIZE = 64 << 10
+STORE_RATIO = 0.9
+EXPORT_WORKERS = min(8, os.cpu_count() or 1)
+
+
+def dos_datetime(mtime):
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), \
+        ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+
+# Minimal streaming zip writer. Sizes and CRCs go into data descriptors, so
+# members can be written as their compressed blocks arrive; zip64 records are
+# added where the sizes or offsets need them.
+class ZipStreamWriter:
+    def __init__(self, fp):
+        self.fp = fp
+        self.offset = 0
+        self.entries = []
+        self.current = None
+
+    def _write(self, data):
+        self.fp.write(data)
+        self.offset += len(data)
+
+    def begin(self, name, method, mtime, mode, file_size):
+        encoded = name.encode("utf-8")
+        flags = 0x08 | (0x800 if not name.isascii() else 0)
+        zip64 = file_size >= ZIP64_LIMIT
+        dostime, dosdate = dos_datetime(mtime)
+        extra = struct.pack("<HHQQ", 1, 16, 0, 0) if zip64 else b""
+        self.current = [encoded, flags, method, dostime, dosdate, mode, self.offset, zip64]
+        self._write(struct.pack(
+            "<IHHHHHIIIHH", 0x04034B50, 45 if zip64 else 20, flags, method, dostime, dosdate,
+            0, 0xFFFFFFFF if zip64 else 0, 0xFFFFFFFF if zip64 else 0, len(encoded), len(extra),
+        ) + encoded + extra)
+        self.data_start = self.offset
+
+    def write(self, data):
+        self._write(data)
+
+    def end(self, crc, file_size):
+        compress_size = self.offset - self.data_start
+        zip64 = self.current[-1]
+        if zip64:
+            self._write(struct.pack("<IIQQ", 0x08074B50, crc, compress_size, file_size))
+        else:
+            self._write(struct.pack("<IIII", 0x08074B50, crc, compress_size, file_size))
+        self.entries.append(self.current + [crc, compress_size, file_size])
+        self.current = None
+        return compress_size
+
+    def close(self):
+        cd_start = self.offset
+        for encoded, flags, method, dostime, dosdate, mode, offset, zip64, crc, csize, usize in self.entries:
+            fields = []
+            if zip64 or usize >= ZIP64_LIMIT or csize >= ZIP64_LIMIT:
+                fields += [usize, csize]
+                usize = csize = 0xFFFFFFFF
+            if offset >= ZIP64_LIMIT:
+                fields.append(offset)
+                offset = 0xFFFFFFFF
+            extra = struct.pack(f"<HH{len(fields)}Q", 1, 8 * len(fields), *fields) if fields else b""
+            self._write(struct.pack(
+                "<IHHHHHHIIIHHHHHII", 0x02014B50, (3 << 8) | 45, 45 if fields else 20, flags, method,
+                dostime, dosdate, crc, csize, usize, len(encoded), len(extra), 0, 0, 0,
+                (mode & 0xFFFF) << 16, offset,
+            ) + encoded + extra)
+        cd_size = self.offset - cd_start
+        count = len(self.entries)
+        if count >= 0xFFFF or cd_start >= ZIP64_LIMIT or cd_size >= ZIP64_LIMIT:
+            eocd64 = self.offset
+            self._write(struct.pack("<IQHHIIQQQQ", 0x06064B50, 44, 45, 45, 0, 0, count, count, cd_size, cd_start))
+            self._write(struct.pack("<IIQI", 0x07064B50, 0, eocd64, 1))
+            count, cd_size, cd_start = min(count, 0xFFFF), min(cd_size, 0xFFFFFFFF), min(cd_start, 0xFFFFFFFF)
+        self._write(struct.pack("<IHHHHIIH", 0x06054B50, 0, 0, count, count, cd_size, cd_start, 0))
+
+
+# Compresses a few samples spread over the file; music WADs are mostly Ogg
+# data that deflate cannot shrink, so those are stored as-is.
+def choose_method(path, size):
+    if size < SAMPLE_SIZE:
+        return zipfile.ZIP_DEFLATED
+    raw = packed = 0
+    with open_content(path) as f:
+        for i in range(4):
+            f.seek((size - SAMPLE_SIZE) * i // 3)
+            sample = f.read(SAMPLE_SIZE)
+            raw += len(sample)
+            packed += len(zlib.compress(sample, 1))
+    return zipfile.ZIP_STORED if packed > raw * STORE_RATIO else zipfile.ZIP_DEFLATED
+
+
+# Blocks are deflated independently and primed with the previous block's
+# tail (the pigz scheme); sync-flushed raw deflate blocks concatenate into
+# one valid stream.
+def deflate_block(block, window, last):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15, zdict=window) if window else \
+        zlib.compressobj(6, zlib.DEFLATED, -15)
+    return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+# mods: [(mod_name, mod_folder)]. Files whose digest is in `exclude` (the
+# contents of a base package) are listed but not stored, which makes a delta
+# pack. Music WADs kept as deltas locally are exported in full.
+# Returns (manifest, members) for export_package().
+def build_manifest(mods, digest_of, exclude=()):
+    manifest = {"format": PACKAGE_FORMAT, "mods": [], "members": {}}
+    members = []
+    for mod_name, mod_folder in mods:
+        files = []
+        for root, _, names in os.walk(mod_folder):
+            for f in sorted(names):
+                path = os.path.join(root, f)
+                digest = digest_of(path)
+                rel = os.path.relpath(path, mod_folder).replace(os.sep, "/")
+                if rel.endswith(DELTA_SUFFIX):
+                    rel = rel[:-len(DELTA_SUFFIX)] + ".wad"
+                files.append({"name": rel, "digest": digest, "size": content_size(path)})
+                if digest not in exclude and digest not in manifest["members"]:
+                    arcname = f"{mod_name}/{rel}"
+                    manifest["members"][digest] = arcname
+                    members.append((path, arcname))
+        manifest["mods"].append({"name": mod_name, "files": files})
+    return manifest, members
+
+
+def package_digests(zip_path):
+    with zipfile.ZipFile(zip_path, "r") as zipf:
+        manifest = read_manifest(zipf)
+    if not manifest:
+        raise PackageError("The base package has no manifest; export it again with this version first.")
+    return {entry["digest"] for mod in manifest["mods"] for entry in mod["files"]}
+
+
+# members: [(path, arcname)]. Reads, compresses and writes with at most a
+# bounded number of blocks in flight. The manifest, if any, goes last.
+# Returns stats for the export.
+def export_package(members, save_path, progress=None, manifest=None):
+    started = time.monotonic()
+    total_in = total_out = 0
+    with open(save_path, "wb") as fp, ThreadPoolExecutor(EXPORT_WORKERS) as pool:
+        writer = ZipStreamWriter(fp)
+        for path, arcname in members:
+            st = os.stat(path)
+            size = content_size(path)
+            method = choose_method(path, size)
+            writer.begin(arcname, method, st.st_mtime, st.st_mode, size)
+            crc = 0
+            in_flight = deque()
+            window = b""
+            with open_content(path) as f:
+                block = f.read(BLOCK_SIZE)
+                while True:
+                    following = f.read(BLOCK_SIZE) if block else b""
+                    crc = zlib.crc32(block, crc)
+                    if method == zipfile.ZIP_STORED:
+                        writer.write(block)
+                    else:
+                        in_flight.append(pool.submit(deflate_block, block, window, not following))
+                        window = block[-WINDOW_SIZE:]
+                        while len(in_flight) > 2 * EXPORT_WORKERS:
+                            writer.write(in_flight.popleft().result())
+                    if progress:
+                        progress(len(block))
+                    if not following:
+                        break
+                    block = following
+            while in_flight:
+                writer.write(in_flight.popleft().result())
+            total_in += size
+            total_out += writer.end(crc, size)
+        if manifest:
+            data = json.dumps(manifest, indent=1).encode("utf-8")
+            writer.begin(MANIFEST_NAME, zipfile.ZIP_DEFLATED, time.time(), 0o100644, len(data))
+            writer.write(deflate_block(data, b"", True))
+            writer.end(zlib.crc32(data), len(data))
+        writer.close()
+    elapsed = max(time.monotonic() - started, 1e-6)
+    return {
+        "bytes_in": total_in,
+        "bytes_out": total_out,
+        "seconds": elapsed,
+        "mb_per_s": total_in / elapsed / 1e6,
+        "ratio": total_out / total_in if total_in else 1.0,
+    }
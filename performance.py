@@ -0,0 +1,101 @@
+import os
+import threading
+
+from PySide6.QtWidgets import (
+    QCheckBox, QDialog, QFileDialog, QHBoxLayout, QLabel, QMessageBox, QPushButton, QTreeWidget,
+    QTreeWidgetItem, QVBoxLayout
+)
+
+import tracing
+
+COLUMNS = ["Operation", "Time (ms)", "Written", "MB/s", "Thread"]
+
+
+def _bytes(n):
+    if n >= 1 << 20:
+        return f"{n / 1e6:.1f} MB"
+    if n >= 1 << 10:
+        return f"{n / 1e3:.1f} KB"
+    return f"{n} B" if n else ""
+
+
+# Recorded spans as a tree, outermost operations first, newest at the top.
+class PerformanceDialog(QDialog):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Performance")
+        self.resize(800, 500)
+        layout = QVBoxLayout(self)
+
+        self.record_check = QCheckBox("Record timings of file operations and UI refreshes")
+        self.record_check.setChecked(tracing.enabled())
+        self.record_check.toggled.connect(self.on_record_toggled)
+        layout.addWidget(self.record_check)
+
+        self.tree = QTreeWidget()
+        self.tree.setColumnCount(len(COLUMNS))
+        self.tree.setHeaderLabels(COLUMNS)
+        self.tree.setColumnWidth(0, 320)
+        layout.addWidget(self.tree)
+        self.summary = QLabel()
+        layout.addWidget(self.summary)
+
+        btn_row = QHBoxLayout()
+        refresh_btn = QPushButton("Refresh")
+        clear_btn = QPushButton("Clear")
+        export_btn = QPushButton("Export Chrome Trace")
+        close_btn = QPushButton("Close")
+        for btn in (refresh_btn, clear_btn, export_btn, close_btn):
+            btn_row.addWidget(btn)
+        layout.addLayout(btn_row)
+        refresh_btn.clicked.connect(self.refresh)
+        clear_btn.clicked.connect(self.on_clear)
+        export_btn.clicked.connect(self.on_export)
+        close_btn.clicked.connect(self.accept)
+        self.refresh()
+
+    def on_record_toggled(self, on):
+        tracing.set_enabled(on)
+        self.refresh()
+
+    def on_clear(self):
+        tracing.clear()
+        self.refresh()
+
+    def on_export(self):
+        path = QFileDialog.getSaveFileName(self, "Export Chrome Trace", "hmmm-trace.json", "*.json")[0]
+        if not path:
+            return
+        try:
+            tracing.export_chrome_trace(path)
+        except OSError as e:
+            QMessageBox.critical(self, "Error", f"Failed to export the trace:\n{e}")
+            return
+        QMessageBox.information(self, "Success",
+                                f"Trace saved to {os.path.basename(path)}.\nOpen it in chrome://tracing or ui.perfetto.dev.")
+
+    def refresh(self):
+        self.tree.clear()
+        spans = tracing.spans()
+        items = {}
+        main = threading.main_thread().ident
+        for span in spans:
+            seconds = span.duration / 1e9
+            item = QTreeWidgetItem([
+                span.name + (f" ({span.error})" if span.error else ""),
+                f"{span.duration / 1e6:.2f}",
+                _bytes(span.bytes),
+                f"{span.bytes / seconds / 1e6:.0f}" if span.bytes and seconds else "",
+                "UI" if span.thread == main else "worker",
+            ])
+            items[span.id] = (span, item)
+        # recorded as they end, so siblings come out in the order they ran
+        for span, item in items.values():
+            parent = items.get(span.parent)
+            if parent:
+                parent[1].addChild(item)
+            else:
+                self.tree.insertTopLevelItem(0, item)
+        total = sum(s.duration for s in spans if s.parent not in items) / 1e6
+        state = "recording" if tracing.enabled() else "not recording"
+        self.summary.setText(f"{len(spans)} spans ({state}), {total:.1f} ms in top-level operations")
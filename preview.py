@@ -0,0 +1,293 @@
+import json
+import os
+import shutil
+import threading
+import uuid
+from collections import OrderedDict, namedtuple
+
+from PySide6.QtCore import QBuffer, QIODevice, QObject, QRunnable, QSize, QThreadPool, Qt, Signal
+from PySide6.QtGui import QIcon, QImage, QPixmap
+from PySide6.QtWidgets import QLabel, QListView, QListWidget, QListWidgetItem, QVBoxLayout, QWidget
+
+from compose import is_track
+from delta import content_entry
+from wad import WadError, WadReader
+
+PREVIEW_DIR = os.path.join("cache", "previews")
+THUMB_SIZE = 96
+MAX_THUMBS = 12
+# thumbnails kept in memory, in PNG bytes
+MEMORY_BUDGET = 32 << 20
+PREVIEW_WORKERS = 2
+IMAGE_SUFFIXES = (".png",)
+
+# images: [(entry name, PNG thumbnail bytes)], tracks: [entry name]
+FilePreview = namedtuple("FilePreview", "entries images tracks")
+
+
+# -------------------- EXTRACTION --------------------
+# QImage (unlike QPixmap) may be used off the GUI thread.
+def _thumbnail(image):
+    scaled = image.scaled(THUMB_SIZE, THUMB_SIZE, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+    buffer = QBuffer()
+    buffer.open(QIODevice.WriteOnly)
+    scaled.save(buffer, "PNG")
+    return bytes(buffer.data())
+
+
+def extract_preview(path, cache=None):
+    images, tracks = [], []
+    with WadReader(path, cache) as reader:
+        for entry in reader.entries:
+            name = entry.name.lower()
+            if is_track(name):
+                tracks.append(entry.name)
+            elif name.endswith(IMAGE_SUFFIXES) and entry.size and len(images) < MAX_THUMBS:
+                payload = reader.payload(entry.name)
+                try:
+                    image = QImage.fromData(bytes(payload))
+                finally:
+                    payload.release()
+                if not image.isNull():
+                    images.append((entry.name, _thumbnail(image)))
+        return FilePreview(len(reader.entries), images, tracks)
+
+
+# -------------------- CACHE --------------------
+# Previews of single WAD files. In memory they are kept by (path, size, mtime)
+# up to MEMORY_BUDGET bytes of thumbnails, least recently used first out; on
+# disk by content digest, so a WAD is only ever parsed once no matter how
+# many mods share it.
+class PreviewCache:
+    def __init__(self, fingerprints=None, wad_index=None, cache_dir=PREVIEW_DIR, budget=MEMORY_BUDGET):
+        self.fingerprints = fingerprints
+        self.wad_index = wad_index
+        self.cache_dir = cache_dir
+        self.budget = budget
+        self.memory = OrderedDict()
+        self.used = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _key(path):
+        st = os.stat(path)
+        return os.path.abspath(path), st.st_size, st.st_mtime_ns
+
+    # memory only, cheap enough for the GUI thread
+    def peek(self, path):
+        try:
+            key = self._key(path)
+        except OSError:
+            return None
+        with self.lock:
+            preview = self.memory.get(key)
+            if preview is not None:
+                self.memory.move_to_end(key)
+            return preview
+
+    def get(self, path):
+        key = self._key(path)
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return self.memory[key]
+        digest = None
+        if self.fingerprints is not None:
+            digest = content_entry(path, self.fingerprints)["digest"]
+            self.fingerprints.save()
+        preview = self._load(digest) if digest else None
+        if preview is None:
+            preview = extract_preview(path, self.wad_index)
+            if digest:
+                self._save(digest, preview)
+        with self.lock:
+            if key not in self.memory:
+                self.memory[key] = preview
+                self.used += _size(preview)
+            while self.used > self.budget and len(self.memory) > 1:
+                _, old = self.memory.popitem(last=False)
+                self.used -= _size(old)
+        return preview
+
+    def _load(self, digest):
+        folder = os.path.join(self.cache_dir, digest)
+        try:
+            with open(os.path.join(folder, "preview.json"), "r") as f:
+                meta = json.load(f)
+            images = []
+            for i, name in enumerate(meta["images"]):
+                with open(os.path.join(folder, f"{i}.png"), "rb") as f:
+                    images.append((name, f.read()))
+        except (OSError, ValueError, KeyError):
+            return None
+        return FilePreview(meta["entries"], images, meta["tracks"])
+
+    # written to a temp folder and renamed, readers never see half a preview
+    def _save(self, digest, preview):
+        folder = os.path.join(self.cache_dir, digest)
+        tmp = os.path.join(self.cache_dir, f".{digest}.{uuid.uuid4().hex[:8]}.hmmm-tmp")
+        os.makedirs(tmp)
+        try:
+            for i, (_, data) in enumerate(preview.images):
+                with open(os.path.join(tmp, f"{i}.png"), "wb") as f:
+                    f.write(data)
+            with open(os.path.join(tmp, "preview.json"), "w") as f:
+                json.dump({"entries": preview.entries, "images": [name for name, _ in preview.images],
+                           "tracks": preview.tracks}, f)
+            os.rename(tmp, folder)
+        except OSError:
+            # another worker got there first
+            pass
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+
+def _size(preview):
+    return sum(len(data) for _, data in preview.images) + 64 * len(preview.tracks)
+
+
+# -------------------- LOADER --------------------
+class PreviewTask(QRunnable):
+    def __init__(self, loader, row):
+        super().__init__()
+        self.setAutoDelete(False)
+        self.loader = loader
+        self.row = row
+
+    def run(self):
+        previews = None
+        # rows scrolled out of view before their turn came are dropped
+        if self.row.name in self.loader.wanted:
+            previews = []
+            for path in self.row.patch_wads + ([self.row.music_wad] if self.row.music_wad else []):
+                try:
+                    previews.append((os.path.basename(path), self.loader.cache.get(path)))
+                except (OSError, WadError):
+                    pass
+        self.loader.task_done.emit(self, previews)
+
+
+# Builds previews on a small pool of its own, next to (not in) the job
+# panel's. Results arrive through ready(mod_name, [(file name, FilePreview)]).
+class PreviewLoader(QObject):
+    ready = Signal(str, object)
+    task_done = Signal(object, object)
+
+    def __init__(self, cache, parent=None):
+        super().__init__(parent)
+        self.cache = cache
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(PREVIEW_WORKERS)
+        self.tasks = {}
+        self.selected = None
+        self.visible = set()
+        self.wanted = set()
+        self.task_done.connect(self._on_ready)
+
+    # the preview of row if every one of its files is in memory, else None
+    def cached(self, row):
+        previews = []
+        for path in row.patch_wads + ([row.music_wad] if row.music_wad else []):
+            preview = self.cache.peek(path)
+            if preview is None:
+                return None
+            previews.append((os.path.basename(path), preview))
+        return previews
+
+    def select(self, row):
+        self.selected = row.name
+        self._want()
+        self._request(row, 1)
+
+    # warms the cache for the rows on screen; replaces the previous set
+    def prefetch(self, rows):
+        self.visible = {row.name for row in rows}
+        self._want()
+        for row in rows:
+            if self.cached(row) is None:
+                self._request(row, 0)
+
+    def _want(self):
+        self.wanted = self.visible | {self.selected}
+
+    def _request(self, row, priority):
+        task = self.tasks.get(row.name)
+        if task is not None:
+            # still queued: move it up for the selection
+            if priority and self.pool.tryTake(task):
+                self.pool.start(task, priority)
+            return
+        task = PreviewTask(self, row)
+        self.tasks[row.name] = task
+        self.pool.start(task, priority)
+
+    def _on_ready(self, task, previews):
+        if self.tasks.get(task.row.name) is task:
+            del self.tasks[task.row.name]
+        if previews is not None:
+            self.ready.emit(task.row.name, previews)
+        elif task.row.name in self.wanted:
+            # dropped while unwanted, but wanted again since
+            self._request(task.row, 1 if task.row.name == self.selected else 0)
+
+    def wait(self):
+        self.wanted = set()
+        self.pool.clear()
+        self.pool.waitForDone()
+
+
+# -------------------- PANE --------------------
+class PreviewPane(QWidget):
+    def __init__(self, loader, parent=None):
+        super().__init__(parent)
+        self.loader = loader
+        self.mod_name = None
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(0, 0, 0, 0)
+        self.title = QLabel("Select a mod to preview it")
+        self.title.setWordWrap(True)
+        self.images = QListWidget()
+        self.images.setViewMode(QListView.IconMode)
+        self.images.setIconSize(QSize(THUMB_SIZE, THUMB_SIZE))
+        self.images.setResizeMode(QListView.Adjust)
+        self.images.setMovement(QListView.Static)
+        self.tracks = QListWidget()
+        layout.addWidget(self.title)
+        layout.addWidget(QLabel("Textures"))
+        layout.addWidget(self.images, 3)
+        layout.addWidget(QLabel("Tracks"))
+        layout.addWidget(self.tracks, 2)
+        loader.ready.connect(self._on_ready)
+
+    def show_mod(self, row):
+        self.mod_name = row.name if row else None
+        self.images.clear()
+        self.tracks.clear()
+        if row is None:
+            self.title.setText("Select a mod to preview it")
+            return
+        previews = self.loader.cached(row)
+        if previews is not None:
+            self._fill(previews)
+        else:
+            self.title.setText(f"{row.name}\nLoading preview...")
+            self.loader.select(row)
+
+    def _on_ready(self, mod_name, previews):
+        if mod_name == self.mod_name:
+            self._fill(previews)
+
+    def _fill(self, previews):
+        self.images.clear()
+        self.tracks.clear()
+        entries = sum(preview.entries for _, preview in previews)
+        self.title.setText(f"{self.mod_name}\n{entries} files in {len(previews)} WAD(s)")
+        for file_name, preview in previews:
+            for name, data in preview.images:
+                pixmap = QPixmap()
+                pixmap.loadFromData(data, "PNG")
+                item = QListWidgetItem(QIcon(pixmap), os.path.basename(name))
+                item.setToolTip(f"{file_name}: {name}")
+                self.images.addItem(item)
+            for name in preview.tracks:
+                self.tracks.addItem(os.path.basename(name))
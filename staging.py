@@ -0,0 +1,120 @@
+import os
+
+from activation import place
+from delta import content_entry, content_size, packed_header
+from tracing import traced
+
+STAGING_DIR = ".hmmm-staged"
+STAGING_BUDGET = 2 << 30
+USED_SUFFIX = ".used"
+
+
+# Fully materialized game files, kept in a hidden folder next to the game file
+# they are for and named by content digest. A staged copy is on the game's
+# filesystem and plain, so a switch links it into place and swaps it in with
+# os.replace instead of copying across drives or decompressing. Each copy has
+# an empty .used sidecar whose mtime orders the LRU; the copy itself is never
+# touched, it may be hardlinked into the game folder.
+class StagingCache:
+    def __init__(self, fingerprints, budget=STAGING_BUDGET):
+        self.fingerprints = fingerprints
+        self.budget = budget
+
+    def dir_for(self, game_file):
+        return os.path.join(os.path.dirname(game_file), STAGING_DIR)
+
+    # Only sources that cost a real copy are worth staging: other drives, and
+    # deltas or cold files, which have to be rebuilt.
+    def wanted(self, game_file, src):
+        if not self.budget or not src or not os.path.exists(src):
+            return False
+        if packed_header(src):
+            return True
+        try:
+            return os.stat(src).st_dev != os.stat(os.path.dirname(game_file)).st_dev
+        except OSError:
+            return False
+
+    # The staged copy of src for game_file, or None. Never hashes: src's
+    # digest must already be known, and a staged copy whose stat no longer
+    # matches its fingerprint (e.g. Steam rewrote the game file it is linked
+    # to) doesn't count.
+    def lookup(self, game_file, src):
+        if not self.wanted(game_file, src):
+            return None
+        entry = content_entry(src, self.fingerprints, cached_only=True)
+        if not entry:
+            return None
+        path = os.path.join(self.dir_for(game_file), entry["digest"])
+        staged = self.fingerprints.cached(path)
+        if not staged or staged["digest"] != entry["digest"]:
+            return None
+        self._touch(path)
+        return path
+
+    # returns the bytes written
+    @traced("staging.stage")
+    def stage(self, game_file, src, progress=None):
+        entry = content_entry(src, self.fingerprints)
+        path = os.path.join(self.dir_for(game_file), entry["digest"])
+        if self.lookup(game_file, src):
+            return 0
+        os.makedirs(self.dir_for(game_file), exist_ok=True)
+        place(src, path, progress)
+        self.fingerprints.record(path, entry)
+        self._touch(path)
+        return entry["size"]
+
+    def _touch(self, path):
+        with open(path + USED_SUFFIX, "a"):
+            pass
+        os.utime(path + USED_SUFFIX)
+
+    # [(last used, path, size)] in the staging folders of game_files
+    def entries(self, game_files):
+        found = []
+        for folder in {self.dir_for(g) for g in game_files}:
+            if not os.path.isdir(folder):
+                continue
+            for entry in os.scandir(folder):
+                if entry.name.startswith(".") or entry.name.endswith(USED_SUFFIX):
+                    continue
+                try:
+                    used = os.stat(entry.path + USED_SUFFIX).st_mtime
+                except OSError:
+                    used = 0
+                found.append((used, entry.path, entry.stat().st_size))
+        return found
+
+    # Drops least recently used copies until the rest fit the budget, and
+    # leftovers of interrupted staging. Copies in keep go last.
+    def prune(self, game_files, keep=()):
+        for folder in {self.dir_for(g) for g in game_files}:
+            if os.path.isdir(folder):
+                for entry in os.scandir(folder):
+                    if entry.name.endswith(".hmmm-tmp"):
+                        os.remove(entry.path)
+        entries = sorted(self.entries(game_files), key=lambda e: (e[1] in keep, e[0]))
+        total = sum(size for _, _, size in entries)
+        freed = 0
+        for _, path, size in entries:
+            if total <= self.budget:
+                break
+            self.remove(path)
+            total -= size
+            freed += size
+        return freed
+
+    def remove(self, path):
+        os.remove(path)
+        if os.path.exists(path + USED_SUFFIX):
+            os.remove(path + USED_SUFFIX)
+        self.fingerprints.forget(path)
+
+    def clear(self, game_files):
+        for _, path, _ in self.entries(game_files):
+            self.remove(path)
+
+
+def staging_size(work):
+    return sum(content_size(src) for _, src in work)
@@ -0,0 +1,222 @@
+import json
+import os
+import threading
+import time
+import uuid
+
+from copier import atomic_clone, atomic_copy, copy_file
+from hashing import TreeHasher, hash_file
+
+STORE_DIR = "store"
+INDEX_LOG_MIN = 1024
+
+
+def pin_path(digest, root=STORE_DIR):
+    return os.path.join(root, "pins", digest)
+
+
+# Content-addressed blob store. Mod files are hardlinks to blobs, so a blob's
+# reference count is simply its link count minus the store's own link.
+class BlobStore:
+    def __init__(self, root=STORE_DIR):
+        self.root = root
+        self.blobs_dir = os.path.join(root, "blobs")
+        self.tmp_dir = os.path.join(root, "tmp")
+        os.makedirs(self.blobs_dir, exist_ok=True)
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        # "size:crc32" -> digest, lets zip members be matched before extracting.
+        # New keys are appended to index.log and folded into index.json now
+        # and then, rewriting the whole index per file gets quadratic.
+        self.index_file = os.path.join(root, "index.json")
+        self.log_file = os.path.join(root, "index.log")
+        self.index = {}
+        self.logged = 0
+        if os.path.exists(self.index_file):
+            with open(self.index_file, "r") as f:
+                self.index = json.load(f)
+        if os.path.exists(self.log_file):
+            with open(self.log_file, "r") as f:
+                for line in f:
+                    parts = line.split()
+                    # a torn last line from a crash is simply skipped
+                    if len(parts) == 2:
+                        self.index[parts[0]] = parts[1]
+                        self.logged += 1
+
+    def blob_path(self, digest):
+        return os.path.join(self.blobs_dir, digest[:2], digest)
+
+    def has(self, digest):
+        return os.path.exists(self.blob_path(digest))
+
+    def temp_path(self):
+        return os.path.join(self.tmp_dir, uuid.uuid4().hex)
+
+    def find_crc(self, size, crc):
+        digest = self.index.get(f"{size}:{crc}")
+        if digest and self.has(digest):
+            return digest
+        return None
+
+    def _remember(self, hasher, digest):
+        with self.lock:
+            key = f"{hasher.size}:{hasher.crc}"
+            if self.index.get(key) == digest:
+                return
+            self.index[key] = digest
+            with open(self.log_file, "a") as f:
+                f.write(f"{key} {digest}\n")
+            self.logged += 1
+            if self.logged > max(INDEX_LOG_MIN, len(self.index)):
+                self._compact_index()
+
+    def _compact_index(self):
+        tmp = self.index_file + ".hmmm-tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.index, f)
+        os.replace(tmp, self.index_file)
+        if os.path.exists(self.log_file):
+            os.remove(self.log_file)
+        self.logged = 0
+
+    def link(self, digest, dest_path):
+        with self.lock:
+            self._link_or_copy(self.blob_path(digest), dest_path)
+
+    # progress sees the file twice: once while hashing, once while copying
+    def install(self, src_path, dest_path, progress=None):
+        hasher = hash_file(src_path, progress)
+        digest = hasher.hexdigest()
+        self._remember(hasher, digest)
+        blob = self.blob_path(digest)
+        with self.lock:
+            if os.path.exists(blob):
+                self._link_or_copy(blob, dest_path)
+                if progress:
+                    progress(os.path.getsize(blob))
+                return digest
+        tmp = self.temp_path()
+        try:
+            copy_file(src_path, tmp, progress)
+            with self.lock:
+                self._commit(tmp, blob, dest_path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        return digest
+
+    # writes a stream (e.g. a zip member) into the store while hashing it
+    def install_stream(self, fsrc, dest_path, progress=None):
+        hasher = TreeHasher()
+        tmp = self.temp_path()
+        try:
+            with open(tmp, "wb") as fdst:
+                while True:
+                    data = fsrc.read(1 << 20)
+                    if not data:
+                        break
+                    hasher.update(data)
+                    fdst.write(data)
+                    if progress:
+                        progress(len(data))
+            digest = hasher.hexdigest()
+            blob = self.blob_path(digest)
+            with self.lock:
+                if os.path.exists(blob):
+                    self._link_or_copy(blob, dest_path)
+                else:
+                    self._commit(tmp, blob, dest_path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        self._remember(hasher, digest)
+        return digest
+
+    def adopt(self, path):
+        # deduplicate a file that was written into the mods tree directly
+        hasher = hash_file(path)
+        digest = hasher.hexdigest()
+        self._remember(hasher, digest)
+        blob = self.blob_path(digest)
+        if os.path.exists(blob):
+            if not os.path.samefile(blob, path):
+                tmp = path + ".hmmm-tmp"
+                try:
+                    os.link(blob, tmp)
+                    os.replace(tmp, path)
+                except OSError:
+                    pass
+            return digest
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        try:
+            os.link(path, blob)
+        except OSError:
+            pass
+        return digest
+
+    # Keeps a file's current contents around even after the file itself
+    # changes; used for the vanilla bases that deltas are built against. A
+    # pin is a copy (or reflink) of its own, not a link to a blob, so nothing
+    # written through another link can change it.
+    def pin(self, path):
+        hasher = hash_file(path)
+        digest = hasher.hexdigest()
+        self._remember(hasher, digest)
+        pinned = pin_path(digest, self.root)
+        if not os.path.exists(pinned) or os.stat(pinned).st_nlink > 1:
+            # a missing pin, or a linked one from an older version
+            os.makedirs(os.path.dirname(pinned), exist_ok=True)
+            atomic_clone(path, pinned)
+        return digest
+
+    # drops the pins of bases no delta in `keep` (digests) is built against
+    def unpin_unused(self, keep):
+        pins_dir = os.path.dirname(pin_path("", self.root))
+        if not os.path.isdir(pins_dir):
+            return
+        for entry in os.scandir(pins_dir):
+            if entry.name not in keep:
+                os.remove(entry.path)
+
+    def _commit(self, tmp, blob, dest_path):
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        try:
+            os.link(tmp, dest_path)
+        except OSError:
+            # no hardlinks here (e.g. FAT/exFAT): keep a plain copy, no blob
+            os.replace(tmp, dest_path)
+            return
+        os.replace(tmp, blob)
+
+    def _link_or_copy(self, blob, dest_path):
+        try:
+            os.link(blob, dest_path)
+        except OSError:
+            atomic_copy(blob, dest_path)
+
+    # -------------------- GARBAGE COLLECTION --------------------
+    def gc(self):
+        with self.lock:
+            return self._gc()
+
+    def _gc(self):
+        freed = 0
+        for shard in os.scandir(self.blobs_dir):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                # DirEntry.stat() reports st_nlink as 0 on Windows
+                st = os.stat(entry.path)
+                if st.st_nlink <= 1:
+                    os.remove(entry.path)
+                    freed += st.st_size
+        if freed:
+            self.index = {k: d for k, d in self.index.items() if self.has(d)}
+            self._compact_index()
+        # leftovers from interrupted writes
+        cutoff = time.time() - 24 * 3600
+        for entry in os.scandir(self.tmp_dir):
+            if entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        return freed
@@ -0,0 +1,125 @@
+import itertools
+import json
+import os
+import threading
+import time
+from collections import deque, namedtuple
+from functools import wraps
+
+RING_SIZE = 10000
+
+# start and duration in nanoseconds; parent is the id of the enclosing span
+Span = namedtuple("Span", "id parent name category start duration bytes thread error")
+
+# Off unless turned on in the Performance dialog or with HMMM_TRACE=1. While
+# off, a traced call costs one global lookup on top of the call itself.
+_enabled = os.environ.get("HMMM_TRACE") == "1"
+_ring = deque(maxlen=RING_SIZE)
+_local = threading.local()
+_ids = itertools.count(1)
+_origin = time.perf_counter_ns()
+
+
+def enabled():
+    return _enabled
+
+
+def set_enabled(on):
+    global _enabled
+    _enabled = on
+
+
+# -------------------- SPANS --------------------
+class _Active:
+    __slots__ = ("id", "parent", "name", "category", "start", "bytes")
+
+    def __init__(self, name, category):
+        self.name = name
+        self.category = category
+        self.bytes = 0
+
+    def __enter__(self):
+        stack = getattr(_local, "stack", None)
+        if stack is None:
+            stack = _local.stack = []
+        self.id = next(_ids)
+        self.parent = stack[-1].id if stack else None
+        stack.append(self)
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter_ns() - self.start
+        stack = _local.stack
+        stack.pop()
+        if stack:
+            # bytes roll up, the outer span covers everything inside it
+            stack[-1].bytes += self.bytes
+        _ring.append(Span(self.id, self.parent, self.name, self.category, self.start - _origin, duration,
+                          self.bytes, threading.get_ident(), exc_type.__name__ if exc_type else None))
+        return False
+
+
+class _Null:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL = _Null()
+
+
+def span(name, category="hmmm"):
+    return _Active(name, category) if _enabled else _NULL
+
+
+def traced(name, category="hmmm"):
+    def wrap(fn):
+        @wraps(fn)
+        def call(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            with _Active(name, category):
+                return fn(*args, **kwargs)
+        return call
+    return wrap
+
+
+# adds bytes written to the innermost open span of this thread
+def count(nbytes):
+    if _enabled:
+        stack = getattr(_local, "stack", None)
+        if stack:
+            stack[-1].bytes += nbytes
+
+
+# -------------------- RESULTS --------------------
+def spans():
+    return list(_ring)
+
+
+def clear():
+    _ring.clear()
+
+
+# Chrome's trace event format: load it in chrome://tracing or ui.perfetto.dev.
+def chrome_trace(recorded=None):
+    events = []
+    for s in spans() if recorded is None else recorded:
+        args = {"bytes": s.bytes}
+        if s.error:
+            args["error"] = s.error
+        events.append({
+            "name": s.name, "cat": s.category, "ph": "X", "pid": os.getpid(), "tid": s.thread,
+            "ts": s.start / 1000, "dur": s.duration / 1000, "args": args,
+        })
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+def export_chrome_trace(path):
+    with open(path, "w") as f:
+        json.dump(chrome_trace(), f)
@@ -0,0 +1,206 @@
+import io
+import json
+import mmap
+import os
+import struct
+import threading
+from collections import OrderedDict, namedtuple
+
+import delta
+from tracing import count
+
+WAD_INDEX_DIR = os.path.join("cache", "wad-index")
+MEMORY_CACHE_SIZE = 64
+
+WadEntry = namedtuple("WadEntry", "name offset size")
+
+
+class WadError(ValueError):
+    pass
+
+
+# -------------------- INDEX --------------------
+# HM2 WAD layout: an optional "AGAR" header, the file table (name, size,
+# offset relative to the data section), the directory table, then the data.
+def read_prefix(f):
+    f.seek(0)
+    if f.read(4) != b"AGAR":
+        f.seek(0)
+        return b""
+    versions = f.read(12)
+    if len(versions) != 12:
+        raise WadError("truncated WAD header")
+    (ext_len,) = struct.unpack("<I", versions[8:])
+    return b"AGAR" + versions + f.read(ext_len)
+
+
+def parse_index(f, size):
+    def read(fmt):
+        data = f.read(struct.calcsize(fmt))
+        if len(data) != struct.calcsize(fmt):
+            raise WadError("truncated WAD header")
+        return struct.unpack(fmt, data)
+
+    def read_name():
+        (length,) = read("<I")
+        if length > 4096:
+            raise WadError("bad entry name length")
+        return f.read(length).decode("utf-8", "replace")
+
+    read_prefix(f)
+    (count,) = read("<I")
+    if count > 1_000_000:
+        raise WadError("not a WAD")
+    files = []
+    for _ in range(count):
+        name = read_name()
+        length, offset = read("<QQ")
+        files.append((name, offset, length))
+    (dir_count,) = read("<I")
+    if dir_count > 1_000_000:
+        raise WadError("not a WAD")
+    for _ in range(dir_count):
+        read_name()
+        (children,) = read("<I")
+        for _ in range(children):
+            read_name()
+            f.seek(1, io.SEEK_CUR)
+    data_start = f.tell()
+    entries = [WadEntry(name, data_start + offset, length) for name, offset, length in files]
+    for entry in entries:
+        if entry.offset + entry.size > size:
+            raise WadError(f"entry {entry.name} runs past the end of the file")
+    return entries
+
+
+# Parsed indexes are kept in memory by (path, size, mtime) and on disk by
+# content digest, when the digest is already known without hashing.
+class IndexCache:
+    def __init__(self, cache_dir=WAD_INDEX_DIR, fingerprints=None):
+        self.cache_dir = cache_dir
+        self.fingerprints = fingerprints
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _digest(self, path):
+        header = delta.packed_header(path)
+        if header:
+            return header["digest"]
+        if self.fingerprints:
+            entry = self.fingerprints.cached(path)
+            return entry["digest"] if entry else None
+        return None
+
+    def get(self, path, f, size):
+        st = os.stat(path)
+        key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return self.memory[key]
+        digest = self._digest(path)
+        disk_path = os.path.join(self.cache_dir, f"{digest}.json") if digest else None
+        if disk_path and os.path.exists(disk_path):
+            with open(disk_path, "r") as cached:
+                entries = [WadEntry(*e) for e in json.load(cached)]
+        else:
+            entries = parse_index(f, size)
+            if disk_path:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                with open(disk_path, "w") as cached:
+                    json.dump(entries, cached)
+        with self.lock:
+            self.memory[key] = entries
+            while len(self.memory) > MEMORY_CACHE_SIZE:
+                self.memory.popitem(last=False)
+        return entries
+
+
+default_cache = IndexCache()
+
+
+# -------------------- READER --------------------
+# Random access to entry payloads. Plain WADs are memory-mapped and payload()
+# returns zero-copy memoryviews; deltas are read through their DeltaFile.
+class WadReader:
+    def __init__(self, path, cache=None):
+        self.path = path
+        self.mm = None
+        self.file = delta.open_content(path)
+        try:
+            header = delta.packed_header(path)
+            if header:
+                self.size = header["size"]
+            else:
+                self.size = os.fstat(self.file.fileno()).st_size
+                if self.size:
+                    self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.entries = (cache or default_cache).get(path, self.file, self.size)
+        except Exception:
+            self.close()
+            raise
+        self.by_name = {entry.name: entry for entry in self.entries}
+        self.file.seek(0)
+        self.prefix = read_prefix(self.file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def payload(self, name):
+        entry = self.by_name[name]
+        if self.mm is not None:
+            return memoryview(self.mm)[entry.offset:entry.offset + entry.size]
+        self.file.seek(entry.offset)
+        return memoryview(self.file.read(entry.size))
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+        self.file.close()
+
+
+def list_entries(path, cache=None):
+    with WadReader(path, cache) as reader:
+        return list(reader.entries)
+
+
+# -------------------- WRITER --------------------
+def _name(name):
+    encoded = name.encode("utf-8")
+    return struct.pack("<I", len(encoded)) + encoded
+
+
+def directory_table(names):
+    # dicts as ordered sets: children keep their first-seen order
+    dirs = {"": {}}
+    for name in names:
+        parts = name.split("/")
+        for i, part in enumerate(parts):
+            parent = "/".join(parts[:i])
+            dirs.setdefault(parent, {})[(part, 0 if i == len(parts) - 1 else 1)] = None
+    table = [struct.pack("<I", len(dirs))]
+    for folder, children in dirs.items():
+        table.append(_name(folder) + struct.pack("<I", len(children)))
+        table.extend(_name(child) + bytes([kind]) for child, kind in children)
+    return b"".join(table)
+
+
+# items: (name, payload) pairs, payloads being buffers such as the
+# memoryviews WadReader.payload() hands out. Payloads are written as-is, in
+# order, right after the tables.
+def write_wad(f, items, prefix=b"", progress=None):
+    table, offset = [struct.pack("<I", len(items))], 0
+    for name, payload in items:
+        table.append(_name(name) + struct.pack("<QQ", len(payload), offset))
+        offset += len(payload)
+    f.write(prefix + b"".join(table) + directory_table(name for name, _ in items))
+    for _, payload in items:
+        f.write(payload)
+        if progress:
+            progress(len(payload))
+    count(offset)
+    return offset